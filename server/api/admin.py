@@ -1,6 +1,10 @@
+from django import forms
 from django.contrib import admin
 
-from .models import Player, Equipment, Harvest, Minigame, PlayerHarvest, PlayerEquipment, PlayerMinigame
+from .leaderboard import invalidate_minigame_leaderboards, rebuild_leaderboard
+from .models import (MAX_MINIGAME_ID, Player, Equipment, Harvest, Minigame,
+                     PlayerHarvest, PlayerEquipment, PlayerMinigame, packed_progress)
+from .progress import reset_players
 
 
 class EquipmentAdmin(admin.ModelAdmin):
@@ -18,7 +22,18 @@ class HarvestAdmin(admin.ModelAdmin):
     )
 
 
+class MinigameForm(forms.ModelForm):
+    def clean(self):
+        # Для достижения новой игры нужен свободный бит в Player.achievement_mask
+        if self.instance.pk is None and Minigame.objects.filter(
+                id__gte=MAX_MINIGAME_ID).exists():
+            raise forms.ValidationError(
+                f'Нельзя добавить больше {MAX_MINIGAME_ID} мини-игр')
+        return super().clean()
+
+
 class MinigameAdmin(admin.ModelAdmin):
+    form = MinigameForm
     list_display = (
         'id',
         'name',
@@ -27,8 +42,27 @@ class MinigameAdmin(admin.ModelAdmin):
     )
 
 
-class EquipmentInline(admin.TabularInline):
+class ProgressInline(admin.TabularInline):
+    # Записи прогресса загружаются вместе с оборудованием/урожаем/игрой,
+    # а варианты выбора для них читаются один раз на страницу
+    catalog_field = None
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related(self.catalog_field)
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        formfield = super().formfield_for_foreignkey(db_field, request, **kwargs)
+        if db_field.name == self.catalog_field:
+            choices = request.__dict__.setdefault('_catalog_choices', {})
+            if db_field.name not in choices:
+                choices[db_field.name] = list(formfield.choices)
+            formfield.choices = choices[db_field.name]
+        return formfield
+
+
+class EquipmentInline(ProgressInline):
     model = PlayerEquipment
+    catalog_field = 'equipment'
     extra = 0
     readonly = True
     fieldsets = (
@@ -38,8 +72,9 @@ class EquipmentInline(admin.TabularInline):
     )
 
 
-class HarvestInline(admin.TabularInline):
+class HarvestInline(ProgressInline):
     model = PlayerHarvest
+    catalog_field = 'harvest'
     extra = 0
     readonly = True
     fields = (
@@ -49,8 +84,9 @@ class HarvestInline(admin.TabularInline):
     )
 
 
-class MinigameInline(admin.TabularInline):
+class MinigameInline(ProgressInline):
     model = PlayerMinigame
+    catalog_field = 'minigame'
     extra = 0
     readonly = True
     fields = (
@@ -68,6 +104,7 @@ class PlayerAdmin(admin.ModelAdmin):
     inlines = [EquipmentInline, MinigameInline]
     save_on_top = True
     save_as = True
+    actions = ['reset_progress']
     fieldsets = (
         (None, {
             "fields": (("name", "gender"),)
@@ -77,6 +114,49 @@ class PlayerAdmin(admin.ModelAdmin):
         }),
     )
 
+    def get_inlines(self, request, obj):
+        # Упакованный прогресс редактируется как документ Player.progress
+        if packed_progress():
+            return []
+        return super().get_inlines(request, obj)
+
+    def get_fieldsets(self, request, obj=None):
+        fieldsets = super().get_fieldsets(request, obj)
+        if packed_progress():
+            fieldsets = (*fieldsets, (None, {"fields": ("progress",)}))
+        return fieldsets
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # Достижения могли измениться во вкладке мини-игр
+        form.instance.refresh_achievements()
+        form.instance.save(update_fields=['achievement_mask', 'achievement_count'])
+        # Изменённые результаты мини-игр меняют их таблицы лидеров
+        minigame_ids = set()
+        for formset in formsets:
+            if formset.model is not PlayerMinigame:
+                continue
+            rows = [*formset.new_objects, *formset.deleted_objects,
+                    *(row for row, _ in formset.changed_objects)]
+            minigame_ids.update(row.minigame_id for row in rows)
+        if minigame_ids:
+            invalidate_minigame_leaderboards(sorted(minigame_ids))
+
+    def save_model(self, request, obj, form, change):
+        # Правка в админке может затронуть любую часть состояния игрока
+        if change:
+            obj.mark_reset()
+        super().save_model(request, obj, form, change)
+        # Ручная правка рекорда может как поднять, так и опустить игрока
+        if 'top_score' in form.changed_data:
+            rebuild_leaderboard()
+
+    @admin.action(description='Начать новую игру для выбранных игроков')
+    def reset_progress(self, request, queryset):
+        reset = reset_players(queryset)
+        invalidate_minigame_leaderboards()
+        self.message_user(request, f'Прогресс сброшен у игроков: {reset}')
+
 
 admin.site.register(Equipment, EquipmentAdmin)
 admin.site.register(Harvest, HarvestAdmin)
@@ -0,0 +1,149 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Player, ProgressBackfill, packed_progress
+from .progress import TABLES
+
+logger = logging.getLogger(__name__)
+
+# Строки прогресса существующих игроков для новой записи справочника.
+#
+# Новая запись оборудования, урожая или мини-игры получает задание
+# ProgressBackfill. Задание выполняется фоновым потоком процесса, который
+# добавил запись, или командой backfill_progress. Команда loaddata только
+# создаёт задания: её процесс завершается раньше, чем поток закончил бы
+# проход, а выполняет их backfill_progress при запуске контейнера.
+# Строки вставляются запросами INSERT ... SELECT по диапазонам id игроков,
+# каждый диапазон - отдельная короткая транзакция, между ними пауза.
+# Позиция прохода хранится в задании, прерванный проход продолжается с неё.
+#
+# Процессы со старым кэшем справочников ещё CATALOG_VERSION_CHECK_INTERVAL
+# секунд создают игроков без новой строки. Игрок с меньшим id, чья
+# транзакция зафиксирована позже, чем проход миновал его id, тоже остался
+# бы без строки. Поэтому после основного прохода задание выполняет
+# проверочный проход с начала: он начинается ещё через этот срок после
+# того, как все процессы увидели новую запись, и благодаря NOT EXISTS
+# вставляет только пропущенные строки.
+#
+# При упакованном хранении (PLAYER_PROGRESS_STORAGE = 'packed') строки
+# не нужны: новая запись справочника читается из документа значениями
+# по умолчанию.
+
+BACKFILL_CHUNK_SIZE = 10000
+BACKFILL_PAUSE = 0.05
+
+SECTIONS = {table.catalog_field: table for table in TABLES}
+CATALOG_TABLES = {table.catalog: table for table in TABLES}
+
+
+def backfill_sql(table):
+    # Строки прогресса записи справочника для игроков из диапазона id,
+    # у которых её ещё нет. Поля строки - значения по умолчанию модели.
+    qn = connection.ops.quote_name
+    player = qn(Player._meta.db_table)
+    rows = qn(table.model._meta.db_table)
+    catalog_column = qn(f'{table.catalog_field}_id')
+    defaults = [field for field in table.model._meta.concrete_fields
+                if field.column not in ('id', 'player_id', f'{table.catalog_field}_id',
+                                        table.name_field)]
+    columns = ', '.join(qn(column) for column in (
+        'player_id', f'{table.catalog_field}_id', table.name_field,
+        *(field.column for field in defaults)))
+    placeholders = ', '.join(['%s'] * (len(defaults) + 2))
+    sql = (f'INSERT INTO {rows} ({columns}) '
+           f'SELECT {player}.{qn("id")}, {placeholders} FROM {player} '
+           f'WHERE {player}.{qn("id")} > %s AND {player}.{qn("id")} <= %s '
+           f'AND NOT EXISTS (SELECT 1 FROM {rows} WHERE {rows}.{qn("player_id")} = '
+           f'{player}.{qn("id")} AND {rows}.{catalog_column} = %s)')
+    return sql, [field.get_default() for field in defaults]
+
+
+def insert_missing_rows(table, catalog_id, name, first_id, last_id):
+    # Вставка строк для игроков с id в (first_id, last_id], возвращает число строк
+    sql, defaults = backfill_sql(table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql, [catalog_id, name, *defaults, first_id, last_id, catalog_id])
+        return cursor.rowcount
+
+
+def schedule_backfill(catalog_row, start=True):
+    # Задание для новой записи справочника. С start=True оно запускается
+    # фоновым потоком после коммита, иначе ждёт команду backfill_progress.
+    if packed_progress():
+        return None
+    backfill = ProgressBackfill.objects.create(
+        catalog=CATALOG_TABLES[type(catalog_row)].catalog_field,
+        catalog_id=catalog_row.id)
+    if start:
+        transaction.on_commit(lambda: start_backfill(backfill.id))
+    return backfill
+
+
+def start_backfill(backfill_id):
+    def run():
+        try:
+            run_backfill(backfill_id)
+        except Exception:
+            logger.exception('Progress backfill %d failed', backfill_id)
+        finally:
+            connection.close()
+
+    threading.Thread(
+        target=run, name=f'progress-backfill-{backfill_id}', daemon=True).start()
+
+
+def run_backfill(backfill_id, chunk_size=BACKFILL_CHUNK_SIZE, pause=BACKFILL_PAUSE,
+                 report=None):
+    # Выполняет задание до конца. Задание блокируется на время каждого
+    # диапазона, поэтому поток и команда могут выполнять его одновременно.
+    # report(задание, последний id игрока) вызывается после каждого диапазона.
+    settle = timedelta(seconds=settings.CATALOG_VERSION_CHECK_INTERVAL)
+    while True:
+        wait = 0
+        with transaction.atomic():
+            backfill = ProgressBackfill.objects.select_for_update().get(pk=backfill_id)
+            if backfill.finished_at is not None:
+                return backfill
+            table = SECTIONS[backfill.catalog]
+            name = table.catalog.objects.filter(pk=backfill.catalog_id).values_list(
+                'name', flat=True).first()
+            max_id = Player.objects.order_by('-id').values_list(
+                'id', flat=True).first() or 0
+            now = timezone.now()
+
+            if name is None or (backfill.rescan_at is not None
+                                and backfill.last_player_id >= max_id):
+                # Запись справочника удалена или проверочный проход закончен
+                backfill.finished_at = now
+                backfill.save(update_fields=['finished_at'])
+                return backfill
+
+            if backfill.rescan_at is not None and now < backfill.rescan_at:
+                wait = (backfill.rescan_at - now).total_seconds()
+            elif backfill.last_player_id < max_id:
+                last_id = min(backfill.last_player_id + chunk_size, max_id)
+                backfill.inserted += insert_missing_rows(
+                    table, backfill.catalog_id, name, backfill.last_player_id, last_id)
+                backfill.last_player_id = last_id
+                backfill.save(update_fields=['last_player_id', 'inserted'])
+            else:
+                # Основной проход закончен, проверочный идёт с начала
+                backfill.rescan_at = max(now, backfill.created_at + settle) + settle
+                backfill.last_player_id = 0
+                backfill.save(update_fields=['rescan_at', 'last_player_id'])
+                wait = (backfill.rescan_at - now).total_seconds()
+
+        if report is not None and not wait:
+            report(backfill, max_id)
+        time.sleep(wait or pause)
+
+
+def pending_backfills():
+    return ProgressBackfill.objects.filter(finished_at__isnull=True).order_by('id')
@@ -0,0 +1,98 @@
+import logging
+
+from django.db import DatabaseError, transaction
+from rest_framework.exceptions import ValidationError
+
+from .models import Player
+from .payload import validate_update
+from .progress import TABLES
+from .serializers import update_player
+
+logger = logging.getLogger(__name__)
+
+SECTIONS = {table.catalog_field: table for table in TABLES}
+
+
+def coalesce(player, operations):
+    # Операции игрока сливаются в одно изменение в порядке запроса:
+    # поле игрока принимает последнее значение, строка прогресса - поля
+    # из последней операции, где она указана. Рекорд и прирост за день
+    # и неделю считаются по всей последовательности own_coins, как при
+    # отдельных PATCH: наибольшее значение и сумма положительных приростов.
+    merged = {}
+    coins = peak = player.own_coins
+    gained = 0
+    for data in operations:
+        for key, value in data.items():
+            table = SECTIONS.get(key)
+            if table is None:
+                merged[key] = value
+                continue
+            rows = merged.setdefault(key, {})
+            for item in value:
+                rows.setdefault(item[table.name_field], {}).update(item)
+        if 'own_coins' in data:
+            gained += max(data['own_coins'] - coins, 0)
+            coins = data['own_coins']
+            peak = max(peak, coins)
+
+    for key in SECTIONS:
+        if key in merged:
+            merged[key] = list(merged[key].values())
+    return merged, peak, gained
+
+
+def apply_player_operations(player, items):
+    # Операции игрока записываются одним обновлением в своей точке
+    # сохранения: ошибка откатывает только их. Все операции игрока
+    # получают версию состояния после записи.
+    merged, peak, gained = coalesce(player, [data for _, data in items])
+    try:
+        with transaction.atomic():
+            update_player(player, merged, peak_coins=peak, gained_coins=gained)
+    except ValidationError as error:
+        return [{'status': 400, 'errors': error.detail}] * len(items)
+    except DatabaseError:
+        logger.exception('Batch update of player %d failed', player.id)
+        return [{'status': 500, 'error': 'Failed to save player'}] * len(items)
+    return [{'status': 200, 'version': player.version}] * len(items)
+
+
+def apply_batch(operations):
+    # Операции всех игроков выполняются в одной транзакции.
+    # Каждая операция проверяется отдельно, затем корректные операции
+    # игрока записываются одним обновлением в его точке сохранения.
+    results = [None] * len(operations)
+
+    with transaction.atomic():
+        # Строки игроков блокируются в порядке id
+        players = {
+            player.id: player
+            for player in Player.objects.with_progress().select_for_update().filter(
+                id__in={operation['player'] for operation in operations}
+            ).order_by('id')
+        }
+
+        pending = {}
+        for index, operation in enumerate(operations):
+            player = players.get(operation['player'])
+            if player is None:
+                results[index] = {'player': operation['player'], 'status': 404,
+                                  'error': 'Player not found'}
+                continue
+
+            try:
+                data = validate_update(player, operation['data'])
+            except ValidationError as error:
+                results[index] = {'player': player.id, 'status': 400,
+                                  'errors': error.detail}
+                continue
+            pending.setdefault(player.id, []).append((index, data))
+
+        # Проверенные операции уже приведены к виду для записи
+        for player_id, items in pending.items():
+            player_results = apply_player_operations(players[player_id], items)
+            for (index, _), result in zip(items, player_results):
+                results[index] = {'player': player_id, **result}
+
+    return results
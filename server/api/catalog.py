@@ -0,0 +1,105 @@
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from .models import CatalogVersion, Equipment, Harvest, Minigame
+
+# Кэш справочников (оборудование, урожай, мини-игры) в памяти процесса.
+#
+# Справочники меняются только загрузкой данных и через админку.
+# Процесс держит неизменяемый снимок всех справочников вместе с версией
+# из CatalogVersion и сверяет её с базой не чаще раза в
+# CATALOG_VERSION_CHECK_INTERVAL секунд. Изменение справочника
+# (сигналы post_save/post_delete) увеличивает версию в той же транзакции,
+# поэтому остальные процессы перечитывают снимок не позже чем через интервал,
+# а изменивший процесс - сразу после коммита.
+
+CATALOG_MODELS = (Equipment, Harvest, Minigame)
+VERSION_PK = 1
+
+
+class CatalogSnapshot:
+    # Записи справочников не изменяются после загрузки снимка
+    def __init__(self, version):
+        self.version = version
+        self.rows = {}
+        self.items = {}
+        self.ids = {}
+        # Готовые тела ответов по этому снимку (api/rendered.py)
+        self.rendered = {}
+        for model in CATALOG_MODELS:
+            rows = tuple(model.objects.order_by('id'))
+            self.rows[model] = {row.id: row for row in rows}
+            self.items[model] = tuple((row.id, row.name) for row in rows)
+            self.ids[model] = {row.name: row.id for row in rows}
+
+
+_snapshot = None
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def catalog_version():
+    return CatalogVersion.objects.filter(pk=VERSION_PK).values_list(
+        'version', flat=True).first() or 0
+
+
+def catalog_snapshot():
+    global _snapshot, _checked_at
+    now = time.monotonic()
+    snapshot = _snapshot
+    interval = settings.CATALOG_VERSION_CHECK_INTERVAL
+    if snapshot is not None and now - _checked_at < interval:
+        return snapshot
+
+    with _lock:
+        # Версия читается до записей: снимок не окажется новее своей версии
+        version = catalog_version()
+        if _snapshot is None or _snapshot.version != version:
+            _snapshot = CatalogSnapshot(version)
+        _checked_at = now
+        return _snapshot
+
+
+def catalog_items(model):
+    # Пары (id, name) записей справочника в порядке id
+    return catalog_snapshot().items[model]
+
+
+def catalog_rows(model):
+    # Записи справочника в порядке id
+    return tuple(catalog_snapshot().rows[model].values())
+
+
+def catalog_row(model, catalog_id):
+    # Запись справочника по id или None
+    return catalog_snapshot().rows[model].get(catalog_id)
+
+
+def catalog_row_named(model, name):
+    # Запись справочника по названию или None
+    snapshot = catalog_snapshot()
+    return snapshot.rows[model].get(snapshot.ids[model].get(name))
+
+
+def catalog_index(model):
+    # {название: id} записей справочника
+    return catalog_snapshot().ids[model]
+
+
+def clear_catalog():
+    # Снимок процесса перечитывается при следующем обращении
+    global _snapshot
+    _snapshot = None
+
+
+def bump_catalog_version():
+    # Новая версия справочников для всех процессов
+    updated = CatalogVersion.objects.filter(pk=VERSION_PK).update(
+        version=F('version') + 1)
+    if not updated:
+        CatalogVersion.objects.get_or_create(pk=VERSION_PK, defaults={'version': 1})
+    transaction.on_commit(clear_catalog)
@@ -0,0 +1,95 @@
+from django.db import connection, transaction
+
+from .leaderboard import record_top_score
+from .models import Player
+from .score_history import record_coins
+from .shared_leaderboard import update_shared_score
+
+# Поля, которые меняются приращениями
+INCREMENT_FIELDS = ('own_coins', 'own_money', 'credit')
+RETURNING_FIELDS = ('id', *INCREMENT_FIELDS, 'top_score', 'version')
+
+# Наибольшее число игроков в одном UPDATE
+INCREMENT_CHUNK_SIZE = 500
+
+
+def increment_sql(fields, count):
+    # Один UPDATE без предварительного чтения строк для count игроков:
+    # приращения полей, рост top_score, новая версия состояния
+    # и новые значения в RETURNING. Приращения передаются таблицей
+    # delta(id, поля...). В SET все выражения видят значения строки до изменения.
+    qn = connection.ops.quote_name
+    postgresql = connection.vendor == 'postgresql'
+    table = qn(Player._meta.db_table)
+
+    def column(name):
+        return f'{table}.{qn(name)}'
+
+    columns = ', '.join(qn(name) for name in ('id', *fields))
+    placeholders = ', '.join(['%s'] * (len(fields) + 1))
+    values = ', '.join([f'({placeholders})'] * count)
+
+    assignments = [f'{qn(field)} = {column(field)} + delta.{qn(field)}'
+                   for field in fields]
+    if 'own_coins' in fields:
+        greatest = 'GREATEST' if postgresql else 'MAX'
+        assignments.append(
+            f'{qn("top_score")} = {greatest}({column("top_score")}, '
+            f'{column("own_coins")} + delta.{qn("own_coins")})')
+
+    if postgresql:
+        pairs = ', '.join(f"'{field}', {column('version')} + 1" for field in fields)
+        versions = f'{column("change_versions")} || jsonb_build_object({pairs})'
+    else:
+        pairs = ', '.join(f"'$.{field}', {column('version')} + 1" for field in fields)
+        versions = f'json_set({column("change_versions")}, {pairs})'
+    assignments.append(f'{qn("change_versions")} = {versions}')
+    assignments.append(f'{qn("version")} = {column("version")} + 1')
+
+    returning = ', '.join(column(name) for name in RETURNING_FIELDS)
+    return (f'WITH delta({columns}) AS (VALUES {values}) '
+            f'UPDATE {table} SET {", ".join(assignments)} FROM delta '
+            f'WHERE {column("id")} = delta.{qn("id")} RETURNING {returning}')
+
+
+def increment_players(deltas):
+    # Применяет приращения {id игрока: {поле: значение}}.
+    # Игроки с одинаковым набором изменяемых полей обновляются
+    # одним запросом на пачку. Возвращает {id игрока: новые значения},
+    # отсутствующих игроков в результате нет.
+    groups = {}
+    for player_id, player_deltas in deltas.items():
+        fields = tuple(field for field in INCREMENT_FIELDS if player_deltas.get(field))
+        if fields:
+            groups.setdefault(fields, []).append(player_id)
+
+    results = {}
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            for fields, player_ids in groups.items():
+                for start in range(0, len(player_ids), INCREMENT_CHUNK_SIZE):
+                    chunk = player_ids[start:start + INCREMENT_CHUNK_SIZE]
+                    params = []
+                    for player_id in chunk:
+                        params.append(player_id)
+                        params.extend(deltas[player_id][field] for field in fields)
+                    cursor.execute(increment_sql(fields, len(chunk)), params)
+                    for row in cursor.fetchall():
+                        values = dict(zip(RETURNING_FIELDS, row))
+                        results[values.pop('id')] = values
+
+        # UPDATE минует save(), поэтому обработчики вызываются здесь же.
+        # Рекорд мог вырасти, только если очки выросли до него.
+        for player_id, values in results.items():
+            coins = deltas[player_id].get('own_coins', 0)
+            if coins > 0 and values['top_score'] == values['own_coins']:
+                record_top_score(Player(id=player_id, top_score=values['top_score']))
+                update_shared_score(player_id, values['top_score'])
+            record_coins(player_id, coins)
+
+    return results
+
+
+def increment_player(player_id, deltas):
+    # Новые значения полей игрока или None, если игрока нет
+    return increment_players({player_id: deltas}).get(player_id)
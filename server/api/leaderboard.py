@@ -0,0 +1,310 @@
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import IntegerField, Q
+from django.db.models.fields.json import KT
+from django.db.models.functions import Cast, Coalesce
+
+from .catalog import catalog_items
+from .models import (
+    LeaderboardEntry,
+    Minigame,
+    Player,
+    PlayerMinigame,
+    achievement_bit,
+    packed_progress,
+)
+from .shared_leaderboard import (
+    SharedLeaderboardUnavailable,
+    get_shared_leaderboard,
+    load_from_db,
+    shared_leaderboard_engine,
+)
+
+# Порядок игроков в таблице лидеров: по убыванию top_score,
+# при равных очках выше стоит игрок с меньшим id (зарегистрировался раньше).
+# Порядок поддерживается индексом player_rank_idx.
+LEADERBOARD_ORDERING = ('-top_score', 'id')
+
+logger = logging.getLogger(__name__)
+
+# Количество игроков в таблице лидеров
+LEADERBOARD_SIZE = 100
+
+# Время жизни закэшированной таблицы лидеров мини-игры, секунд.
+# Кэш сбрасывается при росте очков, таймаут ограничивает устаревание
+# в других процессах при локальном кэше.
+MINIGAME_LEADERBOARD_CACHE_TIMEOUT = 60
+
+# Ключи advisory-блокировок снимка таблицы лидеров в PostgreSQL:
+# запись в снимок и перестроение, которое может опустить последнюю запись
+LEADERBOARD_LOCK_KEY = 0x4c42
+LEADERBOARD_REBUILD_LOCK_KEY = 0x4c43
+
+
+def ahead_of(top_score, player_id):
+    # Условие "стоит в рейтинге выше позиции (top_score, player_id)".
+    # Первое слагаемое задаёт границу диапазона по индексу,
+    # второе отсекает игроков с равными очками и большим id.
+    return Q(top_score__gte=top_score) & (
+        Q(top_score__gt=top_score) | Q(id__lt=player_id))
+
+
+def behind(top_score, player_id):
+    # Условие "стоит в рейтинге ниже позиции (top_score, player_id)"
+    return Q(top_score__lte=top_score) & (
+        Q(top_score__lt=top_score) | Q(id__gt=player_id))
+
+
+def ranking():
+    # Полный рейтинг всех игроков в порядке таблицы лидеров
+    return Player.objects.for_leaderboard().order_by(*LEADERBOARD_ORDERING)
+
+
+def players_around(player, count):
+    # Соседи игрока по рейтингу: count игроков выше и count ниже.
+    # Оба запроса читают не более count строк по индексу от позиции игрока.
+    above = Player.objects.for_leaderboard().filter(
+        ahead_of(player.top_score, player.id)
+    ).order_by('top_score', '-id')[:count]
+    below = ranking().filter(behind(player.top_score, player.id))[:count]
+    return list(reversed(above)), list(below)
+
+
+def player_place(player):
+    # Место берётся из рейтинга в разделяемой памяти, если он включён:
+    # там оно ищется за O(log n) при любом размере таблицы
+    engine = get_shared_leaderboard()
+    if engine is not None:
+        try:
+            place = engine.place(player.id)
+        except SharedLeaderboardUnavailable:
+            place = None
+        if place is not None:
+            return place
+
+    # Место игрока = количество игроков выше него + 1.
+    # Запрос проходит записи индекса выше игрока, поэтому считается
+    # не больше LEADERBOARD_DB_PLACE_LIMIT записей. Место ниже этой границы
+    # без рейтинга в разделяемой памяти не определяется: возвращается None.
+    limit = settings.LEADERBOARD_DB_PLACE_LIMIT
+    ahead = Player.objects.filter(
+        ahead_of(player.top_score, player.id))[:limit].count()
+    if ahead >= limit:
+        logger.error('Place of player %d is below %d, the shared leaderboard '
+                     '(LEADERBOARD_SHARED_PATH) is not loaded', player.id, limit)
+        return None
+    return ahead + 1
+
+
+def top_players():
+    engine = get_shared_leaderboard()
+    if engine is not None:
+        try:
+            leaders = [player_id for top_score, player_id
+                       in engine.top(LEADERBOARD_SIZE) if top_score > 0]
+        except SharedLeaderboardUnavailable:
+            leaders = None
+        if leaders is not None:
+            players = Player.objects.for_leaderboard().in_bulk(leaders)
+            return [players[player_id] for player_id in leaders if player_id in players]
+
+    # Лучшие игроки читаются через снимок LeaderboardEntry,
+    # сортируется не более LEADERBOARD_SIZE строк
+    return Player.objects.for_leaderboard().filter(
+        id__in=LeaderboardEntry.objects.values('player_id')
+    ).order_by(*LEADERBOARD_ORDERING)[:LEADERBOARD_SIZE]
+
+
+def advisory_lock(key, shared=False):
+    # В SQLite запись и так идёт в одной транзакции за раз
+    if connection.vendor == 'postgresql':
+        function = 'pg_advisory_xact_lock_shared' if shared else 'pg_advisory_xact_lock'
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT {function}(%s)', [key])
+
+
+def lock_leaderboard():
+    # Вход в снимок и вытеснение из него выполняются по одному
+    # до конца транзакции
+    advisory_lock(LEADERBOARD_LOCK_KEY)
+
+
+def enters_leaderboard(player):
+    # Результат игрока выше последнего в заполненной таблице лидеров.
+    # Возвращает также число записей в снимке.
+    count = LeaderboardEntry.objects.count()
+    if count < LEADERBOARD_SIZE:
+        return True, count
+    lowest = LeaderboardEntry.objects.order_by('top_score', '-player_id').first()
+    if lowest is None:
+        return True, 0
+    return (player.top_score, -player.id) > (lowest.top_score, -lowest.player_id), count
+
+
+def record_top_score(player):
+    # Обновление снимка после роста top_score игрока.
+    # Запись меняется, только если игрок уже в таблице лидеров
+    # или его новый результат вытесняет последнего в ней.
+    if player.top_score <= 0:
+        return
+
+    with transaction.atomic():
+        if update_entry(player):
+            return
+
+        # Последняя запись опускается только перестроением снимка
+        # (удаление игрока, правка рекорда в админке, rebuild_leaderboard).
+        # Разделяемая блокировка до конца транзакции не даёт перестроению
+        # прочитать таблицу Player раньше, чем будет зафиксирован новый
+        # рекорд, поэтому игрока, который сейчас не проходит, перестроение
+        # увидит. Проверки разных игроков друг друга не ждут.
+        advisory_lock(LEADERBOARD_REBUILD_LOCK_KEY, shared=True)
+        if not enters_leaderboard(player)[0]:
+            return
+
+        lock_leaderboard()
+        # Пока блокировка ждала, перестроение могло добавить игрока в снимок
+        if update_entry(player):
+            return
+        enters, count = enters_leaderboard(player)
+        if not enters:
+            return
+
+        LeaderboardEntry.objects.create(
+            player_id=player.id, top_score=player.top_score)
+
+        # Вытесняются последние записи сверх размера таблицы
+        if count >= LEADERBOARD_SIZE:
+            extra = LeaderboardEntry.objects.order_by(
+                'top_score', '-player_id'
+            ).values_list('player_id', flat=True)[:count + 1 - LEADERBOARD_SIZE]
+            LeaderboardEntry.objects.filter(player_id__in=list(extra)).delete()
+
+
+def update_entry(player):
+    return LeaderboardEntry.objects.filter(
+        player_id=player.id).update(top_score=player.top_score)
+
+
+def rebuild_leaderboard():
+    # Полное перестроение снимка по таблице Player. Исключительная блокировка
+    # перестроения ждёт транзакции, проверившие рекорд без входа в снимок;
+    # порядок блокировок тот же, что в record_top_score.
+    with transaction.atomic():
+        advisory_lock(LEADERBOARD_REBUILD_LOCK_KEY)
+        lock_leaderboard()
+        LeaderboardEntry.objects.all().delete()
+        leaders = Player.objects.filter(top_score__gt=0).order_by(
+            *LEADERBOARD_ORDERING).values_list('id', 'top_score')
+        LeaderboardEntry.objects.bulk_create([
+            LeaderboardEntry(player_id=player_id, top_score=top_score)
+            for player_id, top_score in leaders[:LEADERBOARD_SIZE]
+        ])
+
+
+def rebuild_shared_leaderboard():
+    # Загрузка или сверка рейтинга в разделяемой памяти с таблицей Player
+    engine = shared_leaderboard_engine()
+    if engine is not None:
+        load_from_db(engine)
+    return engine
+
+
+def minigame_cache_key(minigame_id):
+    return f'minigame_leaderboard:{minigame_id}'
+
+
+def packed_minigame_score(minigame_id):
+    # Результат мини-игры в упакованном прогрессе Player.progress
+    return Coalesce(Cast(KT(f'progress__minigame__score__{minigame_id - 1}'),
+                         IntegerField()), 0)
+
+
+def minigame_top_players(minigame):
+    # Лучшие игроки мини-игры по score, читаются по индексу minigame_score_idx
+    # и кэшируются до роста чьего-либо результата в этой игре
+    key = minigame_cache_key(minigame.id)
+    leaders = cache.get(key)
+    if leaders is None and packed_progress():
+        # Индекса по упакованному прогрессу нет, список держится в кэше
+        rows = Player.objects.annotate(
+            score=packed_minigame_score(minigame.id)
+        ).filter(score__gt=0).order_by('-score', 'id').values(
+            'id', 'name', 'score', 'achievement_mask'
+        )[:LEADERBOARD_SIZE]
+        leaders = [
+            {
+                'place': place,
+                'player_id': row['id'],
+                'name': row['name'],
+                'score': row['score'],
+                'achievement': bool(
+                    row['achievement_mask'] & achievement_bit(minigame.id)),
+            }
+            for place, row in enumerate(rows, start=1)
+        ]
+        cache.set(key, leaders, MINIGAME_LEADERBOARD_CACHE_TIMEOUT)
+    elif leaders is None:
+        rows = PlayerMinigame.objects.filter(
+            minigame=minigame, score__gt=0
+        ).order_by('-score', 'player_id').values(
+            'player_id', 'player__name', 'score', 'achievement'
+        )[:LEADERBOARD_SIZE]
+        leaders = [
+            {
+                'place': place,
+                'player_id': row['player_id'],
+                'name': row['player__name'],
+                'score': row['score'],
+                'achievement': row['achievement'],
+            }
+            for place, row in enumerate(rows, start=1)
+        ]
+        cache.set(key, leaders, MINIGAME_LEADERBOARD_CACHE_TIMEOUT)
+    return leaders
+
+
+def minigame_place(player_minigame):
+    # Место игрока в мини-игре: при равных очках выше игрок с меньшим id
+    score, player_id = player_minigame.score, player_minigame.player_id
+    if packed_progress():
+        return Player.objects.annotate(
+            score=packed_minigame_score(player_minigame.minigame_id)
+        ).filter(
+            Q(score__gte=score),
+            Q(score__gt=score) | Q(id__lt=player_id),
+        ).count() + 1
+
+    return PlayerMinigame.objects.filter(
+        Q(minigame_id=player_minigame.minigame_id),
+        Q(score__gte=score),
+        Q(score__gt=score) | Q(player_id__lt=player_id),
+    ).count() + 1
+
+
+def player_minigame_progress(minigame, player_id):
+    # Прогресс игрока в мини-игре или None, если игрока нет
+    if packed_progress():
+        player = Player.objects.with_progress().filter(pk=player_id).first()
+        if player is None:
+            return None
+        for row in player.playerminigame_set.all():
+            if row.minigame_id == minigame.id:
+                row.minigame = minigame
+                return row
+        return None
+
+    return PlayerMinigame.objects.select_related('player', 'minigame').filter(
+        minigame=minigame, player_id=player_id).first()
+
+
+def invalidate_minigame_leaderboards(minigame_ids=None):
+    # Кэш сбрасывается после фиксации транзакции, иначе параллельный
+    # запрос успел бы снова закэшировать результаты до изменения
+    if minigame_ids is None:
+        minigame_ids = [minigame_id for minigame_id, _ in catalog_items(Minigame)]
+    keys = [minigame_cache_key(minigame_id) for minigame_id in minigame_ids]
+    transaction.on_commit(lambda: cache.delete_many(keys))
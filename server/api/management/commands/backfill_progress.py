@@ -0,0 +1,39 @@
+from api.backfill import (
+    BACKFILL_CHUNK_SIZE,
+    BACKFILL_PAUSE,
+    pending_backfills,
+    run_backfill,
+)
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ('Create missing progress rows of existing players for new catalog rows '
+            '(resumes interrupted backfills)')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=BACKFILL_CHUNK_SIZE,
+            help='Player id range handled by one INSERT ... SELECT')
+        parser.add_argument(
+            '--pause', type=float, default=BACKFILL_PAUSE,
+            help='Seconds to sleep between chunks')
+
+    def handle(self, *args, **options):
+        def report(backfill, max_id):
+            rescan = ' (verification pass)' if backfill.rescan_at is not None else ''
+            self.stdout.write(
+                f'{backfill.catalog} {backfill.catalog_id}: players up to '
+                f'{backfill.last_player_id} of {max_id}{rescan}, '
+                f'{backfill.inserted} rows inserted')
+
+        backfills = list(pending_backfills())
+        for backfill in backfills:
+            backfill = run_backfill(
+                backfill.id, options['chunk_size'], options['pause'], report)
+            self.stdout.write(self.style.SUCCESS(
+                f'{backfill.catalog} {backfill.catalog_id}: done, '
+                f'{backfill.inserted} rows inserted'))
+
+        if not backfills:
+            self.stdout.write(self.style.SUCCESS('No pending progress backfills'))
@@ -0,0 +1,298 @@
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from api.leaderboard import behind, player_place, ranking
+from api.models import (
+    Equipment,
+    Harvest,
+    Minigame,
+    Player,
+    PlayerEquipment,
+    PlayerHarvest,
+    PlayerMinigame,
+)
+from api.payload import validate_update
+from api.progress import (
+    EQUIPMENT,
+    HARVEST,
+    MINIGAME,
+    patch_progress_lists,
+    write_progress,
+)
+from api.representation import leaderboard_data, player_values, players_data
+from api.serializers import LeaderboardPlayerSerializer, PlayerSerializer
+from api.shared_leaderboard import SharedLeaderboard, load_players
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from rest_framework.renderers import JSONRenderer
+
+SEED_BATCH_SIZE = 10000
+MAX_SCORE = 100000
+
+
+def measure(func, args_list):
+    # Время выполнения func для каждого набора аргументов, в миллисекундах
+    timings = []
+    for args in args_list:
+        started = time.perf_counter()
+        func(*args)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def legacy_progress_update(player, equipment_data, harvest_data, minigame_data):
+    # Прежняя запись прогресса: get_or_create и save на каждую строку
+    for item in equipment_data:
+        equipment, _ = PlayerEquipment.objects.get_or_create(
+            player=player, equipment_name=item['equipment_name'])
+        equipment.available = item['available']
+        equipment.save()
+    for item in harvest_data:
+        harvest, _ = PlayerHarvest.objects.get_or_create(
+            player=player, harvest_name=item['harvest_name'])
+        harvest.available = item['available']
+        harvest.harvest_amount = item['harvest_amount']
+        harvest.gen_modified = item['gen_modified']
+        harvest.save()
+    for item in minigame_data:
+        minigame, _ = PlayerMinigame.objects.get_or_create(
+            player=player, minigame_name=item['minigame_name'])
+        minigame.available = item['available']
+        minigame.complete = item['complete']
+        minigame.score = item['score']
+        minigame.achievement = item['achievement']
+        minigame.save()
+
+
+def bulk_progress_update(player, equipment_data, harvest_data, minigame_data):
+    with transaction.atomic():
+        write_progress(player, EQUIPMENT, equipment_data)
+        write_progress(player, HARVEST, harvest_data)
+        write_progress(player, MINIGAME, minigame_data)
+
+
+class Command(BaseCommand):
+    help = 'Run performance benchmarks on synthetic players (changes are rolled back)'
+
+    scenarios = ('ranking', 'pagination', 'shared_ranking', 'progress_update',
+                 'serialization', 'update_validation')
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=self.scenarios)
+        parser.add_argument(
+            '--sizes', nargs='+', type=int,
+            default=[10000, 100000, 1000000, 5000000],
+            help='Table sizes (number of players) to measure at')
+        parser.add_argument(
+            '--samples', type=int, default=200,
+            help='Number of measured calls per table size')
+        parser.add_argument(
+            '--page-size', type=int, default=100,
+            help='Page size for the pagination and serialization scenarios')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        with transaction.atomic():
+            getattr(self, f'bench_{options["scenario"]}')(options)
+            # Синтетические данные не должны оставаться в базе
+            transaction.set_rollback(True)
+
+    def seed_players(self, total):
+        # Досоздаёт игроков до общего количества total.
+        # bulk_create не вызывает сигналы, дочерние записи не создаются.
+        created = Player.objects.count()
+        while created < total:
+            batch = min(SEED_BATCH_SIZE, total - created)
+            Player.objects.bulk_create([
+                Player(name=f'bench_{created + i}',
+                       own_coins=score, top_score=score)
+                for i, score in enumerate(
+                    random.randint(0, MAX_SCORE) for _ in range(batch))
+            ], batch_size=SEED_BATCH_SIZE)
+            created += batch
+
+    def sample_players(self, count):
+        bounds = Player.objects.order_by('id').values_list('id', flat=True)
+        first, last = bounds.first(), bounds.last()
+        ids = random.sample(range(first, last + 1), min(count, last - first + 1))
+        return list(Player.objects.filter(id__in=ids).only('id', 'top_score'))
+
+    def report(self, label, timings):
+        timings = sorted(timings)
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        self.stdout.write(
+            f'{label:>30}: median {statistics.median(timings):8.3f} ms, '
+            f'p95 {p95:8.3f} ms, max {timings[-1]:8.3f} ms')
+
+    def bench_ranking(self, options):
+        for size in sorted(options['sizes']):
+            self.seed_players(size)
+            players = self.sample_players(options['samples'])
+            timings = measure(player_place, [(player,) for player in players])
+            self.report(f'player_place @ {size} players', timings)
+            # Запрос к базе проходит индекс выше игрока,
+            # поэтому время отдельно замеряется на разной глубине рейтинга
+            for depth in (0.01, 0.5, 0.9):
+                start = int(size * depth)
+                deep = list(ranking().only('id', 'top_score')[
+                    start:start + options['samples']])
+                self.report(f'place at {depth:.0%} @ {size}', measure(
+                    player_place, [(player,) for player in deep]))
+
+    def bench_pagination(self, options):
+        page_size = options['page_size']
+
+        def keyset_page(top_score, player_id):
+            return list(ranking().filter(
+                behind(top_score, player_id)).values_list('id', flat=True)[:page_size])
+
+        def offset_page(offset):
+            return list(ranking().values_list(
+                'id', flat=True)[offset:offset + page_size])
+
+        for size in sorted(options['sizes']):
+            self.seed_players(size)
+            first = ranking().only('id', 'top_score').first()
+            # Курсоры на глубине 90% рейтинга
+            depth = int(size * 0.9)
+            deep = ranking().only('id', 'top_score')[depth:depth + options['samples']]
+            cursors = [(player.top_score, player.id) for player in deep]
+
+            self.report(f'keyset first page @ {size}', measure(
+                keyset_page, [(first.top_score, first.id)] * options['samples']))
+            self.report(f'keyset page at 90% @ {size}', measure(keyset_page, cursors))
+            self.report(f'OFFSET page at 90% @ {size}', measure(
+                offset_page, [(depth,)] * min(options['samples'], 10)))
+
+    def bench_shared_ranking(self, options):
+        # Отдельный временный файл: синтетические данные не попадают
+        # в рабочий рейтинг в разделяемой памяти
+        shm = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        with tempfile.TemporaryDirectory(dir=shm) as directory:
+            engine = SharedLeaderboard(os.path.join(directory, 'leaderboard.bin'))
+            for size in sorted(options['sizes']):
+                self.seed_players(size)
+                started = time.perf_counter()
+                # Синтетические игроки не зафиксированы, поэтому рейтинг
+                # загружается в транзакции бенчмарка, а не load_from_db
+                with engine.locked(exclusive=True):
+                    load_players(engine)
+                self.stdout.write(
+                    f'load @ {size} players: {time.perf_counter() - started:.2f} s')
+
+                players = self.sample_players(options['samples'])
+                self.report(f'place @ {size} players', measure(
+                    engine.place, [(player.id,) for player in players]))
+                self.report(f'top 100 @ {size} players', measure(
+                    engine.top, [(100,)] * options['samples']))
+                self.report(f'set_score @ {size} players', measure(
+                    engine.set_score,
+                    [(player.id, random.randint(0, MAX_SCORE)) for player in players]))
+
+    def progress_payload(self, changed):
+        # Полное состояние прогресса, в котором изменено примерно changed полей
+        def flag():
+            return random.random() < changed
+        return (
+            [{'equipment_name': name, 'available': flag()}
+             for name in Equipment.objects.values_list('name', flat=True)],
+            [{'harvest_name': name, 'harvest_amount': 0, 'available': flag(),
+              'gen_modified': False}
+             for name in Harvest.objects.values_list('name', flat=True)],
+            [{'minigame_name': name, 'available': flag(), 'complete': False,
+              'score': 0, 'achievement': False}
+             for name in Minigame.objects.values_list('name', flat=True)],
+        )
+
+    def bench_progress_update(self, options):
+        # Игроки создаются через save(): сигналы заводят строки прогресса
+        players = [Player.objects.create(name=f'bench_{index}')
+                   for index in range(options['samples'])]
+
+        for changed in (0.0, 0.3, 1.0):
+            for label, func in (('legacy', legacy_progress_update),
+                                ('bulk', bulk_progress_update)):
+                # Каждый вариант стартует с исходного состояния прогресса
+                PlayerEquipment.objects.update(available=False)
+                PlayerHarvest.objects.update(available=False)
+                PlayerMinigame.objects.update(available=False)
+                payloads = [(player, *self.progress_payload(changed))
+                            for player in players]
+                queries = []
+                with connection.execute_wrapper(
+                        lambda execute, *args: queries.append(1) or execute(*args)):
+                    timings = measure(func, payloads)
+                self.report(f'{label} ({changed:.0%} changed)', timings)
+                self.stdout.write(
+                    f'{"":>30}  {len(queries) / len(payloads):.1f} queries per update')
+
+    def bench_serialization(self, options):
+        # Страница игроков с прогрессом: сигналы заводят строки прогресса
+        players = [Player.objects.create(name=f'bench_{index}',
+                                         own_coins=random.randint(0, MAX_SCORE))
+                   for index in range(options['page_size'])]
+        ids = [player.id for player in players]
+        renderer = JSONRenderer()
+
+        def players_page():
+            return Player.objects.filter(id__in=ids).order_by('id')
+
+        def leaderboard_page():
+            return Player.objects.for_leaderboard().filter(id__in=ids).order_by('id')
+
+        variants = (
+            ('player serializer', lambda: renderer.render(
+                PlayerSerializer(players_page().with_progress(), many=True).data)),
+            ('player values', lambda: renderer.render(
+                players_data(player_values(players_page())))),
+            ('leaderboard serializer', lambda: renderer.render(
+                LeaderboardPlayerSerializer(leaderboard_page(), many=True).data)),
+            ('leaderboard values', lambda: renderer.render(
+                leaderboard_data(leaderboard_page()))),
+        )
+
+        # Быстрый путь должен отдавать те же байты, что и сериализаторы
+        rendered = [func() for _, func in variants]
+        if rendered[0] != rendered[1] or rendered[2] != rendered[3]:
+            raise CommandError(
+                'Fast serialization output differs from serializer output')
+
+        for label, func in variants:
+            timings = measure(func, [()] * options['samples'])
+            self.report(f'{label} ({len(ids)} players)', timings)
+            self.stdout.write(
+                f'{"":>30}  '
+                f'{statistics.median(timings) * 1000 / len(ids):.1f} us per player')
+
+    def bench_update_validation(self, options):
+        # Проверка полного тела PATCH без записи: сериализатор и быстрый путь
+        player = Player.objects.create(name='bench_update')
+        equipment, harvest, minigame = self.progress_payload(0.5)
+
+        def section(rows, name_field):
+            return {row[name_field]: {field: value for field, value in row.items()
+                                      if field != name_field} for row in rows}
+
+        payload = {
+            'own_coins': 150, 'own_money': 1500, 'credit': 30000, 'user_review': 4,
+            'equipment': section(equipment, 'equipment_name'),
+            'harvest': section(harvest, 'harvest_name'),
+            'minigame': section(minigame, 'minigame_name'),
+        }
+
+        def serializer_validation():
+            serializer = PlayerSerializer(
+                player, data=patch_progress_lists(dict(payload)), partial=True)
+            serializer.is_valid(raise_exception=True)
+            return serializer.validated_data
+
+        def fast_validation():
+            return validate_update(player, payload)
+
+        for label, func in (('serializer', serializer_validation),
+                            ('compiled', fast_validation)):
+            self.report(f'{label} validation', measure(func, [()] * options['samples']))
@@ -1,61 +1,101 @@
+import hashlib
+import json
 from pathlib import Path
 
-from django.core.management.base import BaseCommand
-from api.models import Equipment, Harvest, Minigame
-import json
+from api.backfill import schedule_backfill
+from api.catalog import VERSION_PK, bump_catalog_version
+from api.models import MAX_MINIGAME_ID, CatalogVersion, Equipment, Harvest, Minigame
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 
 current_dir = Path(__file__).resolve().parent
 equipment_data_file = current_dir / 'data/equipment_data.json'
 harvest_data_file = current_dir / 'data/harvest_data.json'
 minigame_data_file = current_dir / 'data/minigame_data.json'
 
+# Справочник, файл и поля, которые обновляются у существующих записей.
+# Описания оборудования и урожая при повторной загрузке не перезаписываются.
+CATALOGS = (
+    (Equipment, equipment_data_file, ()),
+    (Harvest, harvest_data_file, ()),
+    (Minigame, minigame_data_file, ('description', 'achievement')),
+)
+
 
 class Command(BaseCommand):
     help = 'Load common data from JSON file'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Apply the data even if the files did not change since the last load')
+
     def handle(self, *args, **options):
+        contents = [path.read_bytes() for _, path, _ in CATALOGS]
+        digest = hashlib.sha256(b'\0'.join(contents)).hexdigest()
+
+        applied = CatalogVersion.objects.filter(pk=VERSION_PK).values_list(
+            'fixture_hash', flat=True).first()
+        if applied == digest and not options['force']:
+            self.stdout.write(self.style.SUCCESS(
+                'Common data unchanged, nothing to load'))
+            return
+
+        catalogs = [
+            (model, json.loads(content), update_fields)
+            for (model, _, update_fields), content in zip(CATALOGS, contents)
+        ]
+        minigames = next(data for model, data, _ in catalogs if model is Minigame)
+        if len(minigames) > MAX_MINIGAME_ID:
+            # Для достижения каждой игры нужен бит в Player.achievement_mask
+            raise CommandError(f'At most {MAX_MINIGAME_ID} minigames are supported')
+
+        with transaction.atomic():
+            for model, data, update_fields in catalogs:
+                self.load_catalog(model, data, update_fields)
+
+            # bulk_create не вызывает сигналы: версия справочников
+            # для кэшей процессов увеличивается здесь
+            bump_catalog_version()
+            CatalogVersion.objects.filter(pk=VERSION_PK).update(fixture_hash=digest)
+
+    def load_catalog(self, model, data, update_fields):
+        # Вставляются только новые названия, у существующих записей
+        # обновляются update_fields. Вставка с ON CONFLICT в PostgreSQL
+        # тратила бы значение последовательности на каждую существующую
+        # запись, а id справочников должны идти подряд: по ним
+        # адресуются упакованный прогресс и биты достижений.
+        fields = ('name', 'description', *update_fields)
+        existing = model.objects.in_bulk(field_name='name')
+        items = {item['name']: item for item in data}
+
+        model.objects.bulk_create([
+            model(**{field: item[field] for field in fields if field in item})
+            for name, item in items.items() if name not in existing
+        ])
+
+        changed = []
+        for name, row in existing.items():
+            item = items.get(name)
+            if item is None:
+                continue
+            values = {field: item[field] for field in update_fields if field in item}
+            if any(getattr(row, field) != value for field, value in values.items()):
+                for field, value in values.items():
+                    setattr(row, field, value)
+                changed.append(row)
+        if changed:
+            model.objects.bulk_update(changed, list(update_fields))
+
+        created = model.objects.filter(
+            name__in=list(items)).exclude(name__in=list(existing)).order_by('id')
+        for row in created:
+            # Строки прогресса существующих игроков досоздаёт backfill_progress:
+            # поток в процессе команды был бы прерван при её завершении
+            schedule_backfill(row, start=False)
+            self.stdout.write(self.style.SUCCESS(
+                f'Created {model._meta.object_name}: {row.name}'))
 
-        with open(equipment_data_file, 'r') as file:
-            data = json.load(file)
-
-        for item in data:
-            equipment, created = Equipment.objects.get_or_create(
-                name=item['name'],
-                defaults={'description': item['description']}
-            )
-
-            if created:
-                self.stdout.write(self.style.SUCCESS(f'Created Equipment: {equipment.name}'))
-            else:
-                self.stdout.write(self.style.SUCCESS(f'Equipment already exists: {equipment.name}'))
-
-        with open(harvest_data_file, 'r') as file:
-            data = json.load(file)
-
-        for item in data:
-            harvest, created = Harvest.objects.get_or_create(
-                name=item['name'],
-                defaults={'description': item['description']}
-            )
-
-            if created:
-                self.stdout.write(self.style.SUCCESS(f'Created Harvest: {harvest.name}'))
-            else:
-                self.stdout.write(self.style.SUCCESS(f'Harvest already exists: {harvest.name}'))
-
-        with open(minigame_data_file, 'r') as file:
-            data = json.load(file)
-
-        for item in data:
-            game, created = Minigame.objects.get_or_create(
-                name=item['name'],
-                defaults={'description': item['description'], 'achievement': item['achievement']}
-            )
-
-            if created:
-                self.stdout.write(self.style.SUCCESS(f'Created Game: {game.name}'))
-            else:
-                game.description = item['description']
-                game.achievement = item['achievement']
-                game.save()
-                self.stdout.write(self.style.SUCCESS(f'Updated Game: {game.name}'))
+        self.stdout.write(self.style.SUCCESS(
+            f'{model._meta.object_name}: {len(items)} items loaded, '
+            f'{len(created)} new, {len(changed)} updated'))
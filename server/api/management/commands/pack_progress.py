@@ -0,0 +1,62 @@
+from api.models import Player
+from api.progress import TABLES, pack_progress, unpack_progress
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+CHUNK_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = ('Move player progress between progress tables and packed Player.progress '
+            '(see PLAYER_PROGRESS_STORAGE)')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--unpack', action='store_true',
+            help='Recreate progress table rows from Player.progress')
+        parser.add_argument(
+            '--delete-rows', action='store_true',
+            help='Delete progress table rows after packing')
+
+    def handle(self, *args, **options):
+        migrate = self.unpack_chunk if options['unpack'] else self.pack_chunk
+        moved = 0
+        last_id = 0
+        while True:
+            ids = list(Player.objects.filter(id__gt=last_id).order_by('id').values_list(
+                'id', flat=True)[:CHUNK_SIZE])
+            if not ids:
+                break
+            with transaction.atomic():
+                migrate(ids, options)
+            moved += len(ids)
+            last_id = ids[-1]
+
+        direction = 'unpacked' if options['unpack'] else 'packed'
+        self.stdout.write(self.style.SUCCESS(
+            f'Progress {direction} for {moved} players'))
+
+    def pack_chunk(self, ids, options):
+        # Строки прогресса загружаются явно: with_progress в упакованном
+        # режиме читает уже документ
+        players = list(Player.objects.filter(id__in=ids).only(
+            'id', 'progress').prefetch_related(
+                *(table.related_name for table in TABLES)))
+        for player in players:
+            pack_progress(player)
+        Player.objects.bulk_update(players, ['progress'])
+
+        if options['delete_rows']:
+            for table in TABLES:
+                table.model.objects.filter(player_id__in=ids).delete()
+
+    def unpack_chunk(self, ids, options):
+        players = list(Player.objects.filter(id__in=ids).only('id', 'progress'))
+        for player in players:
+            unpack_progress(player)
+        for table in TABLES:
+            table.model.objects.filter(player_id__in=ids).delete()
+            table.model.objects.bulk_create([
+                row for player in players
+                for row in player._prefetched_objects_cache[table.related_name]
+            ])
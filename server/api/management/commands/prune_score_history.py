@@ -0,0 +1,10 @@
+from api.score_history import prune_score_history
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Delete score history buckets older than the retention period'
+
+    def handle(self, *args, **options):
+        deleted = prune_score_history()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} score history rows'))
@@ -0,0 +1,15 @@
+from api.leaderboard import rebuild_leaderboard, rebuild_shared_leaderboard
+from api.models import LeaderboardEntry
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Rebuild leaderboard snapshot from player scores'
+
+    def handle(self, *args, **options):
+        rebuild_leaderboard()
+        self.stdout.write(self.style.SUCCESS(
+            f'Leaderboard rebuilt: {LeaderboardEntry.objects.count()} entries'))
+
+        if rebuild_shared_leaderboard() is not None:
+            self.stdout.write(self.style.SUCCESS('Shared leaderboard reloaded'))
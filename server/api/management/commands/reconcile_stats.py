@@ -0,0 +1,33 @@
+from api.stats import player_totals, reconcile_totals, scan_totals
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Check player statistics counters against the player table and fix drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report drift, do not fix it')
+
+    def handle(self, *args, **options):
+        totals = player_totals()
+        actual = scan_totals()
+
+        drift = {
+            field: (getattr(totals, field), value)
+            for field, value in actual.items()
+            if getattr(totals, field) != value
+        }
+
+        if not drift:
+            self.stdout.write(self.style.SUCCESS('Player statistics are consistent'))
+            return
+
+        for field, (stored, value) in drift.items():
+            self.stdout.write(self.style.WARNING(
+                f'{field}: stored {stored}, actual {value}'))
+
+        if not options['dry_run']:
+            reconcile_totals()
+            self.stdout.write(self.style.SUCCESS('Player statistics fixed'))
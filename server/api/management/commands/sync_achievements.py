@@ -0,0 +1,47 @@
+from api.models import Player, PlayerMinigame, achievement_bit, packed_progress
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+CHUNK_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = 'Recalculate denormalized player achievements from minigame progress'
+
+    def handle(self, *args, **options):
+        updated = 0
+        last_id = 0
+        while True:
+            players = list(Player.objects.filter(id__gt=last_id).order_by('id').only(
+                'id', 'achievement_mask', 'achievement_count', 'progress')[:CHUNK_SIZE])
+            if not players:
+                break
+
+            masks = dict.fromkeys((player.id for player in players), 0)
+            if packed_progress():
+                # Маска достижений хранится в упакованном прогрессе как есть
+                for player in players:
+                    masks[player.id] = player.progress.get(
+                        'minigame', {}).get('achievement', 0)
+            else:
+                for player_id, minigame_id in PlayerMinigame.objects.filter(
+                        player_id__in=masks, achievement=True
+                ).values_list('player_id', 'minigame_id'):
+                    masks[player_id] |= achievement_bit(minigame_id)
+
+            changed = []
+            for player in players:
+                if player.achievement_mask != masks[player.id]:
+                    player.achievement_mask = masks[player.id]
+                    player.achievement_count = masks[player.id].bit_count()
+                    changed.append(player)
+
+            with transaction.atomic():
+                Player.objects.bulk_update(
+                    changed, ['achievement_mask', 'achievement_count'])
+
+            updated += len(changed)
+            last_id = players[-1].id
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Achievements updated for {updated} players'))
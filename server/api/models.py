@@ -1,4 +1,6 @@
+from django.conf import settings
 from django.db import models
+from django.db.models import DEFERRED
 from django.core.validators import MaxValueValidator, MinValueValidator
 
 
@@ -26,6 +28,18 @@ class Harvest(models.Model):
         verbose_name_plural = "Урожай"
 
 
+# Player.achievement_mask - знаковое 64-битное поле: биты 0-62
+# вмещают достижения мини-игр с id от 1 до 63
+MAX_MINIGAME_ID = 63
+
+
+def achievement_bit(minigame_id):
+    # Бит достижения мини-игры в Player.achievement_mask
+    if not 0 < minigame_id <= MAX_MINIGAME_ID:
+        raise ValueError(f'Minigame id {minigame_id} has no achievement bit')
+    return 1 << (minigame_id - 1)
+
+
 class Minigame(models.Model):
     name = models.CharField(max_length=50, blank=False, unique=True)
     description = models.TextField(blank=False)
@@ -34,9 +48,115 @@ class Minigame(models.Model):
     def __str__(self):
         return f'{self.name}'
 
+    @property
+    def achievement_bit(self):
+        return achievement_bit(self.id)
+
     class Meta:
         verbose_name = "Игра"
         verbose_name_plural = "Игры"
+        constraints = [
+            models.CheckConstraint(check=models.Q(id__lte=MAX_MINIGAME_ID),
+                                   name='minigame_achievement_bit'),
+        ]
+
+
+class CatalogVersion(models.Model):
+    # Версия справочников (одна строка, pk=1): растёт при любом изменении
+    # оборудования, урожая и мини-игр, процессы сверяют с ней свой кэш
+    version = models.PositiveIntegerField(default=0)
+    # Хеш файлов справочников, загруженных командой loaddata
+    fixture_hash = models.CharField(max_length=64, blank=True)
+
+    def __str__(self):
+        return f'{self.version}'
+
+    class Meta:
+        verbose_name = "Версия справочников"
+        verbose_name_plural = "Версия справочников"
+
+
+class ProgressBackfill(models.Model):
+    # Досоздание строк прогресса существующих игроков для новой записи
+    # справочника (api/backfill.py). last_player_id - игроки до него
+    # включительно уже обработаны, с него продолжается прерванный проход.
+    # rescan_at - время начала проверочного прохода после основного
+    catalog = models.CharField(max_length=20)
+    catalog_id = models.IntegerField()
+    last_player_id = models.BigIntegerField(default=0)
+    inserted = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    rescan_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.catalog} {self.catalog_id}: {self.last_player_id}'
+
+    class Meta:
+        verbose_name = "Досоздание прогресса"
+        verbose_name_plural = "Досоздание прогресса"
+
+
+def packed_progress():
+    return settings.PLAYER_PROGRESS_STORAGE == 'packed'
+
+
+class PlayerQuerySet(models.QuerySet):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._unpack_progress = False
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._unpack_progress = self._unpack_progress
+        return clone
+
+    def _fetch_all(self):
+        fetched = self._result_cache is None
+        super()._fetch_all()
+        if fetched and self._unpack_progress:
+            from .progress import unpack_progress
+            for player in self._result_cache:
+                if isinstance(player, Player):
+                    unpack_progress(player)
+
+    def with_progress(self, sections=('equipment', 'harvest', 'minigame')):
+        # sections - разделы прогресса, которые нужны в ответе
+        if packed_progress():
+            # Прогресс хранится в Player.progress и распаковывается
+            # в строки прогресса после загрузки игроков
+            clone = self._chain()
+            clone._unpack_progress = True
+            return clone
+
+        # Прогресс игроков загружается одним запросом на раздел для всего списка,
+        # только с колонками, которые выводит PlayerSerializer
+        prefetches = {
+            'equipment': models.Prefetch(
+                'playerequipment_set',
+                queryset=PlayerEquipment.objects.only(
+                    'id', 'player_id', 'equipment_name', 'available'
+                ).order_by('id')),
+            'harvest': models.Prefetch(
+                'playerharvest_set',
+                queryset=PlayerHarvest.objects.only(
+                    'id', 'player_id', 'harvest_name', 'harvest_amount',
+                    'available', 'gen_modified'
+                ).order_by('id')),
+            'minigame': models.Prefetch(
+                'playerminigame_set',
+                queryset=PlayerMinigame.objects.only(
+                    'id', 'player_id', 'minigame_id', 'minigame_name', 'available',
+                    'complete', 'score', 'achievement'
+                ).order_by('id')),
+        }
+        return self.prefetch_related(*(prefetches[section] for section in sections))
+
+    def for_leaderboard(self):
+        # Колонки, которые выводят таблицы лидеров
+        return self.only(
+            'id', 'name', 'own_coins', 'own_money', 'user_review',
+            'top_score', 'achievement_mask', 'achievement_count')
 
 
 class Player(models.Model):
@@ -52,7 +172,7 @@ class Player(models.Model):
     own_coins = models.IntegerField(default=0)
     credit = models.IntegerField(default=0)
     top_score = models.IntegerField(default=0)
-    
+
     user_review = models.IntegerField(
         null=True,
         blank=True,
@@ -60,16 +180,85 @@ class Player(models.Model):
         choices=[(1, '1'), (2, '2'), (3, '3'), (4, '4'), (5, '5')],
     )
 
+    # Копия достижений из PlayerMinigame для таблицы лидеров:
+    # бит (id мини-игры - 1) и количество полученных достижений
+    achievement_mask = models.BigIntegerField(default=0)
+    achievement_count = models.IntegerField(default=0)
+
+    # Версия состояния для синхронизации клиента: растёт при каждом изменении.
+    # change_versions - версия последнего изменения каждого поля и строки
+    # прогресса ("own_coins", "equipment.robot"), reset_version - версия
+    # последней перезаписи всего состояния (новая игра, правка в админке)
+    version = models.PositiveIntegerField(default=0)
+    reset_version = models.PositiveIntegerField(default=0)
+    change_versions = models.JSONField(default=dict, blank=True)
+
+    # Прогресс при PLAYER_PROGRESS_STORAGE = 'packed', формат описан в api/progress.py
+    progress = models.JSONField(default=dict, blank=True)
+
     equipment = models.ManyToManyField(Equipment, through='PlayerEquipment')
     harvest = models.ManyToManyField(Harvest, through='PlayerHarvest')
     minigame = models.ManyToManyField(Minigame, through='PlayerMinigame')
 
+    objects = PlayerQuerySet.as_manager()
+
     def __str__(self):
         return f'{self.name}'
 
+    def has_achievement(self, minigame_id):
+        return bool(self.achievement_mask & achievement_bit(minigame_id))
+
+    def set_achievement(self, minigame_id, achieved):
+        if achieved:
+            self.achievement_mask |= achievement_bit(minigame_id)
+        else:
+            self.achievement_mask &= ~achievement_bit(minigame_id)
+        self.achievement_count = self.achievement_mask.bit_count()
+
+    def mark_changed(self, keys):
+        # Новая версия состояния для изменённых полей и строк прогресса
+        if not keys:
+            return
+        self.version += 1
+        for key in keys:
+            self.change_versions[key] = self.version
+
+    def mark_reset(self):
+        # Состояние перезаписано целиком: клиентам с более старой версией
+        # отправляется всё состояние
+        self.version += 1
+        self.reset_version = self.version
+        self.change_versions = {}
+
+    def refresh_achievements(self):
+        # Пересчёт копии достижений по записям PlayerMinigame
+        if packed_progress():
+            # Биты достижений в упакованном прогрессе совпадают с achievement_mask
+            self.achievement_mask = self.progress.get('minigame', {}).get(
+                'achievement', 0)
+            self.achievement_count = self.achievement_mask.bit_count()
+            return
+
+        self.achievement_mask = 0
+        for minigame_id in self.playerminigame_set.filter(
+                achievement=True).values_list('minigame_id', flat=True):
+            self.achievement_mask |= achievement_bit(minigame_id)
+        self.achievement_count = self.achievement_mask.bit_count()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Оценка на момент загрузки нужна для инкрементального пересчёта статистики
+        instance._loaded_user_review = instance.__dict__.get('user_review', DEFERRED)
+        return instance
+
     class Meta:
         verbose_name = "Игрок"
         verbose_name_plural = "Игроки"
+        indexes = [
+            # Рейтинг: top_score по убыванию, при равенстве - по id
+            models.Index(fields=['-top_score', 'id'], name='player_rank_idx'),
+        ]
 
 
 class PlayerEquipment(models.Model):
@@ -82,6 +271,12 @@ class PlayerEquipment(models.Model):
         return (f'equipment_name: {self.equipment.name},'
                 f'available: {self.available}')
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['player', 'equipment'],
+                                    name='player_equipment_uniq'),
+        ]
+
 
 class PlayerHarvest(models.Model):
     player = models.ForeignKey(Player, on_delete=models.CASCADE)
@@ -97,6 +292,12 @@ class PlayerHarvest(models.Model):
                 f'available: {self.available},'
                 f'gen_modified: {self.gen_modified}')
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['player', 'harvest'],
+                                    name='player_harvest_uniq'),
+        ]
+
 
 class PlayerMinigame(models.Model):
     player = models.ForeignKey(Player, on_delete=models.CASCADE)
@@ -112,3 +313,105 @@ class PlayerMinigame(models.Model):
                 f'available: {self.available},'
                 f'complete: {self.complete},'
                 f'score: {self.score}')
+
+    class Meta:
+        indexes = [
+            # Рейтинг по мини-игре: score по убыванию, при равенстве - по игроку
+            models.Index(fields=['minigame', '-score', 'player'],
+                         name='minigame_score_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['player', 'minigame'],
+                                    name='player_minigame_uniq'),
+        ]
+
+
+class LeaderboardEntry(models.Model):
+    # Снимок таблицы лидеров: top_score лучших игроков,
+    # поддерживается инкрементально при изменении очков
+    player = models.OneToOneField(
+        Player, on_delete=models.CASCADE, primary_key=True)
+    top_score = models.IntegerField()
+
+    def __str__(self):
+        return f'{self.player_id}: {self.top_score}'
+
+    class Meta:
+        verbose_name = "Позиция в таблице лидеров"
+        verbose_name_plural = "Таблица лидеров"
+        indexes = [
+            models.Index(fields=['-top_score', 'player'],
+                         name='leaderboard_rank_idx'),
+        ]
+
+
+class PlayerTotals(models.Model):
+    # Агрегаты по всем игрокам в одной строке (pk=1),
+    # поддерживаются инкрементально при изменении игроков
+    total_players = models.IntegerField(default=0)
+    review_count = models.IntegerField(default=0)
+    review_sum = models.BigIntegerField(default=0)
+
+    @property
+    def average_review(self):
+        if not self.review_count:
+            return None
+        return self.review_sum / self.review_count
+
+    def __str__(self):
+        return (f'total_players: {self.total_players}, '
+                f'review_count: {self.review_count}, '
+                f'review_sum: {self.review_sum}')
+
+    class Meta:
+        verbose_name = "Статистика игроков"
+        verbose_name_plural = "Статистика игроков"
+
+
+class ScoreEvent(models.Model):
+    # Журнал прироста очков игрока: записи только добавляются,
+    # старые дни удаляются целиком
+    player = models.ForeignKey(Player, on_delete=models.CASCADE)
+    day = models.DateField()
+    coins = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.player_id}: +{self.coins} ({self.day})'
+
+    class Meta:
+        verbose_name = "Прирост очков"
+        verbose_name_plural = "Прирост очков"
+        indexes = [
+            models.Index(fields=['day'], name='score_event_day_idx'),
+        ]
+
+
+class ScoreRollup(models.Model):
+    # Сумма прироста очков игрока за день или неделю
+    DAY = 'day'
+    WEEK = 'week'
+    periods = (
+        (DAY, 'День'),
+        (WEEK, 'Неделя'),
+    )
+
+    player = models.ForeignKey(Player, on_delete=models.CASCADE)
+    period = models.CharField(max_length=4, choices=periods)
+    bucket = models.DateField()
+    score = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.player_id}: {self.score} ({self.period} {self.bucket})'
+
+    class Meta:
+        verbose_name = "Очки за период"
+        verbose_name_plural = "Очки за период"
+        constraints = [
+            models.UniqueConstraint(fields=['period', 'bucket', 'player'],
+                                    name='score_rollup_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['period', 'bucket', '-score', 'player'],
+                         name='score_rollup_rank_idx'),
+        ]
@@ -0,0 +1,134 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from .leaderboard import behind
+
+
+class KeysetCursorPagination(BasePagination):
+    # Постраничный обход по ключу без OFFSET: каждая страница -
+    # диапазонный запрос по индексу от позиции курсора, поэтому
+    # глубокие страницы стоят столько же, сколько первая.
+    # Курсор - целые числа через точку в base64.
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+    page_size = 100
+    max_page_size = 500
+    invalid_cursor_message = 'Некорректный курсор'
+    cursor_parts = 1
+    next_example = None
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            decoded = urlsafe_b64decode(encoded.encode('ascii'))
+            parts = tuple(int(part) for part in decoded.split(b'.'))
+        except (BinasciiError, UnicodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if len(parts) != self.cursor_parts:
+            raise NotFound(self.invalid_cursor_message)
+        return parts
+
+    def encode_cursor(self, *parts):
+        return urlsafe_b64encode(
+            '.'.join(str(part) for part in parts).encode('ascii')).decode('ascii')
+
+    def fetch_page(self, queryset, request):
+        # Лишняя строка показывает, есть ли следующая страница
+        self.request = request
+        page = list(queryset[:self.page_size + 1])
+        self.has_next = len(page) > self.page_size
+        self.page = page[:self.page_size]
+        return self.page
+
+    def cursor_link(self, *parts):
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.cursor_query_param,
+            self.encode_cursor(*parts))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {
+                    'type': 'string',
+                    'nullable': True,
+                    'format': 'uri',
+                    'example': self.next_example,
+                },
+                'results': schema,
+            },
+        }
+
+
+class LeaderboardCursorPagination(KeysetCursorPagination):
+    # Обход рейтинга по ключу (top_score, id).
+    # Курсор хранит последнюю строку страницы и её место в рейтинге.
+    cursor_parts = 3
+    next_example = 'http://localhost:8000/api/v1/liderboard/all/?cursor=ODAwLjEuMQ%3D%3D'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+
+        cursor = self.decode_cursor(request)
+        if cursor is None:
+            self.start_place = 1
+        else:
+            top_score, player_id, place = cursor
+            queryset = queryset.filter(behind(top_score, player_id))
+            self.start_place = place + 1
+
+        return self.fetch_page(queryset, request)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        return self.cursor_link(
+            last.top_score, last.id, self.start_place + len(self.page) - 1)
+
+    def get_paginated_response(self, data):
+        for place, item in enumerate(data, start=self.start_place):
+            item['place'] = place
+        return super().get_paginated_response(data)
+
+
+class PlayerCursorPagination(KeysetCursorPagination):
+    # Обход игроков по id, курсор - id последнего игрока страницы
+    next_example = 'http://localhost:8000/api/v1/player/?cursor=MTAw'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+
+        cursor = self.decode_cursor(request)
+        queryset = queryset.order_by('id')
+        if cursor is not None:
+            queryset = queryset.filter(id__gt=cursor[0])
+
+        return self.fetch_page(queryset, request)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        # Страница - игроки или строки .values() быстрого пути
+        last = self.page[-1]
+        return self.cursor_link(last['id'] if isinstance(last, dict) else last.id)
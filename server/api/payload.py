@@ -0,0 +1,129 @@
+from rest_framework.exceptions import ValidationError
+from rest_framework.settings import api_settings
+from rest_framework.validators import UniqueValidator
+
+from .catalog import catalog_index
+from .progress import TABLES, check_progress_sections
+from .serializers import PlayerSerializer
+
+# Быстрая проверка тела PUT/PATCH игрока без сериализаторов DRF.
+#
+# Проверки полей собираются один раз из полей PlayerSerializer и вложенных
+# сериализаторов прогресса, поэтому приведение типов и тексты ошибок
+# те же, что у сериализатора. Тело запроса проверяется и приводится
+# к виду для update_player за один проход, разделы прогресса - без
+# промежуточных списков строк. Ошибки в разделах прогресса
+# возвращаются по названиям: {"minigame": {"gameOne": {"score": [...]}}}.
+
+_schema = None
+
+
+class UpdateSchema:
+    def __init__(self, serializer):
+        fields = {name: field for name, field in serializer.fields.items()
+                  if not field.read_only}
+        sections = {table.catalog_field: table for table in TABLES}
+
+        # Уникальность имени проверяется запросом с исключением самого игрока
+        name = fields['name']
+        self.required_message = name.error_messages['required']
+        self.unique = [validator for validator in name.validators
+                       if isinstance(validator, UniqueValidator)]
+        name.validators = [validator for validator in name.validators
+                           if validator not in self.unique]
+
+        self.fields = {field_name: field.run_validation
+                       for field_name, field in fields.items()
+                       if field_name not in sections}
+
+        # Раздел прогресса: (таблица, проверка названия, проверки полей,
+        # значения по умолчанию)
+        self.sections = {}
+        for section, table in sections.items():
+            item_fields = fields[section].child.fields
+            self.sections[section] = (
+                table,
+                item_fields[table.name_field].run_validation,
+                {field: item_fields[field].run_validation for field in table.fields},
+                {field: table.model._meta.get_field(field).default
+                 for field in table.fields},
+            )
+
+    def validate(self, player, data, partial=True):
+        if not isinstance(data, dict):
+            raise ValidationError({api_settings.NON_FIELD_ERRORS_KEY: [
+                'Invalid data. Expected a dictionary, '
+                f'but got {type(data).__name__}.']})
+        check_progress_sections(data)
+
+        values = {}
+        errors = {}
+        if not partial and 'name' not in data:
+            errors['name'] = [self.required_message]
+
+        for key, value in data.items():
+            check = self.fields.get(key)
+            if check is not None:
+                try:
+                    values[key] = check(value)
+                except ValidationError as error:
+                    errors[key] = error.detail
+                continue
+
+            section = self.sections.get(key)
+            if section is None:
+                continue
+            rows, section_errors = self.validate_section(section, value)
+            values[key] = rows
+            if section_errors:
+                errors[key] = section_errors
+
+        if 'name' in values and self.unique:
+            unique = self.unique[0]
+            taken = unique.queryset.filter(name=values['name']).exclude(pk=player.pk)
+            if taken.exists():
+                errors['name'] = [unique.message]
+
+        if errors:
+            raise ValidationError(errors)
+        return values
+
+    def validate_section(self, section, items):
+        # Строки без available пропускаются, как и в patch_progress_lists
+        table, check_name, checks, defaults = section
+        catalog_ids = catalog_index(table.catalog)
+        rows = []
+        errors = {}
+        for name, item in items.items():
+            if 'available' not in item:
+                continue
+            row = {}
+            row_errors = {}
+            try:
+                row[table.name_field] = check_name(name)
+            except ValidationError as error:
+                row_errors[table.name_field] = error.detail
+            else:
+                # Неизвестное название отклоняется до записи
+                if row[table.name_field] not in catalog_ids:
+                    row_errors[table.name_field] = [f'Неизвестное название: {name}']
+            for field, check in checks.items():
+                if field not in item:
+                    row[field] = defaults[field]
+                    continue
+                try:
+                    row[field] = check(item[field])
+                except ValidationError as error:
+                    row_errors[field] = error.detail
+            if row_errors:
+                errors[name] = row_errors
+            rows.append(row)
+        return rows, errors
+
+
+def validate_update(player, data, partial=True):
+    # Проверенные значения для update_player или ValidationError
+    global _schema
+    if _schema is None:
+        _schema = UpdateSchema(PlayerSerializer())
+    return _schema.validate(player, data, partial)
@@ -0,0 +1,346 @@
+from django.db import transaction
+from django.db.models import F
+from rest_framework.exceptions import ValidationError
+
+from .catalog import catalog_index, catalog_items
+from .models import (
+    Equipment,
+    Harvest,
+    Minigame,
+    Player,
+    PlayerEquipment,
+    PlayerHarvest,
+    PlayerMinigame,
+    packed_progress,
+)
+
+
+class ProgressTable:
+    # Описание таблицы прогресса игрока: модель, справочник,
+    # поле с названием из справочника и изменяемые поля
+    def __init__(self, model, catalog, catalog_field, name_field, fields):
+        self.model = model
+        self.catalog = catalog
+        self.catalog_field = catalog_field
+        self.name_field = name_field
+        self.fields = fields
+        self.related_name = f'{model._meta.model_name}_set'
+        self.flags = tuple(
+            field for field in fields
+            if model._meta.get_field(field).get_internal_type() == 'BooleanField')
+
+
+EQUIPMENT = ProgressTable(
+    PlayerEquipment, Equipment, 'equipment', 'equipment_name',
+    ('available',))
+HARVEST = ProgressTable(
+    PlayerHarvest, Harvest, 'harvest', 'harvest_name',
+    ('harvest_amount', 'available', 'gen_modified'))
+MINIGAME = ProgressTable(
+    PlayerMinigame, Minigame, 'minigame', 'minigame_name',
+    ('available', 'complete', 'score', 'achievement'))
+TABLES = (EQUIPMENT, HARVEST, MINIGAME)
+
+# Значения прогресса после начала новой игры
+RESET_VALUES = (
+    (EQUIPMENT, {'available': False}),
+    (HARVEST, {'available': False, 'gen_modified': False}),
+    (MINIGAME, {'available': False, 'complete': False, 'achievement': False,
+                'score': 0}),
+)
+PLAYER_RESET_FIELDS = ('own_money', 'own_coins', 'credit')
+
+RESET_CHUNK_SIZE = 1000
+
+# Упакованное хранение прогресса (PLAYER_PROGRESS_STORAGE = 'packed').
+# Весь прогресс игрока - документ Player.progress:
+#   {"equipment": {"available": 5},
+#    "harvest": {"available": 1, "gen_modified": 0, "harvest_amount": [0, 4]},
+#    "minigame": {"available": 3, "complete": 1, "achievement": 1, "score": [30]}}
+# Логическое поле - битовая маска, бит (id записи справочника - 1),
+# числовое поле - массив по тому же индексу, недостающие элементы равны 0.
+# Названия берутся из справочника, строки прогресса для сериализатора
+# и write_progress восстанавливаются из документа в памяти.
+
+
+def unpack_section(progress, table):
+    # Значения строк прогресса из документа: [(id записи справочника, название, поля)]
+    section = progress.get(table.catalog_field, {})
+    rows = []
+    for catalog_id, name in catalog_items(table.catalog):
+        index = catalog_id - 1
+        values = {}
+        for field in table.fields:
+            stored = section.get(field)
+            if field in table.flags:
+                values[field] = bool((stored or 0) >> index & 1)
+            else:
+                values[field] = stored[index] if stored and index < len(stored) else 0
+        rows.append((catalog_id, name, values))
+    return rows
+
+
+def unpack_rows(player, table):
+    return [
+        table.model(player=player, **values, **{
+            f'{table.catalog_field}_id': catalog_id,
+            table.name_field: name,
+        })
+        for catalog_id, name, values in unpack_section(player.progress, table)
+    ]
+
+
+def pack_rows(table, rows):
+    section = {field: 0 for field in table.flags}
+    for row in rows:
+        index = getattr(row, f'{table.catalog_field}_id') - 1
+        for field in table.fields:
+            value = getattr(row, field)
+            if field in table.flags:
+                section[field] |= int(bool(value)) << index
+            elif value:
+                values = section.setdefault(field, [])
+                values.extend([0] * (index + 1 - len(values)))
+                values[index] = value
+    return section
+
+
+def unpack_progress(player):
+    # Строки прогресса из документа подставляются как загруженные
+    # вместе с игроком, их читают PlayerSerializer и write_progress
+    if not hasattr(player, '_prefetched_objects_cache'):
+        player._prefetched_objects_cache = {}
+    for table in TABLES:
+        player._prefetched_objects_cache[table.related_name] = unpack_rows(
+            player, table)
+
+
+def pack_progress(player):
+    player.progress = {
+        table.catalog_field: pack_rows(
+            table, player._prefetched_objects_cache[table.related_name])
+        for table in TABLES
+    }
+
+
+def write_progress(player, table, items):
+    # Запись прогресса игрока набором запросов вместо запроса на каждую строку:
+    # одно чтение текущих строк, bulk_update изменённых, bulk_create новых.
+    # Неизменённые строки не записываются. При упакованном хранении
+    # меняется документ Player.progress, его сохраняет вызывающий код.
+    # Возвращает список (строка, прежние значения или None для новой строки).
+    if packed_progress() and table.related_name not in getattr(
+            player, '_prefetched_objects_cache', {}):
+        unpack_progress(player)
+    # Названия переводятся в id по индексу справочника до любых запросов,
+    # неизвестное название отклоняется без записи
+    catalog_ids = catalog_index(table.catalog)
+    unknown = [item[table.name_field] for item in items
+               if item[table.name_field] not in catalog_ids]
+    if unknown:
+        raise ValidationError(
+            {table.catalog_field: [f'Неизвестное название: {name}'
+                                   for name in unknown]})
+
+    prefetched = getattr(player, '_prefetched_objects_cache', {})
+    if table.related_name in prefetched:
+        # Строки уже загружены вместе с игроком, изменения видны в ответе
+        current = prefetched[table.related_name]
+    else:
+        current = table.model.objects.filter(player=player)
+    # Строки сопоставляются по (игрок, запись справочника)
+    id_field = f'{table.catalog_field}_id'
+    rows = {getattr(row, id_field): row for row in current}
+
+    changes = {}
+    created = []
+    changed_fields = set()
+    for item in items:
+        name = item[table.name_field]
+        catalog_id = catalog_ids[name]
+        row = rows.get(catalog_id)
+        if row is None:
+            row = table.model(
+                player=player, **{id_field: catalog_id, table.name_field: name})
+            rows[catalog_id] = row
+            created.append(row)
+            changes[catalog_id] = (row, None)
+
+        before = {field: getattr(row, field) for field in table.fields}
+        for field in table.fields:
+            if field in item:
+                setattr(row, field, item[field])
+
+        modified = {field for field, value in before.items()
+                    if getattr(row, field) != value}
+        if modified and catalog_id not in changes:
+            changes[catalog_id] = (row, before)
+        changed_fields |= modified
+
+    if packed_progress():
+        if changes:
+            player.progress[table.catalog_field] = pack_rows(table, rows.values())
+            prefetched[table.related_name] = list(rows.values())
+        return list(changes.values())
+
+    if created:
+        table.model.objects.bulk_create(created)
+        prefetched.pop(table.related_name, None)
+
+    # В UPDATE попадают только поля, которые действительно изменились
+    updated = [row for row, before in changes.values() if before is not None]
+    if updated:
+        table.model.objects.bulk_update(
+            updated, [field for field in table.fields if field in changed_fields])
+
+    return list(changes.values())
+
+
+def patch_progress_lists(data):
+    # Разделы прогресса из запроса PUT/PATCH приходят словарями
+    # {название: поля}, сериализатор принимает списки строк.
+    # Неуказанные поля строки принимают значения по умолчанию.
+    check_progress_sections(data)
+
+    # Преобразование equipment из словаря в список только если есть данные
+    equipment_data = data.get('equipment')
+    if equipment_data is not None:
+        equipment_data = [
+            {
+                'equipment_name': equipment_name,
+                'available': equipment_info['available']
+            }
+            for equipment_name, equipment_info in equipment_data.items()
+            if 'available' in equipment_info
+        ]
+        data['equipment'] = equipment_data
+
+    # Преобразование harvest из словаря в список только если есть данные
+    harvest_data = data.get('harvest')
+    if harvest_data is not None:
+        harvest_data = [
+            {
+                'harvest_name': harvest_name,
+                'harvest_amount': harvest_info.get('harvest_amount', 0),
+                'available': harvest_info['available'],
+                'gen_modified': harvest_info.get('gen_modified', False)
+            }
+            for harvest_name, harvest_info in harvest_data.items()
+            if 'available' in harvest_info
+        ]
+        data['harvest'] = harvest_data
+
+    # Преобразование minigame из словаря в список только если есть данные
+    minigame_data = data.get('minigame')
+    if minigame_data is not None:
+        minigame_data = [
+            {
+                'minigame_name': minigame_name,
+                'available': minigame_info['available'],
+                'complete': minigame_info.get('complete', False),
+                'score': minigame_info.get('score', 0),
+                'achievement': minigame_info.get('achievement', False)
+            }
+            for minigame_name, minigame_info in minigame_data.items()
+            if 'available' in minigame_info
+        ]
+        data['minigame'] = minigame_data
+
+    return data
+
+
+def check_progress_sections(data):
+    # Разделы прогресса в запросе: {название: {поле: значение}}
+    for table in TABLES:
+        section = data.get(table.catalog_field)
+        if section is None:
+            continue
+        if not isinstance(section, dict) or not all(
+                isinstance(fields, dict) for fields in section.values()):
+            raise ValidationError(
+                {table.catalog_field: [
+                    'Ожидается словарь {название: {поле: значение}}']})
+
+
+def create_progress(player):
+    # Строки прогресса нового игрока: по одному bulk_create на таблицу,
+    # записи справочников берутся из кэша.
+    # Упакованный прогресс нового игрока - пустой документ.
+    if packed_progress():
+        unpack_progress(player)
+        return
+
+    for table in TABLES:
+        table.model.objects.bulk_create([
+            table.model(player=player, available=False, **{
+                f'{table.catalog_field}_id': catalog_id,
+                table.name_field: name,
+            })
+            for catalog_id, name in catalog_items(table.catalog)
+        ])
+
+
+def player_reset_values():
+    values = {name: Player._meta.get_field(name).get_default()
+              for name in PLAYER_RESET_FIELDS}
+    values.update(achievement_mask=0, achievement_count=0)
+    return values
+
+
+def reset_document(progress):
+    # Сброс упакованного прогресса: маски обнуляются, массивы очищаются
+    for table, values in RESET_VALUES:
+        section = progress.setdefault(table.catalog_field, {})
+        for field in values:
+            section[field] = 0 if field in table.flags else []
+    return progress
+
+
+def reset_player(player):
+    # Сброс прогресса одним UPDATE на таблицу. Загруженные вместе
+    # с игроком строки меняются в памяти, чтобы ответ не читал их заново.
+    packed = packed_progress()
+    if packed and not hasattr(player, '_prefetched_objects_cache'):
+        unpack_progress(player)
+    prefetched = getattr(player, '_prefetched_objects_cache', {})
+    with transaction.atomic():
+        for table, values in RESET_VALUES:
+            if not packed:
+                table.model.objects.filter(player=player).update(**values)
+            for row in prefetched.get(table.related_name, ()):
+                for field, value in values.items():
+                    setattr(row, field, value)
+        if packed:
+            reset_document(player.progress)
+
+        for field, value in player_reset_values().items():
+            setattr(player, field, value)
+        player.mark_reset()
+        player.save()
+
+
+def reset_players(queryset, chunk_size=RESET_CHUNK_SIZE):
+    # Массовый сброс: игроки обрабатываются пачками по id,
+    # каждая пачка - отдельная транзакция из UPDATE по всем таблицам.
+    # Рекорд и отзыв не меняются, поэтому сигналы сохранения не нужны.
+    ids = queryset.order_by('id').values_list('id', flat=True)
+    last_id, total = 0, 0
+    while True:
+        chunk = list(ids.filter(id__gt=last_id)[:chunk_size])
+        if not chunk:
+            return total
+        with transaction.atomic():
+            if packed_progress():
+                players = list(
+                    Player.objects.filter(id__in=chunk).only('id', 'progress'))
+                for player in players:
+                    reset_document(player.progress)
+                Player.objects.bulk_update(players, ['progress'])
+            else:
+                for table, values in RESET_VALUES:
+                    table.model.objects.filter(player_id__in=chunk).update(**values)
+            Player.objects.filter(id__in=chunk).update(
+                version=F('version') + 1, reset_version=F('version') + 1,
+                change_versions={}, **player_reset_values())
+        last_id = chunk[-1]
+        total += len(chunk)
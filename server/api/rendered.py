@@ -0,0 +1,91 @@
+import gzip
+import hashlib
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+from rest_framework.renderers import JSONRenderer
+
+from .catalog import catalog_snapshot
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Готовые ответы списков справочников.
+#
+# Тело списка рендерится один раз на версию справочников и хранится
+# в снимке кэша (api/catalog.py) несжатым, в gzip и, если установлен
+# пакет brotli, в br. У каждого варианта свой сильный ETag
+# "<хеш>", "<хеш>-gzip", "<хеш>-br". Запрос с If-None-Match,
+# совпадающим с любым из них, получает 304 без чтения справочников
+# и без сериализатора. Cache-Control разрешает клиентам не перепроверять
+# ответ CATALOG_VERSION_CHECK_INTERVAL секунд - столько же может
+# устаревать кэш справочников в самом процессе.
+
+
+class RenderedBody:
+    def __init__(self, raw):
+        self.tag = hashlib.sha256(raw).hexdigest()[:32]
+        self.encodings = {
+            'identity': raw,
+            'gzip': gzip.compress(raw, compresslevel=9, mtime=0),
+        }
+        if brotli is not None:
+            self.encodings['br'] = brotli.compress(raw)
+
+    def etag(self, encoding):
+        if encoding == 'identity':
+            return f'"{self.tag}"'
+        return f'"{self.tag}-{encoding}"'
+
+
+def catalog_body(model, serializer_class):
+    # Тело списка справочника для текущего снимка
+    snapshot = catalog_snapshot()
+    body = snapshot.rendered.get(model)
+    if body is None:
+        rows = tuple(snapshot.rows[model].values())
+        body = snapshot.rendered[model] = RenderedBody(
+            JSONRenderer().render(serializer_class(rows, many=True).data))
+    return body
+
+
+def accepted_encodings(header):
+    # Кодировки из Accept-Encoding, кроме явно запрещённых (q=0)
+    encodings = set()
+    for item in header.split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = params.strip().removeprefix('q=')
+        try:
+            if params and float(quality) == 0:
+                continue
+        except ValueError:
+            continue
+        encodings.add(coding.strip().lower())
+    return encodings
+
+
+def rendered_response(request, body):
+    accepted = accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    encoding = next((coding for coding in ('br', 'gzip')
+                     if coding in body.encodings and coding in accepted), 'identity')
+
+    # If-None-Match сравнивается по хешу тела, без учёта кодировки
+    tags = {tag.removeprefix('W/').strip('"').split('-', 1)[0]
+            for tag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))}
+    if body.tag in tags or '*' in tags:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(
+            body.encodings[encoding], content_type='application/json')
+        if encoding != 'identity':
+            response['Content-Encoding'] = encoding
+
+    response['ETag'] = body.etag(encoding)
+    max_age = int(settings.CATALOG_VERSION_CHECK_INTERVAL)
+    response['Cache-Control'] = f'public, max-age={max_age}'
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
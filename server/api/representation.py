@@ -0,0 +1,116 @@
+from .catalog import catalog_items
+from .models import Minigame, packed_progress
+from .progress import TABLES, unpack_section
+from .serializers import PLAYER_NESTED_FIELDS, PlayerSerializer
+
+# Быстрое чтение игроков для JSON-ответов: словари ответа собираются
+# из строк .values() без полей и вложенных сериализаторов DRF.
+# Результат совпадает с PlayerSerializer и LeaderboardPlayerSerializer
+# байт в байт, включая порядок ключей. Страницы browsable API
+# по-прежнему строятся сериализаторами.
+
+PLAYER_FIELDS = PlayerSerializer.Meta.fields
+
+# Поля строк прогресса в порядке PlayerSerializer.to_representation
+SECTION_FIELDS = {
+    'equipment': ('available',),
+    'harvest': ('harvest_amount', 'available', 'gen_modified'),
+    'minigame': ('available', 'complete', 'score', 'achievement'),
+}
+
+
+def player_fields(fields=None):
+    # Поля ответа в порядке PlayerSerializer.Meta.fields
+    if fields is None:
+        return PLAYER_FIELDS
+    return tuple(name for name in PLAYER_FIELDS if name in fields)
+
+
+def player_values(queryset, fields=None):
+    # Строки игроков с колонками, нужными для ответа
+    fields = player_fields(fields)
+    columns = ['id', *(name for name in fields
+                       if name not in PLAYER_NESTED_FIELDS and name != 'id')]
+    if packed_progress() and any(name in PLAYER_NESTED_FIELDS for name in fields):
+        columns.append('progress')
+    return queryset.values(*columns)
+
+
+def progress_sections(rows, sections):
+    # {раздел: {id игрока: {название: поля}}} одним запросом на раздел
+    result = {}
+    packed = packed_progress()
+    for table in TABLES:
+        section = table.catalog_field
+        if section not in sections:
+            continue
+        output = SECTION_FIELDS[section]
+        players = result[section] = {row['id']: {} for row in rows}
+
+        if packed:
+            for row in rows:
+                items = players[row['id']]
+                for _, name, values in unpack_section(row['progress'], table):
+                    items[name] = {field: values[field] for field in output}
+            continue
+
+        for player_id, name, *values in table.model.objects.filter(
+                player_id__in=players
+        ).order_by('id').values_list('player_id', table.name_field, *output):
+            players[player_id][name] = dict(zip(output, values))
+    return result
+
+
+def players_data(rows, fields=None):
+    # Ответы для строк из player_values() в том же порядке
+    rows = list(rows)
+    fields = player_fields(fields)
+    sections = progress_sections(
+        rows, [name for name in fields if name in PLAYER_NESTED_FIELDS])
+
+    data = []
+    for row in rows:
+        item = {}
+        for name in fields:
+            if name in sections:
+                item[name] = sections[name][row['id']]
+            else:
+                item[name] = row[name]
+        data.append(item)
+    return data
+
+
+def player_data(player):
+    # Ответ PlayerSerializer для загруженного игрока, прогресс -
+    # из предзагруженных строк (with_progress)
+    item = {}
+    for name in PLAYER_FIELDS:
+        if name not in PLAYER_NESTED_FIELDS:
+            item[name] = getattr(player, name)
+    for table in TABLES:
+        output = SECTION_FIELDS[table.catalog_field]
+        item[table.catalog_field] = {
+            getattr(row, table.name_field): {
+                field: getattr(row, field) for field in output}
+            for row in getattr(player, table.related_name).all()
+        }
+    return {name: item[name] for name in PLAYER_FIELDS}
+
+
+def leaderboard_data(players):
+    # Ответ LeaderboardPlayerSerializer по строкам for_leaderboard()
+    minigames = catalog_items(Minigame)
+    return [
+        {
+            'name': player.name,
+            'own_coins': player.own_coins,
+            'own_money': player.own_money,
+            'user_review': player.user_review,
+            'achievement': {
+                name: {'achievement': player.has_achievement(minigame_id)}
+                for minigame_id, name in minigames
+            },
+            'top_score': player.top_score,
+        }
+        for player in players
+    ]
@@ -0,0 +1,88 @@
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import ScoreEvent, ScoreRollup
+
+# Сколько хранится история прироста очков
+SCORE_EVENTS_RETENTION_DAYS = 14
+DAY_ROLLUPS_RETENTION_DAYS = 14
+WEEK_ROLLUPS_RETENTION_WEEKS = 8
+
+WINDOW_LEADERBOARD_SIZE = 100
+
+
+def period_bucket(period, day):
+    # Начало периода: сам день или понедельник его недели
+    if period == ScoreRollup.WEEK:
+        return day - timedelta(days=day.weekday())
+    return day
+
+
+def add_to_rollup(player_id, period, bucket, coins):
+    updated = ScoreRollup.objects.filter(
+        player_id=player_id, period=period, bucket=bucket
+    ).update(score=F('score') + coins)
+    if updated:
+        return
+
+    try:
+        with transaction.atomic():
+            ScoreRollup.objects.create(
+                player_id=player_id, period=period, bucket=bucket, score=coins)
+    except IntegrityError:
+        # Строку периода успел создать параллельный запрос
+        ScoreRollup.objects.filter(
+            player_id=player_id, period=period, bucket=bucket
+        ).update(score=F('score') + coins)
+
+
+def record_coins(player_id, coins):
+    # Прирост own_coins записывается в журнал и сразу
+    # прибавляется к суммам за текущие день и неделю
+    if coins <= 0:
+        return
+
+    today = timezone.localdate()
+    with transaction.atomic():
+        ScoreEvent.objects.create(player_id=player_id, day=today, coins=coins)
+        for period, _ in ScoreRollup.periods:
+            add_to_rollup(player_id, period, period_bucket(period, today), coins)
+
+
+def window_top_players(period, day=None):
+    # Таблица лидеров за период читается только из сумм по периоду
+    bucket = period_bucket(period, day or timezone.localdate())
+    rows = ScoreRollup.objects.filter(
+        period=period, bucket=bucket
+    ).order_by('-score', 'player_id').values(
+        'player_id', 'player__name', 'score'
+    )[:WINDOW_LEADERBOARD_SIZE]
+    return bucket, [
+        {
+            'place': place,
+            'player_id': row['player_id'],
+            'name': row['player__name'],
+            'score': row['score'],
+        }
+        for place, row in enumerate(rows, start=1)
+    ]
+
+
+def prune_score_history(today=None):
+    # Удаление журнала и сумм за периоды старше срока хранения
+    today = today or timezone.localdate()
+    deleted, _ = ScoreEvent.objects.filter(
+        day__lt=today - timedelta(days=SCORE_EVENTS_RETENTION_DAYS)).delete()
+    rollups, _ = ScoreRollup.objects.filter(
+        period=ScoreRollup.DAY,
+        bucket__lt=today - timedelta(days=DAY_ROLLUPS_RETENTION_DAYS)).delete()
+    deleted += rollups
+    rollups, _ = ScoreRollup.objects.filter(
+        period=ScoreRollup.WEEK,
+        bucket__lt=period_bucket(ScoreRollup.WEEK, today)
+        - timedelta(weeks=WEEK_ROLLUPS_RETENTION_WEEKS)).delete()
+    return deleted + rollups
+
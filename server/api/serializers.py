@@ -1,6 +1,17 @@
-from rest_framework.serializers import ModelSerializer
-
-from .models import Player, Equipment, Harvest, Minigame, PlayerEquipment, PlayerHarvest, PlayerMinigame
+from django.db import transaction
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import extend_schema_field
+from rest_framework.exceptions import ValidationError
+from rest_framework.serializers import (DictField, IntegerField, ModelSerializer,
+                                        Serializer, SerializerMethodField)
+
+from .catalog import catalog_items
+from .leaderboard import invalidate_minigame_leaderboards, record_top_score
+from .models import (Player, Equipment, Harvest, Minigame, PlayerEquipment,
+                     PlayerHarvest, PlayerMinigame)
+from .progress import EQUIPMENT, HARVEST, MINIGAME, TABLES, write_progress
+from .score_history import record_coins
+from .sync import SYNC_FIELDS, progress_key
 
 
 class EquipmentSerializer(ModelSerializer):
@@ -41,11 +52,16 @@ class PlayerMinigameSerializer(ModelSerializer):
                   'complete', 'score', 'achievement')
 
 
+# Вложенные разделы прогресса в представлении игрока
+PLAYER_NESTED_FIELDS = ('equipment', 'harvest', 'minigame')
+
+
 class PlayerSerializer(ModelSerializer):
     class Meta:
         model = Player
         fields = ('id', 'name', 'gender', 'own_money', 'own_coins', 'user_review',
-                  'credit', 'equipment', 'harvest', 'minigame')
+                  'credit', 'equipment', 'harvest', 'minigame', 'version')
+        read_only_fields = ('version',)
 
     equipment = PlayerEquipmentSerializer(
         source='playerequipment_set', many=True, required=False)
@@ -54,114 +70,181 @@ class PlayerSerializer(ModelSerializer):
     minigame = PlayerMinigameSerializer(
         source='playerminigame_set', many=True, required=False)
 
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Выборочный вывод полей (?fields= и ?include= в списке игроков)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
     def to_representation(self, instance):
         data = super().to_representation(instance)
 
         # Преобразование equipment в словарь
-        equipment_data = {}
-        for equipment in data['equipment']:
-            equipment_data[equipment['equipment_name']] = {
-                'available': equipment['available']
-            }
+        if 'equipment' in data:
+            equipment_data = {}
+            for equipment in data['equipment']:
+                equipment_data[equipment['equipment_name']] = {
+                    'available': equipment['available']
+                }
 
-        data['equipment'] = equipment_data
+            data['equipment'] = equipment_data
 
         # Преобразование harvest в словарь
-        harvest_data = {}
-        for harvest in data['harvest']:
-            harvest_data[harvest['harvest_name']] = {
-                'harvest_amount': harvest['harvest_amount'],
-                'available': harvest['available'],
-                'gen_modified': harvest['gen_modified']
-            }
+        if 'harvest' in data:
+            harvest_data = {}
+            for harvest in data['harvest']:
+                harvest_data[harvest['harvest_name']] = {
+                    'harvest_amount': harvest['harvest_amount'],
+                    'available': harvest['available'],
+                    'gen_modified': harvest['gen_modified']
+                }
 
-        data['harvest'] = harvest_data
+            data['harvest'] = harvest_data
 
         # Преобразование minigame в словарь
-        minigame_data = {}
-        for minigame in data['minigame']:
-            minigame_data[minigame['minigame_name']] = {
-                'available': minigame['available'],
-                'complete': minigame['complete'],
-                'score': minigame['score'],
-                'achievement': minigame['achievement']
-            }
-
-        data['minigame'] = minigame_data
+        if 'minigame' in data:
+            minigame_data = {}
+            for minigame in data['minigame']:
+                minigame_data[minigame['minigame_name']] = {
+                    'available': minigame['available'],
+                    'complete': minigame['complete'],
+                    'score': minigame['score'],
+                    'achievement': minigame['achievement']
+                }
+
+            data['minigame'] = minigame_data
         return data
 
     def update(self, instance, validated_data):
+        # Разделы прогресса приходят под именами связей модели
+        for table in TABLES:
+            rows = validated_data.pop(table.related_name, None)
+            if rows is not None:
+                validated_data[table.catalog_field] = rows
+        return update_player(instance, validated_data)
+
+
+def update_player(instance, data, peak_coins=None, gained_coins=None):
+    # Запись изменений игрока: поля Player и разделы прогресса
+    # equipment, harvest и minigame списками строк.
+    # Пакетная запись передаёт наибольшее значение own_coins среди слитых
+    # операций (peak_coins) и сумму их приростов (gained_coins)
+    previous_top_score = instance.top_score
+    previous_own_coins = instance.own_coins
+    previous = {field: getattr(instance, field) for field in SYNC_FIELDS}
+    changed = []
+
+    equipment_data = data.get('equipment')
+    harvest_data = data.get('harvest')
+    minigame_data = data.get('minigame')
+
+    with transaction.atomic():
         # Обновляем поля Player
-        instance.name = validated_data.get('name', instance.name)
-        instance.gender = validated_data.get('gender', instance.gender)
-        instance.own_money = validated_data.get(
-            'own_money', instance.own_money)
-        instance.own_coins = validated_data.get(
-            'own_coins', instance.own_coins)
-        instance.credit = validated_data.get('credit', instance.credit)
-        instance.user_review = validated_data.get('user_review', instance.user_review)
+        instance.name = data.get('name', instance.name)
+        instance.gender = data.get('gender', instance.gender)
+        instance.own_money = data.get('own_money', instance.own_money)
+        instance.own_coins = data.get('own_coins', instance.own_coins)
+        instance.credit = data.get('credit', instance.credit)
+        instance.user_review = data.get('user_review', instance.user_review)
 
         # Проверяем, если own_coins больше текущего top_score, то обновляем top_score
-        if validated_data.get('own_coins', instance.own_coins) > instance.top_score:
-            instance.top_score = validated_data.get(
-                'own_coins', instance.own_coins)
+        top_coins = instance.own_coins
+        if peak_coins is not None:
+            top_coins = max(top_coins, peak_coins)
+        if top_coins > instance.top_score:
+            instance.top_score = top_coins
+
+        # Прогресс пишется пакетно: только новые и изменённые строки
+        if equipment_data:
+            changed += [
+                progress_key(EQUIPMENT, row)
+                for row, _ in write_progress(instance, EQUIPMENT, equipment_data)]
+
+        if harvest_data:
+            changed += [
+                progress_key(HARVEST, row)
+                for row, _ in write_progress(instance, HARVEST, harvest_data)]
+
+        if minigame_data:
+            changed_minigames = []
+            for minigame, before in write_progress(instance, MINIGAME, minigame_data):
+                changed.append(progress_key(MINIGAME, minigame))
+                # Любое изменение результата или достижения меняет
+                # таблицу лидеров мини-игры
+                result = ((before['score'], before['achievement'])
+                          if before else (0, False))
+                if (minigame.score, minigame.achievement) != result:
+                    changed_minigames.append(minigame.minigame_id)
+                # Копия достижений для таблицы лидеров
+                instance.set_achievement(minigame.minigame_id, minigame.achievement)
+
+            if changed_minigames:
+                invalidate_minigame_leaderboards(changed_minigames)
+
+        # Версия для синхронизации растёт при любом изменении состояния
+        changed += [field for field, value in previous.items()
+                    if getattr(instance, field) != value]
+        instance.mark_changed(changed)
 
         instance.save()
 
-        equipment_data = validated_data.pop('playerequipment_set', None)
-        harvest_data = validated_data.pop('playerharvest_set', None)
-        minigame_data = validated_data.pop('playerminigame_set', None)
+        # Обновляем снимок таблицы лидеров, только если рекорд вырос
+        if instance.top_score > previous_top_score:
+            record_top_score(instance)
 
-        instance = super().update(instance, validated_data)
+        # Прирост очков попадает в таблицы лидеров за день и неделю
+        if gained_coins is None:
+            gained_coins = instance.own_coins - previous_own_coins
+        record_coins(instance.id, gained_coins)
 
-        if equipment_data:
-            for equipment_item in equipment_data:
-                equipment, created = PlayerEquipment.objects.get_or_create(player=instance,
-                                                                           equipment_name=equipment_item[
-                                                                               'equipment_name'])
-                equipment.available = equipment_item['available']
-                equipment.save()
+    return instance
 
-        if harvest_data:
-            for harvest_item in harvest_data:
-                harvest, created = PlayerHarvest.objects.get_or_create(player=instance,
-                                                                       harvest_name=harvest_item[
-                                                                           'harvest_name'])
-                harvest.available = harvest_item['available']
-                harvest.harvest_amount = harvest_item['harvest_amount']
-                harvest.gen_modified = harvest_item['gen_modified']
-                harvest.harvest_name = harvest_item['harvest_name']
-                harvest.save()
 
-        if minigame_data:
-            for minigame_item in minigame_data:
-                minigame, created = PlayerMinigame.objects.get_or_create(player=instance,
-                                                                         minigame_name=minigame_item[
-                                                                             'minigame_name'])
-                minigame.available = minigame_item['available']
-                minigame.complete = minigame_item['complete']
-                minigame.score = minigame_item['score']
-                minigame.minigame_name = minigame_item['minigame_name']
-                minigame.achievement = minigame_item['achievement']
-                minigame.save()
+class PlayerSyncSerializer(Serializer):
+    base_version = IntegerField(min_value=0)
+    changes = DictField(required=False, default=dict)
 
-        return instance
 
+class PlayerIncrementSerializer(Serializer):
+    own_coins = IntegerField(required=False, default=0)
+    own_money = IntegerField(required=False, default=0)
+    credit = IntegerField(required=False, default=0)
 
-class LeaderboardPlayerSerializer(ModelSerializer):
-    achievement = PlayerMinigameSerializer(
-        source='playerminigame_set', many=True, required=False, read_only=True)
+    def validate(self, attrs):
+        if not any(attrs.values()):
+            raise ValidationError('Укажите хотя бы одно ненулевое приращение')
+        return attrs
 
-    def to_representation(self, instance):
-        data = super().to_representation(instance)
 
-        achievement_data = {
-            minigame['minigame_name']: {'achievement': minigame['achievement']}
-            for minigame in data['achievement']
-        }
+# Наибольшее число операций в одном пакетном запросе
+BATCH_MAX_OPERATIONS = 500
 
-        data['achievement'] = achievement_data
-        return data
+
+class PlayerBatchOperationSerializer(Serializer):
+    player = IntegerField()
+    data = DictField()
+
+
+class PlayerBatchSerializer(Serializer):
+    operations = PlayerBatchOperationSerializer(
+        many=True, allow_empty=False, max_length=BATCH_MAX_OPERATIONS)
+
+
+class LeaderboardPlayerSerializer(ModelSerializer):
+    achievement = SerializerMethodField()
+
+    def get_minigames(self):
+        # Список мини-игр берётся из кэша справочников
+        return catalog_items(Minigame)
+
+    @extend_schema_field(OpenApiTypes.OBJECT)
+    def get_achievement(self, instance):
+        # Достижения берутся из Player.achievement_mask без чтения PlayerMinigame
+        return {
+            minigame_name: {'achievement': instance.has_achievement(minigame_id)}
+            for minigame_id, minigame_name in self.get_minigames()
+        }
 
     class Meta:
         model = Player
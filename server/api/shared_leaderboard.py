@@ -0,0 +1,309 @@
+import fcntl
+import logging
+import mmap
+import os
+import struct
+from contextlib import contextmanager
+from functools import partial
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import Player
+
+logger = logging.getLogger(__name__)
+
+# Формат файла рейтинга в разделяемой памяти:
+#   заголовок: сигнатура, количество игроков, ёмкость массивов;
+#   массив рейтинга: (-top_score, id), отсортирован по возрастанию,
+#     индекс записи + 1 = место игрока;
+#   массив игроков: (id, top_score), отсортирован по id,
+#     по нему находится текущий результат игрока.
+# Все процессы отображают один файл через mmap, согласованность
+# обеспечивает flock на соседнем .lock файле.
+MAGIC = b'LDB1'
+HEADER = struct.Struct('<4sqq')
+HEADER_SIZE = 64
+RECORD = struct.Struct('<qq')
+MIN_CAPACITY = 1024
+MIN_KEY = -2 ** 63
+
+LOAD_CHUNK_SIZE = 10000
+
+
+class SharedLeaderboardUnavailable(Exception):
+    pass
+
+
+class SharedLeaderboard:
+    def __init__(self, path):
+        self.path = path
+        self.pid = None
+        self.lock_fd = None
+        self.fd = None
+        self.mm = None
+        self.capacity = 0
+
+    def _open(self):
+        # Дескрипторы не наследуются от родительского процесса:
+        # flock на общем дескрипторе не разделял бы воркеры
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.lock_fd = os.open(f'{self.path}.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.mm = None
+        self.capacity = 0
+
+    def _map(self, capacity):
+        if self.mm is not None:
+            self.mm.close()
+        self.mm = mmap.mmap(self.fd, file_size(capacity))
+        self.capacity = capacity
+
+    def _attach(self):
+        # Другой процесс мог перестроить или расширить файл
+        if os.fstat(self.fd).st_size < HEADER_SIZE:
+            raise SharedLeaderboardUnavailable(self.path)
+        if self.mm is None:
+            self.mm = mmap.mmap(self.fd, HEADER_SIZE)
+        magic, _, capacity = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise SharedLeaderboardUnavailable(self.path)
+        if capacity != self.capacity:
+            self._map(capacity)
+
+    @contextmanager
+    def locked(self, exclusive=False):
+        self._open()
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    def is_loaded(self):
+        with self.locked():
+            try:
+                self._attach()
+            except SharedLeaderboardUnavailable:
+                return False
+        return True
+
+    # Смещения массивов в файле
+
+    def _ranks(self):
+        return HEADER_SIZE
+
+    def _ids(self):
+        return HEADER_SIZE + self.capacity * RECORD.size
+
+    def _count(self):
+        return HEADER.unpack_from(self.mm, 0)[1]
+
+    def _set_count(self, count):
+        HEADER.pack_into(self.mm, 0, MAGIC, count, self.capacity)
+
+    def _bisect(self, offset, count, key):
+        # Первая позиция, запись в которой не меньше key
+        unpack, mm = RECORD.unpack_from, self.mm
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if unpack(mm, offset + middle * RECORD.size) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _insert(self, offset, count, index, record):
+        position = offset + index * RECORD.size
+        self.mm.move(position + RECORD.size, position, (count - index) * RECORD.size)
+        RECORD.pack_into(self.mm, position, *record)
+
+    def _delete(self, offset, count, index):
+        position = offset + index * RECORD.size
+        self.mm.move(position, position + RECORD.size,
+                     (count - index - 1) * RECORD.size)
+
+    def _find(self, count, player_id):
+        # Позиция игрока в массиве игроков и его результат
+        index = self._bisect(self._ids(), count, (player_id, MIN_KEY))
+        if index < count:
+            found_id, top_score = RECORD.unpack_from(
+                self.mm, self._ids() + index * RECORD.size)
+            if found_id == player_id:
+                return index, top_score
+        return index, None
+
+    def _grow(self, count):
+        ids, capacity = self._ids(), self.capacity * 2
+        os.ftruncate(self.fd, file_size(capacity))
+        self._map(capacity)
+        self.mm.move(self._ids(), ids, count * RECORD.size)
+        self._set_count(count)
+
+    # Чтение
+
+    def place(self, player_id):
+        with self.locked():
+            self._attach()
+            count = self._count()
+            _, top_score = self._find(count, player_id)
+            if top_score is None:
+                return None
+            return self._bisect(self._ranks(), count, (-top_score, player_id)) + 1
+
+    def top(self, limit):
+        # Первые limit записей рейтинга: (top_score, id)
+        with self.locked():
+            self._attach()
+            count = min(limit, self._count())
+            return [
+                (-negative_score, player_id)
+                for negative_score, player_id in RECORD.iter_unpack(
+                    self.mm[self._ranks():self._ranks() + count * RECORD.size])
+            ]
+
+    # Запись
+
+    def set_score(self, player_id, top_score):
+        with self.locked(exclusive=True):
+            self._attach()
+            count = self._count()
+            index, previous = self._find(count, player_id)
+
+            if previous == top_score:
+                return
+
+            if previous is None:
+                if count == self.capacity:
+                    self._grow(count)
+                self._insert(self._ids(), count, index, (player_id, top_score))
+            else:
+                rank = self._bisect(self._ranks(), count, (-previous, player_id))
+                self._delete(self._ranks(), count, rank)
+                count -= 1
+                RECORD.pack_into(self.mm, self._ids() + index * RECORD.size,
+                                 player_id, top_score)
+
+            rank = self._bisect(self._ranks(), count, (-top_score, player_id))
+            self._insert(self._ranks(), count, rank, (-top_score, player_id))
+            self._set_count(count + 1)
+
+    def remove(self, player_id):
+        with self.locked(exclusive=True):
+            self._attach()
+            count = self._count()
+            index, previous = self._find(count, player_id)
+            if previous is None:
+                return
+            rank = self._bisect(self._ranks(), count, (-previous, player_id))
+            self._delete(self._ranks(), count, rank)
+            self._delete(self._ids(), count, index)
+            self._set_count(count - 1)
+
+    def load(self, count, ranking_rows, player_rows):
+        # Полная перезапись файла, вызывается под locked(exclusive=True).
+        # ranking_rows - (top_score, id) в порядке рейтинга,
+        # player_rows - (id, top_score) в порядке id.
+        capacity = MIN_CAPACITY
+        while capacity < count * 5 // 4:
+            capacity *= 2
+
+        os.ftruncate(self.fd, file_size(capacity))
+        self._map(capacity)
+        # Сигнатура пишется последней: до конца загрузки файл недоступен
+        HEADER.pack_into(self.mm, 0, b'\0' * 4, 0, capacity)
+        for index, (top_score, player_id) in enumerate(ranking_rows):
+            RECORD.pack_into(self.mm, self._ranks() + index * RECORD.size,
+                             -top_score, player_id)
+        for index, record in enumerate(player_rows):
+            RECORD.pack_into(self.mm, self._ids() + index * RECORD.size, *record)
+        self._set_count(count)
+
+
+def file_size(capacity):
+    return HEADER_SIZE + 2 * capacity * RECORD.size
+
+
+def load_from_db(engine):
+    # Загрузка из таблицы Player командой rebuild_leaderboard, не из запроса:
+    # внутри чужой транзакции снимок видел бы незафиксированные результаты
+    if connection.in_atomic_block:
+        raise RuntimeError('Shared leaderboard must be loaded outside a transaction')
+
+    # Блокировка берётся до снимка базы: изменения, зафиксированные после
+    # снимка, ждут её в set_score и применяются поверх загруженных данных.
+    # Оба запроса читают один снимок, чтобы массивы совпадали.
+    with engine.locked(exclusive=True), transaction.atomic():
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        load_players(engine)
+
+
+def load_players(engine):
+    # Оба массива рейтинга из таблицы Player в текущей транзакции,
+    # вызывается под engine.locked(exclusive=True)
+    players = Player.objects.all()
+    engine.load(
+        players.count(),
+        players.order_by('-top_score', 'id').values_list(
+            'top_score', 'id').iterator(chunk_size=LOAD_CHUNK_SIZE),
+        players.order_by('id').values_list(
+            'id', 'top_score').iterator(chunk_size=LOAD_CHUNK_SIZE),
+    )
+
+
+_engine = None
+
+
+def shared_leaderboard_engine():
+    # Файл рейтинга из LEADERBOARD_SHARED_PATH, загружен он или нет
+    global _engine
+    path = settings.LEADERBOARD_SHARED_PATH
+    if not path:
+        return None
+    if _engine is None:
+        _engine = SharedLeaderboard(path)
+    return _engine
+
+
+def get_shared_leaderboard():
+    # Рейтинг в разделяемой памяти включается настройкой LEADERBOARD_SHARED_PATH
+    # и загружается командой rebuild_leaderboard при запуске контейнера.
+    # Пока он не загружен и при любой ошибке возвращается None
+    # и используется база данных.
+    engine = shared_leaderboard_engine()
+    if engine is None:
+        return None
+
+    try:
+        if not engine.is_loaded():
+            return None
+    except OSError:
+        logger.exception('Shared leaderboard %s is unavailable', engine.path)
+        return None
+    return engine
+
+
+def _apply(method, *args):
+    try:
+        method(*args)
+    except (OSError, SharedLeaderboardUnavailable):
+        logger.exception('Shared leaderboard update failed')
+
+
+def update_shared_score(player_id, top_score):
+    # Изменения применяются после фиксации транзакции,
+    # откат не должен попадать в общий рейтинг
+    engine = get_shared_leaderboard()
+    if engine is not None:
+        transaction.on_commit(partial(_apply, engine.set_score, player_id, top_score))
+
+
+def remove_shared_player(player_id):
+    engine = get_shared_leaderboard()
+    if engine is not None:
+        transaction.on_commit(partial(_apply, engine.remove, player_id))
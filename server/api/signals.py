@@ -1,31 +1,68 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
-from .models import Player, Equipment, Harvest, Minigame, PlayerHarvest, PlayerEquipment, PlayerMinigame
+from .backfill import schedule_backfill
+from .catalog import bump_catalog_version
+from .leaderboard import (LEADERBOARD_SIZE, invalidate_minigame_leaderboards,
+                          rebuild_leaderboard)
+from .shared_leaderboard import remove_shared_player, update_shared_score
+from .stats import player_deleted, player_saved
+from .models import Player, Equipment, Harvest, Minigame, LeaderboardEntry
+from .progress import create_progress
 
 
 @receiver(post_save, sender=Player)
-def create_player_equipment(sender, instance, created, **kwargs):
-    if created:
-        equipment_list = Equipment.objects.all()
-        for equipment in equipment_list:
-            PlayerEquipment.objects.create(
-                player=instance, equipment=equipment, equipment_name=equipment.name, available=False)
+def count_saved_player(sender, instance, created, update_fields=None, **kwargs):
+    player_saved(instance, created, update_fields)
+
+
+@receiver(post_delete, sender=Player)
+def count_deleted_player(sender, instance, **kwargs):
+    player_deleted(instance)
 
 
 @receiver(post_save, sender=Player)
-def create_player_harvest(sender, instance, created, **kwargs):
-    if created:
-        harvest_list = Harvest.objects.all()
-        for harvest in harvest_list:
-            PlayerHarvest.objects.create(
-                player=instance, harvest=harvest, harvest_name=harvest.name, available=False)
+def share_player_score(sender, instance, **kwargs):
+    # Рейтинг в разделяемой памяти содержит всех игроков, включая новых
+    if 'top_score' not in instance.get_deferred_fields():
+        update_shared_score(instance.id, instance.top_score)
+
+
+@receiver(post_delete, sender=Player)
+def unshare_player_score(sender, instance, **kwargs):
+    remove_shared_player(instance.id)
 
 
 @receiver(post_save, sender=Player)
-def create_player_minigame(sender, instance, created, **kwargs):
+def create_player_progress(sender, instance, created, **kwargs):
+    # Выполняется в транзакции создания игрока
     if created:
-        minigame_list = Minigame.objects.all()
-        for minigame in minigame_list:
-            PlayerMinigame.objects.create(
-                player=instance, minigame=minigame, minigame_name=minigame.name, available=False)
+        create_progress(instance)
+
+
+@receiver(post_save, sender=Equipment)
+@receiver(post_save, sender=Harvest)
+@receiver(post_save, sender=Minigame)
+@receiver(post_delete, sender=Equipment)
+@receiver(post_delete, sender=Harvest)
+@receiver(post_delete, sender=Minigame)
+def reset_catalog_cache(sender, **kwargs):
+    # Кэши справочников во всех процессах устаревают
+    bump_catalog_version()
+
+
+@receiver(post_save, sender=Equipment)
+@receiver(post_save, sender=Harvest)
+@receiver(post_save, sender=Minigame)
+def backfill_player_progress(sender, instance, created, **kwargs):
+    # Существующие игроки получают строку прогресса новой записи в фоне
+    if created:
+        schedule_backfill(instance)
+
+
+@receiver(post_delete, sender=Player)
+def refill_leaderboard(sender, instance, **kwargs):
+    # Удалённый лидер освобождает место в снимке таблицы лидеров
+    if LeaderboardEntry.objects.count() < LEADERBOARD_SIZE:
+        rebuild_leaderboard()
+    invalidate_minigame_leaderboards()
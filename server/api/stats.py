@@ -0,0 +1,81 @@
+from django.db import transaction
+from django.db.models import DEFERRED, Count, F, Sum
+
+from .models import Player, PlayerTotals
+
+TOTALS_PK = 1
+
+
+def player_totals():
+    # Строка агрегатов; при первом обращении считается по таблице Player
+    totals = PlayerTotals.objects.filter(pk=TOTALS_PK).first()
+    if totals is None:
+        totals = reconcile_totals()
+    return totals
+
+
+def scan_totals():
+    # Фактические значения агрегатов по таблице Player
+    values = Player.objects.aggregate(
+        total_players=Count('id'),
+        review_count=Count('user_review'),
+        review_sum=Sum('user_review'),
+    )
+    values['review_sum'] = values['review_sum'] or 0
+    return values
+
+
+def reconcile_totals():
+    # Пересчёт агрегатов по таблице Player с перезаписью строки.
+    # Строка сначала создаётся: get_or_create переживает параллельное
+    # создание, а блокировка существующей строки упорядочивает пересчёты.
+    with transaction.atomic():
+        PlayerTotals.objects.get_or_create(pk=TOTALS_PK)
+        totals = PlayerTotals.objects.select_for_update().get(pk=TOTALS_PK)
+        for field, value in scan_totals().items():
+            setattr(totals, field, value)
+        totals.save()
+    return totals
+
+
+def apply_totals_delta(players=0, reviews=0, review_sum=0):
+    if not (players or reviews or review_sum):
+        return
+
+    with transaction.atomic():
+        updated = PlayerTotals.objects.filter(pk=TOTALS_PK).update(
+            total_players=F('total_players') + players,
+            review_count=F('review_count') + reviews,
+            review_sum=F('review_sum') + review_sum,
+        )
+        # Строки ещё нет - считаем её целиком, изменение уже учтено в Player
+        if not updated:
+            reconcile_totals()
+
+
+def player_saved(player, created, update_fields=None):
+    if created:
+        apply_totals_delta(
+            players=1,
+            reviews=int(player.user_review is not None),
+            review_sum=player.user_review or 0,
+        )
+    elif update_fields is None or 'user_review' in update_fields:
+        previous = getattr(player, '_loaded_user_review', DEFERRED)
+        # Оценка не загружалась из базы - значит и не сохранялась
+        if previous is DEFERRED or previous == player.user_review:
+            return
+        apply_totals_delta(
+            reviews=int(player.user_review is not None) - int(previous is not None),
+            review_sum=(player.user_review or 0) - (previous or 0),
+        )
+
+    player._loaded_user_review = player.user_review
+
+
+def player_deleted(player):
+    apply_totals_delta(
+        players=-1,
+        reviews=-int(player.user_review is not None),
+        review_sum=-(player.user_review or 0),
+    )
@@ -0,0 +1,45 @@
+from .progress import TABLES, check_progress_sections
+
+# Поля игрока, изменения которых передаются клиенту при синхронизации
+SYNC_FIELDS = ('name', 'gender', 'own_money', 'own_coins', 'credit', 'user_review')
+
+
+def progress_key(table, row):
+    return f'{table.catalog_field}.{getattr(row, table.name_field)}'
+
+
+def changes_since(player, data, base_version):
+    # Изменения после base_version в формате представления PlayerSerializer.
+    # data - функция, возвращающая представление игрока.
+    if base_version >= player.version:
+        return {}
+
+    data = data()
+    if base_version < player.reset_version:
+        return {key: value for key, value in data.items()
+                if key not in ('id', 'version')}
+
+    changes = {}
+    for key, version in player.change_versions.items():
+        if version <= base_version:
+            continue
+        section, _, name = key.partition('.')
+        if not name:
+            changes[key] = data[key]
+        elif name in data[section]:
+            changes.setdefault(section, {})[name] = data[section][name]
+    return changes
+
+
+def progress_lists(changes):
+    # Разделы прогресса приходят словарями {название: изменённые поля},
+    # сериализатор принимает списки строк. Неуказанные поля не меняются.
+    check_progress_sections(changes)
+    for table in TABLES:
+        section = changes.get(table.catalog_field)
+        if section is None:
+            continue
+        changes[table.catalog_field] = [
+            {**fields, table.name_field: name} for name, fields in section.items()
+        ]
+    return changes
@@ -0,0 +1,822 @@
+import gzip
+import json
+import tempfile
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DataError, IntegrityError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from . import (
+    backfill,
+    economy,
+    leaderboard,
+    progress,
+    rendered,
+    shared_leaderboard,
+    stats,
+    write_behind,
+)
+from .catalog import (
+    VERSION_PK,
+    bump_catalog_version,
+    catalog_snapshot,
+    clear_catalog,
+)
+from .management.commands import loaddata
+from .models import (
+    MAX_MINIGAME_ID,
+    CatalogVersion,
+    Equipment,
+    LeaderboardEntry,
+    Minigame,
+    Player,
+    PlayerMinigame,
+    PlayerTotals,
+    ProgressBackfill,
+    ScoreEvent,
+)
+from .serializers import LeaderboardPlayerSerializer, PlayerSerializer
+from .views.players import PlayerViewSet
+
+PLAYERS = 12
+
+
+@override_settings(CATALOG_VERSION_CHECK_INTERVAL=3600, LEADERBOARD_SHARED_PATH='')
+class ApiTestCase(TestCase):
+    # Справочники из loaddata и несколько игроков с прогрессом
+    @classmethod
+    def setUpTestData(cls):
+        call_command('loaddata', stdout=StringIO())
+        cls.players = [
+            Player.objects.create(name=f'player{index}', own_coins=index * 10,
+                                  top_score=index * 10, user_review=index % 5 + 1)
+            for index in range(PLAYERS)
+        ]
+
+    def setUp(self):
+        # Кэш справочников читается до подсчёта запросов
+        cache.clear()
+        clear_catalog()
+        catalog_snapshot()
+        self.client = APIClient()
+
+
+class QueryCountTests(ApiTestCase):
+    # Число запросов не зависит от числа игроков в ответе
+    def test_player_list(self):
+        for limit in (PLAYERS // 2, PLAYERS):
+            with self.assertNumQueries(4):
+                response = self.client.get(f'/api/v1/player/?limit={limit}')
+            self.assertEqual(len(response.json()['results']), limit)
+
+    def test_player_retrieve(self):
+        with self.assertNumQueries(4):
+            response = self.client.get(f'/api/v1/player/{self.players[0].id}/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_leaderboard_top(self):
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/v1/liderboard/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_leaderboard_around(self):
+        with self.assertNumQueries(4):
+            response = self.client.get(
+                f'/api/v1/liderboard/{self.players[5].id}/around/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_leaderboard_all(self):
+        for limit in (PLAYERS // 2, PLAYERS):
+            with self.assertNumQueries(1):
+                response = self.client.get(f'/api/v1/liderboard/all/?limit={limit}')
+            self.assertEqual(len(response.json()['results']), limit)
+
+    @override_settings(
+        STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_admin_changelist(self):
+        # Сессия, пользователь, число строк, страница игроков и счётчик без фильтров
+        user = get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'admin')
+        self.client.force_login(user)
+        with self.assertNumQueries(5):
+            response = self.client.get('/admin/api/player/')
+        self.assertEqual(response.status_code, 200)
+
+
+class BatchTests(ApiTestCase):
+    def test_operations_apply_in_order(self):
+        # Промежуточный рекорд пакета попадает в top_score, как при двух PATCH
+        player = self.players[1]
+        response = self.client.post('/api/v1/player/batch/', {'operations': [
+            {'player': player.id, 'data': {'own_coins': 1000}},
+            {'player': player.id, 'data': {'own_coins': 100}},
+        ]}, format='json')
+        self.assertEqual([result['status'] for result in response.json()['results']],
+                         [200, 200])
+        player.refresh_from_db()
+        self.assertEqual((player.own_coins, player.top_score), (100, 1000))
+
+    def post_operations(self, player, coins):
+        operations = [
+            {'player': player.id, 'data': {
+                'own_coins': value,
+                'minigame': {'gameOne': {'available': True, 'score': index + 1}},
+            }}
+            for index, value in enumerate(coins)
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                '/api/v1/player/batch/', {'operations': operations}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results'], len(queries)
+
+    def test_operations_of_player_are_written_once(self):
+        # Пакет из нескольких операций игрока стоит столько же запросов,
+        # сколько одна операция
+        _, single = self.post_operations(self.players[2], [80])
+        results, many = self.post_operations(self.players[3], [80, 20, 130, 60, 100])
+        self.assertEqual(many, single)
+        self.assertEqual({result['version'] for result in results},
+                         {self.players[3].version + 1})
+
+    def test_coalesced_operations_keep_per_operation_scores(self):
+        # Рекорд - наибольшее значение, прирост - сумма положительных шагов
+        player = self.players[3]
+        self.post_operations(player, [80, 20, 130, 60, 100])
+        player.refresh_from_db()
+        self.assertEqual((player.own_coins, player.top_score), (100, 130))
+        gained = ScoreEvent.objects.filter(player=player).values_list(
+            'coins', flat=True)
+        self.assertEqual(sum(gained), (80 - 30) + (130 - 20) + (100 - 60))
+        self.assertEqual(
+            PlayerMinigame.objects.get(player=player, minigame_name='gameOne').score, 5)
+
+
+class SyncTests(ApiTestCase):
+    def sync(self, player, base_version, changes=None):
+        data = {'base_version': base_version}
+        if changes is not None:
+            data['changes'] = changes
+        return self.client.post(f'/api/v1/player/{player.id}/sync/', data,
+                                format='json')
+
+    def test_pull_returns_changes_after_base_version(self):
+        player = self.players[4]
+        base_version = player.version
+        self.client.patch(f'/api/v1/player/{player.id}/', {
+            'own_coins': 77,
+            'equipment': {'robot': {'available': True}},
+        }, format='json')
+
+        response = self.sync(player, base_version)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            'version': base_version + 1,
+            'changes': {'own_coins': 77, 'equipment': {'robot': {'available': True}}},
+        })
+        response = self.sync(player, base_version + 1)
+        self.assertEqual(response.json(), {'version': base_version + 1, 'changes': {}})
+
+    def test_apply_bumps_version(self):
+        player = self.players[4]
+        response = self.sync(player, player.version, {
+            'own_money': 300,
+            'minigame': {'gameTwo': {'score': 9}},
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(),
+                         {'version': player.version + 1, 'changes': {}})
+
+        player.refresh_from_db()
+        self.assertEqual(player.own_money, 300)
+        self.assertEqual(
+            PlayerMinigame.objects.get(player=player, minigame_name='gameTwo').score, 9)
+        self.assertEqual(player.change_versions['own_money'], player.version)
+        self.assertEqual(player.change_versions['minigame.gameTwo'], player.version)
+
+    def test_conflict_returns_server_changes(self):
+        player = self.players[4]
+        base_version = player.version
+        self.client.patch(f'/api/v1/player/{player.id}/', {'credit': 5},
+                          format='json')
+
+        response = self.sync(player, base_version, {'own_money': 300})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json(), {
+            'error': 'Version conflict',
+            'version': base_version + 1,
+            'changes': {'credit': 5},
+        })
+        player.refresh_from_db()
+        self.assertEqual(player.own_money, self.players[4].own_money)
+
+    def test_base_version_ahead_of_server(self):
+        player = self.players[4]
+        response = self.sync(player, player.version + 1)
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(
+        STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_sync_after_admin_reset_returns_full_state(self):
+        player = self.players[4]
+        base_version = player.version
+        user = get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'admin')
+        self.client.force_login(user)
+        self.client.post('/admin/api/player/', {
+            'action': 'reset_progress', '_selected_action': [player.id]})
+
+        response = self.sync(player, base_version)
+        self.assertEqual(response.status_code, 200)
+        player.refresh_from_db()
+        state = PlayerSerializer(player).data
+        self.assertEqual(response.json(), {
+            'version': player.version,
+            'changes': {key: value for key, value in state.items()
+                        if key not in ('id', 'version')},
+        })
+
+
+class ResetPlayersTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.reset, self.kept = self.players[6:9], self.players[9]
+        for player in (*self.reset, self.kept):
+            self.client.patch(f'/api/v1/player/{player.id}/', {
+                'equipment': {'robot': {'available': True}},
+                'minigame': {'gameOne': {'available': True, 'complete': True,
+                                         'score': 40, 'achievement': True}},
+            }, format='json')
+            player.refresh_from_db()
+
+    def progress(self, player):
+        return self.client.get(f'/api/v1/player/{player.id}/').json()
+
+    def assert_reset(self):
+        for player in self.reset:
+            version, top_score = player.version, player.top_score
+            player.refresh_from_db()
+            self.assertEqual((player.version, player.reset_version),
+                             (version + 1, version + 1))
+            self.assertEqual(player.change_versions, {})
+            # Рекорд не сбрасывается
+            self.assertEqual(
+                (player.own_coins, player.top_score, player.achievement_mask),
+                (0, top_score, 0))
+            state = self.progress(player)
+            self.assertFalse(state['equipment']['robot']['available'])
+            self.assertEqual(state['minigame']['gameOne'], {
+                'available': False, 'complete': False, 'score': 0,
+                'achievement': False})
+
+            # Клиент со старой версией получает всё состояние
+            response = self.client.post(f'/api/v1/player/{player.id}/sync/',
+                                        {'base_version': version}, format='json')
+            self.assertEqual(set(response.json()['changes']),
+                             set(state) - {'id', 'version'})
+
+        self.assertEqual(self.progress(self.kept)['minigame']['gameOne']['score'], 40)
+
+    def test_progress_tables(self):
+        ids = [player.id for player in self.reset]
+        # Пачка меньше числа игроков: сброс идёт несколькими транзакциями
+        self.assertEqual(
+            progress.reset_players(Player.objects.filter(id__in=ids), chunk_size=2), 3)
+        self.assertFalse(PlayerMinigame.objects.filter(
+            player_id__in=ids, score__gt=0).exists())
+        self.assert_reset()
+
+    def test_packed_progress(self):
+        with override_settings(PLAYER_PROGRESS_STORAGE='packed'):
+            call_command('pack_progress', stdout=StringIO())
+            for player in self.reset:
+                player.refresh_from_db()
+            progress.reset_players(
+                Player.objects.filter(id__in=[player.id for player in self.reset]),
+                chunk_size=2)
+            self.assert_reset()
+
+
+class WriteBehindTests(ApiTestCase):
+    def test_rejected_delta_is_dropped(self):
+        # Приращение, которое база отвергает, не возвращается в буфер
+        # и не мешает записи приращений других игроков
+        poison, player = self.players[0], self.players[1]
+        increment_players = write_behind.increment_players
+
+        def fail_for_poison(deltas):
+            if poison.id in deltas:
+                raise DataError('integer out of range')
+            return increment_players(deltas)
+
+        buffer = write_behind.WriteBehindBuffer(3600, 100)
+        buffer.add(poison.id, {'credit': 1})
+        buffer.add(player.id, {'credit': 1})
+        with mock.patch.object(write_behind, 'increment_players', fail_for_poison), \
+                self.assertLogs(write_behind.logger, 'ERROR'):
+            self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(buffer.deltas, {})
+        player.refresh_from_db()
+        self.assertEqual(player.credit, 1)
+
+    @override_settings(PLAYER_WRITE_BEHIND_INTERVAL=3600)
+    @mock.patch.object(write_behind, '_buffer', None)
+    def test_increment_is_buffered_for_existing_player(self):
+        player = self.players[2]
+        response = self.client.post(f'/api/v1/player/{player.id}/increment/',
+                                    {'own_coins': 5}, format='json')
+        self.assertEqual(response.status_code, 202)
+        response = self.client.post('/api/v1/player/999999/increment/',
+                                    {'own_coins': 5}, format='json')
+        self.assertEqual(response.status_code, 404)
+
+        buffer = write_behind.get_write_behind_buffer()
+        self.assertEqual(list(buffer.deltas), [player.id])
+        self.assertEqual(buffer.flush(), 1)
+        player.refresh_from_db()
+        self.assertEqual(player.own_coins, 25)
+
+    def test_deleted_player_is_reported(self):
+        player = self.players[2]
+        buffer = write_behind.WriteBehindBuffer(3600, 100)
+        buffer.add(player.id, {'credit': 1})
+        player.delete()
+        with self.assertLogs(write_behind.logger, 'WARNING'):
+            self.assertEqual(buffer.flush(), 0)
+
+
+class IncrementTests(ApiTestCase):
+    def increment(self, player, deltas):
+        return self.client.post(f'/api/v1/player/{player.id}/increment/', deltas,
+                                format='json')
+
+    def test_increment_past_top_score(self):
+        leaderboard.rebuild_leaderboard()
+        player = self.players[1]
+        with mock.patch.object(economy, 'update_shared_score') as shared:
+            response = self.increment(player, {'own_coins': 990, 'own_money': -5})
+        self.assertEqual(response.status_code, 200)
+        shared.assert_called_once_with(player.id, 1000)
+        self.assertEqual(response.json(), {
+            'own_coins': 1000, 'own_money': player.own_money - 5,
+            'credit': player.credit, 'top_score': 1000,
+            'version': player.version + 1,
+        })
+
+        player.refresh_from_db()
+        self.assertEqual((player.own_coins, player.top_score), (1000, 1000))
+        self.assertEqual(player.change_versions['own_coins'], player.version)
+        self.assertEqual(player.change_versions['own_money'], player.version)
+        self.assertEqual(LeaderboardEntry.objects.get(player=player).top_score, 1000)
+        self.assertEqual(list(ScoreEvent.objects.filter(player=player).values_list(
+            'coins', flat=True)), [990])
+
+    def test_negative_delta_keeps_top_score(self):
+        player = self.players[5]
+        with mock.patch.object(economy, 'update_shared_score') as shared:
+            response = self.increment(player, {'own_coins': -20})
+        self.assertEqual(response.status_code, 200)
+        shared.assert_not_called()
+        player.refresh_from_db()
+        self.assertEqual((player.own_coins, player.top_score), (30, 50))
+        self.assertFalse(ScoreEvent.objects.filter(player=player).exists())
+
+    def test_unknown_player(self):
+        response = self.client.post('/api/v1/player/999999/increment/',
+                                    {'own_coins': 1}, format='json')
+        self.assertEqual(response.status_code, 404)
+
+
+class WindowLeaderboardTests(ApiTestCase):
+    def test_impossible_date(self):
+        response = self.client.get('/api/v1/liderboard/daily/?date=2023-02-30')
+        self.assertEqual(response.status_code, 400)
+
+
+@mock.patch.object(leaderboard, 'LEADERBOARD_SIZE', 5)
+class LeaderboardSnapshotTests(ApiTestCase):
+    def leaders(self):
+        return list(LeaderboardEntry.objects.order_by(
+            '-top_score', 'player_id').values_list('top_score', flat=True))
+
+    def test_new_record_evicts_lowest(self):
+        leaderboard.rebuild_leaderboard()
+        player = self.players[0]
+        player.top_score = 75
+        leaderboard.record_top_score(player)
+        self.assertEqual(self.leaders(), [110, 100, 90, 80, 75])
+
+        # Результат ниже последнего не попадает в таблицу
+        leaderboard.record_top_score(self.players[1])
+        self.assertEqual(self.leaders(), [110, 100, 90, 80, 75])
+
+    def test_overfilled_snapshot_is_trimmed(self):
+        # Лишние строки, например после гонки до блокировки, вытесняются
+        LeaderboardEntry.objects.bulk_create([
+            LeaderboardEntry(player=player, top_score=player.top_score)
+            for player in self.players[4:]])
+        player = self.players[0]
+        player.top_score = 200
+        leaderboard.record_top_score(player)
+        self.assertEqual(self.leaders(), [200, 110, 100, 90, 80])
+
+    def test_rejection_holds_rebuild_lock(self):
+        # Отказ без входа в снимок держит разделяемую блокировку перестроения,
+        # перестроение берёт её исключительно и раньше блокировки записи
+        leaderboard.rebuild_leaderboard()
+        with mock.patch.object(leaderboard, 'advisory_lock') as lock:
+            leaderboard.record_top_score(self.players[1])
+            self.assertEqual(lock.call_args_list, [
+                mock.call(leaderboard.LEADERBOARD_REBUILD_LOCK_KEY, shared=True)])
+
+            lock.reset_mock()
+            leaderboard.rebuild_leaderboard()
+            self.assertEqual(lock.call_args_list, [
+                mock.call(leaderboard.LEADERBOARD_REBUILD_LOCK_KEY),
+                mock.call(leaderboard.LEADERBOARD_LOCK_KEY)])
+
+    def test_lowered_snapshot_admits_rejected_player(self):
+        leaderboard.rebuild_leaderboard()
+        player = self.players[6]
+        player.top_score = 65
+        player.save()
+        leaderboard.record_top_score(player)
+        self.assertNotIn(65, self.leaders())
+
+        # Удаление лидера опускает последнюю запись
+        self.players[11].delete()
+        self.assertEqual(self.leaders(), [100, 90, 80, 70, 65])
+
+
+class AchievementBitTests(ApiTestCase):
+    def test_minigame_ids_fit_achievement_mask(self):
+        # Бит достижения есть только у мини-игр с id до MAX_MINIGAME_ID
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Minigame.objects.create(id=MAX_MINIGAME_ID + 1, name='extra',
+                                    description='extra')
+        player = self.players[0]
+        player.set_achievement(MAX_MINIGAME_ID, True)
+        player.save()
+        player.refresh_from_db()
+        self.assertTrue(player.has_achievement(MAX_MINIGAME_ID))
+
+
+class MinigameLeaderboardCacheTests(ApiTestCase):
+    def test_lower_score_invalidates_cache(self):
+        player = self.players[3]
+        url = f'/api/v1/player/{player.id}/'
+        self.client.patch(url, {'minigame': {'gameOne': {
+            'available': True, 'score': 500}}}, format='json')
+        minigame = Minigame.objects.get(name='gameOne')
+        self.assertEqual(leaderboard.minigame_top_players(minigame)[0]['score'], 500)
+
+        # Сброс кэша выполняется после фиксации транзакции записи
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(url, {'minigame': {'gameOne': {
+                'available': True, 'score': 50}}}, format='json')
+        self.assertEqual(leaderboard.minigame_top_players(minigame)[0]['score'], 50)
+
+    @override_settings(
+        STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_admin_inline_edit_invalidates_cache(self):
+        player = self.players[3]
+        minigame = Minigame.objects.get(name='gameOne')
+        PlayerMinigame.objects.filter(
+            player=player, minigame=minigame).update(score=500)
+        self.assertEqual(leaderboard.minigame_top_players(minigame)[0]['score'], 500)
+
+        user = get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'admin')
+        self.client.force_login(user)
+        url = f'/admin/api/player/{player.id}/change/'
+        data = admin_form_data(self.client.get(url))
+        prefix = next(key[:-len('-minigame')] for key, value in data.items()
+                      if key.endswith('-minigame') and str(value) == str(minigame.id))
+        data[f'{prefix}-score'] = 50
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(leaderboard.minigame_top_players(minigame)[0]['score'], 50)
+
+
+def admin_form_data(response):
+    # Данные формы изменения в админке с текущими значениями полей
+    forms = [response.context['adminform'].form]
+    for inline in response.context['inline_admin_formsets']:
+        forms += [inline.formset.management_form, *inline.formset.forms]
+    data = {}
+    for form in forms:
+        for field in form:
+            value = field.value()
+            if value is None or value is False:
+                continue
+            data[field.html_name] = value
+    return data
+
+
+@override_settings(LEADERBOARD_SHARED_PATH='')
+class SharedLeaderboardTests(TransactionTestCase):
+    # Загрузка рейтинга идёт вне транзакции, как при запуске контейнера
+    def setUp(self):
+        # Справочники пусты: кэш прошлых тестов сбрасывается
+        cache.clear()
+        clear_catalog()
+        self.players = [
+            Player.objects.create(name=f'player{index}', top_score=index * 10)
+            for index in range(PLAYERS)
+        ]
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = Path(directory.name) / 'leaderboard.bin'
+        self.enterContext(override_settings(LEADERBOARD_SHARED_PATH=str(path)))
+        self.enterContext(mock.patch.object(shared_leaderboard, '_engine', None))
+
+    def test_loaded_by_command_only(self):
+        # Запросы не загружают рейтинг, пока его не загрузит команда
+        player = self.players[5]
+        response = APIClient().get(f'/api/v1/liderboard/{player.id}/around/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(shared_leaderboard.get_shared_leaderboard())
+
+        call_command('rebuild_leaderboard', stdout=StringIO())
+        engine = shared_leaderboard.get_shared_leaderboard()
+        self.assertIsNotNone(engine)
+        self.assertEqual(engine.place(player.id), PLAYERS - 5)
+
+    @override_settings(LEADERBOARD_DB_PLACE_LIMIT=3)
+    def test_deep_place_needs_shared_leaderboard(self):
+        # Запрос к базе считает не больше LEADERBOARD_DB_PLACE_LIMIT игроков выше
+        client = APIClient()
+        top, deep = self.players[-2], self.players[2]
+        self.assertEqual(leaderboard.player_place(top), 2)
+        for url in ('ranking', 'around'):
+            with self.assertLogs(leaderboard.logger, 'ERROR'):
+                response = client.get(f'/api/v1/liderboard/{deep.id}/{url}/')
+            self.assertEqual(response.status_code, 503)
+
+        call_command('rebuild_leaderboard', stdout=StringIO())
+        response = client.get(f'/api/v1/liderboard/{deep.id}/around/')
+        self.assertEqual(response.json()['place'], PLAYERS - 2)
+
+    def test_not_loaded_inside_transaction(self):
+        engine = shared_leaderboard.shared_leaderboard_engine()
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            shared_leaderboard.load_from_db(engine)
+
+
+class PlayerTotalsTests(ApiTestCase):
+    def test_reconcile_creates_missing_row(self):
+        PlayerTotals.objects.all().delete()
+        totals = stats.player_totals()
+        self.assertEqual((totals.total_players, totals.review_count),
+                         (PLAYERS, PLAYERS))
+
+    def test_reconcile_after_concurrent_create(self):
+        # Строку успел создать параллельный запрос: пересчёт её перезаписывает
+        PlayerTotals.objects.all().delete()
+        PlayerTotals.objects.create(pk=stats.TOTALS_PK)
+        self.assertEqual(stats.reconcile_totals().total_players, PLAYERS)
+
+
+@override_settings(CATALOG_VERSION_CHECK_INTERVAL=0, PLAYER_PROGRESS_STORAGE='tables')
+class ProgressBackfillTests(ApiTestCase):
+    def test_players_committed_behind_the_pass_get_rows(self):
+        # Основной проход уже миновал игроков, зафиксированных позже:
+        # их строки вставляет проверочный проход
+        minigame = Minigame.objects.get(name='gameOne')
+        PlayerMinigame.objects.filter(minigame=minigame).delete()
+        job = ProgressBackfill.objects.create(
+            catalog='minigame', catalog_id=minigame.id,
+            last_player_id=self.players[PLAYERS // 2].id)
+
+        job = backfill.run_backfill(job.id, chunk_size=5, pause=0)
+        self.assertIsNotNone(job.finished_at)
+        self.assertEqual(PlayerMinigame.objects.filter(minigame=minigame).count(),
+                         PLAYERS)
+
+
+class RenderedCatalogTests(ApiTestCase):
+    url = '/api/v1/equipment/'
+
+    def get(self, **headers):
+        return self.client.get(self.url, HTTP_ACCEPT='application/json', **headers)
+
+    def test_encoding_variants(self):
+        identity = self.get()
+        self.assertEqual(identity.status_code, 200)
+        self.assertNotIn('Content-Encoding', identity)
+        self.assertIn('Accept-Encoding', identity['Vary'])
+        self.assertEqual(json.loads(identity.content)[0]['name'], 'software')
+
+        compressed = self.get(HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(compressed.content), identity.content)
+        self.assertEqual(compressed['ETag'], identity['ETag'][:-1] + '-gzip"')
+        self.assertIn('Accept-Encoding', compressed['Vary'])
+
+        refused = self.get(HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertNotIn('Content-Encoding', refused)
+
+    def test_brotli_is_preferred(self):
+        brotli = mock.Mock(compress=lambda raw: b'br' + raw)
+        with mock.patch.object(rendered, 'brotli', brotli):
+            clear_catalog()
+            response = self.get(HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertTrue(response['ETag'].endswith('-br"'))
+
+    def test_not_modified(self):
+        etag = self.get(HTTP_ACCEPT_ENCODING='gzip')['ETag']
+        # Тег любого варианта подходит для любой кодировки
+        for encoding in ('', 'gzip'):
+            response = self.get(HTTP_IF_NONE_MATCH=etag,
+                                HTTP_ACCEPT_ENCODING=encoding)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, b'')
+            self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_etag_changes_with_catalog_version(self):
+        etag = self.get()['ETag']
+        # Изменение без сигналов сохранения видно после новой версии справочников
+        with self.captureOnCommitCallbacks(execute=True):
+            Equipment.objects.filter(name='software').update(description='new')
+            bump_catalog_version()
+
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(json.loads(response.content)[0]['description'], 'new')
+
+
+class LoadDataTests(ApiTestCase):
+    # loaddata над копиями файлов справочников
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        catalogs = []
+        for model, path, update_fields in loaddata.CATALOGS:
+            copy = Path(directory.name) / path.name
+            copy.write_bytes(path.read_bytes())
+            catalogs.append((model, copy, update_fields))
+        patcher = mock.patch.object(loaddata, 'CATALOGS', tuple(catalogs))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.files = {model: path for model, path, _ in catalogs}
+
+    def add_minigame(self, name):
+        path = self.files[Minigame]
+        data = json.loads(path.read_text())
+        data.append({'name': name, 'description': name, 'achievement': name})
+        path.write_text(json.dumps(data))
+
+    def load(self, *args):
+        output = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('loaddata', *args, stdout=output)
+        return output.getvalue()
+
+    def test_unchanged_files_are_skipped(self):
+        version = CatalogVersion.objects.get(pk=VERSION_PK).version
+        with self.assertNumQueries(1):
+            output = self.load()
+        self.assertIn('Common data unchanged', output)
+        self.assertEqual(CatalogVersion.objects.get(pk=VERSION_PK).version, version)
+
+    def test_force_reloads(self):
+        version = CatalogVersion.objects.get(pk=VERSION_PK).version
+        ids = list(Minigame.objects.order_by('id').values_list('id', flat=True))
+        output = self.load('--force')
+        self.assertIn('Minigame: 5 items loaded, 0 new, 0 updated', output)
+        self.assertEqual(CatalogVersion.objects.get(pk=VERSION_PK).version, version + 1)
+        self.assertEqual(
+            list(Minigame.objects.order_by('id').values_list('id', flat=True)), ids)
+
+    def test_changed_file_is_loaded(self):
+        path = self.files[Minigame]
+        data = json.loads(path.read_text())
+        data[0]['achievement'] = 'changed'
+        path.write_text(json.dumps(data))
+        output = self.load()
+        self.assertIn('Minigame: 5 items loaded, 0 new, 1 updated', output)
+        self.assertEqual(Minigame.objects.get(name=data[0]['name']).achievement,
+                         'changed')
+
+        self.add_minigame('gameNew')
+        output = self.load()
+        self.assertIn('Created Minigame: gameNew', output)
+        self.assertEqual(Minigame.objects.get(name='gameNew').id,
+                         Minigame.objects.order_by('-id')[1].id + 1)
+        self.assertIn('Common data unchanged', self.load())
+
+    def test_new_catalog_row_is_left_to_backfill_command(self):
+        # Поток в процессе команды был бы прерван при её завершении
+        self.add_minigame('gameNew')
+        with mock.patch.object(backfill, 'start_backfill') as start, \
+                self.captureOnCommitCallbacks(execute=True):
+            call_command('loaddata', stdout=StringIO())
+        start.assert_not_called()
+        job = ProgressBackfill.objects.get(
+            catalog='minigame', catalog_id=Minigame.objects.get(name='gameNew').id)
+        self.assertIsNone(job.finished_at)
+
+
+class FastUpdateTests(ApiTestCase):
+    # PUT/PATCH в JSON проверяются и выводятся без сериализаторов DRF
+    update = {
+        'own_coins': 500,
+        'equipment': {'software': {'available': True}},
+        'minigame': {'gameOne': {'available': True, 'score': 40, 'achievement': True}},
+    }
+
+    def test_response_matches_serializer(self):
+        player = self.players[2]
+        response = self.client.patch(
+            f'/api/v1/player/{player.id}/', self.update, format='json')
+        self.assertEqual(response.status_code, 200)
+        expected = PlayerSerializer(Player.objects.with_progress().get(pk=player.id))
+        self.assertEqual(response.content, JSONRenderer().render(expected.data))
+
+    def test_sparse_fields_do_not_apply_to_writes(self):
+        # Игрок читается целиком, ?fields= не добавляет запросов
+        player = self.players[2]
+        url = f'/api/v1/player/{player.id}/'
+        with CaptureQueriesContext(connection) as full:
+            self.client.patch(url, {'own_money': 1}, format='json')
+        with self.assertNumQueries(len(full)):
+            response = self.client.patch(
+                f'{url}?fields=name', {'own_money': 2}, format='json')
+        self.assertIn('equipment', response.json())
+
+    def test_progress_errors_are_keyed_by_name(self):
+        player = self.players[2]
+        response = self.client.patch(f'/api/v1/player/{player.id}/', {
+            'equipment': {'unknown': {'available': True}},
+            'minigame': {'gameOne': {'available': True, 'score': 'many'}},
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()
+        self.assertEqual(list(errors['equipment']['unknown']), ['equipment_name'])
+        self.assertEqual(list(errors['minigame']['gameOne']), ['score'])
+
+
+class FastReadTests(ApiTestCase):
+    # JSON-ответы без сериализаторов совпадают с ответами сериализаторов
+    urls = (
+        '/api/v1/player/',
+        '/api/v1/player/?fields=id,name,own_coins',
+        '/api/v1/player/?include=minigame,harvest',
+        '/api/v1/player/?fields=name&include=equipment',
+        '/api/v1/player/{id}/',
+        '/api/v1/player/{id}/?fields=own_coins&include=minigame',
+        '/api/v1/liderboard/',
+        '/api/v1/liderboard/all/',
+        '/api/v1/liderboard/{id}/around/',
+    )
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        player = cls.players[7]
+        APIClient().patch(f'/api/v1/player/{player.id}/', {
+            'user_review': None,
+            'equipment': {'software': {'available': True}},
+            'harvest': {'tomatos': {'available': True, 'harvest_amount': 3}},
+            'minigame': {'gameTwo': {'available': True, 'score': 70,
+                                     'achievement': True}},
+        }, format='json')
+
+    def serializer_leaderboard_data(self, players):
+        return LeaderboardPlayerSerializer(players, many=True).data
+
+    def assert_paths_match(self):
+        for url in self.urls:
+            url = url.format(id=self.players[7].id)
+            with self.subTest(url=url):
+                fast = self.client.get(url)
+                self.assertEqual(fast.status_code, 200)
+                with mock.patch.object(PlayerViewSet, 'fast_response',
+                                       return_value=False), \
+                        mock.patch('api.views.liderboard.leaderboard_data',
+                                   self.serializer_leaderboard_data):
+                    slow = self.client.get(url)
+                self.assertEqual(fast.content, slow.content)
+
+    def test_progress_tables(self):
+        player = self.client.get(f'/api/v1/player/{self.players[7].id}/').json()
+        self.assertEqual(player['minigame']['gameTwo']['score'], 70)
+        self.assert_paths_match()
+
+    def test_packed_progress(self):
+        with override_settings(PLAYER_PROGRESS_STORAGE='packed'):
+            call_command('pack_progress', stdout=StringIO())
+            self.assert_paths_match()
@@ -5,7 +5,9 @@ from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.viewsets import ReadOnlyModelViewSet
 
+from ..catalog import catalog_row, catalog_rows
 from ..models import Equipment
+from ..rendered import catalog_body, rendered_response
 from ..serializers import EquipmentSerializer
 
 
@@ -53,7 +55,8 @@ class EquipmentViewSet(ReadOnlyModelViewSet):
                         value={
                             "id": 1,
                             "name": "software",
-                            "description": "Собирает и обрабатывает информацию о растениях и почве"
+                            "description": ("Собирает и обрабатывает информацию "
+                                            "о растениях и почве")
                         }
 
                     )
@@ -63,7 +66,11 @@ class EquipmentViewSet(ReadOnlyModelViewSet):
         }
     )
     def list(self, request):
-        serializer = self.serializer_class(self.queryset, many=True)
+        # JSON-ответ отдаётся готовым телом, browsable API - сериализатором
+        if request.accepted_renderer.format == 'json':
+            return rendered_response(
+                request, catalog_body(Equipment, self.serializer_class))
+        serializer = self.serializer_class(catalog_rows(Equipment), many=True)
         return Response(serializer.data)
 
     @extend_schema(
@@ -83,11 +90,10 @@ class EquipmentViewSet(ReadOnlyModelViewSet):
         }
     )
     def retrieve(self, request, *args, **kwargs):
-        try:
-            instance = self.get_object()
-            serializer = self.get_serializer(instance)
-            return Response(serializer.data)
-        except Equipment.DoesNotExist:
+        # Справочник читается из кэша процесса (api/catalog.py)
+        pk = self.kwargs['pk']
+        instance = catalog_row(Equipment, int(pk)) if pk.isdigit() else None
+        if instance is None:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        except Exception as e:
-            return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        serializer = self.get_serializer(instance)
+        return Response(serializer.data)
@@ -1,16 +1,25 @@
-from drf_spectacular.utils import OpenApiExample
+from drf_spectacular.utils import OpenApiExample, OpenApiParameter
 from drf_spectacular.openapi import OpenApiResponse
 from rest_framework import status
 from drf_spectacular.views import extend_schema
 from rest_framework.response import Response
 from rest_framework.viewsets import ReadOnlyModelViewSet
+from django.http import Http404
+from django.utils.dateparse import parse_date
 from rest_framework.views import APIView
 from rest_framework.decorators import action
 from rest_framework.exceptions import ValidationError
-from django.db.models import Avg
 
-from ..models import Player
-from ..serializers import PlayerSerializer, LeaderboardPlayerSerializer, PlayerMinigameSerializer
+from ..catalog import catalog_row_named
+from ..leaderboard import (minigame_place, minigame_top_players,
+                           player_minigame_progress, player_place, players_around,
+                           ranking, top_players)
+from ..models import Minigame, Player, ScoreRollup
+from ..pagination import LeaderboardCursorPagination
+from ..representation import leaderboard_data
+from ..score_history import window_top_players
+from ..serializers import PlayerSerializer, LeaderboardPlayerSerializer
+from ..stats import player_totals
 
 
 class LiderboardView(ReadOnlyModelViewSet):
@@ -40,9 +49,13 @@ class LiderboardView(ReadOnlyModelViewSet):
     }
 
     def get_queryset(self):
-        queryset = Player.objects.filter(
-            top_score__gt=0).order_by('-top_score')[:100]
-        return queryset
+        return top_players()
+
+    def serialize_players(self, players):
+        # JSON-ответ собирается без полей сериализатора, browsable API - сериализатором
+        if self.request.accepted_renderer.format == 'json':
+            return leaderboard_data(players)
+        return self.serializer_class(players, many=True).data
 
     @extend_schema(
         summary='Получить 100 лучших игроков по очкам',
@@ -97,22 +110,20 @@ class LiderboardView(ReadOnlyModelViewSet):
     )
     def list(self, request):
         queryset = self.get_queryset()
-        
-        total_players = Player.objects.count()
-        players_with_reviews = Player.objects.exclude(user_review=None).count()
-        average_review = Player.objects.exclude(user_review=None).aggregate(Avg('user_review'))['user_review__avg']
+        totals = player_totals()
+
+        average_review = totals.average_review
 
         if average_review is None:
             average_review = 0.0 
             
         data = {
-            "total_players": total_players,
-            "players_with_reviews": players_with_reviews,
+            "total_players": totals.total_players,
+            "players_with_reviews": totals.review_count,
             "average_review": average_review,
         }
 
-        serializer = self.serializer_class(queryset, many=True)
-        serialized_data = serializer.data
+        serialized_data = self.serialize_players(queryset)
         
         response_data = {
             "total_players": data['total_players'],
@@ -185,7 +196,12 @@ class LiderboardView(ReadOnlyModelViewSet):
                         }]
                     )
                 ]),
-            **common_minigame_status_codes
+            **common_minigame_status_codes,
+            status.HTTP_503_SERVICE_UNAVAILABLE: OpenApiResponse(
+                response=None,
+                description='Место игрока ниже LEADERBOARD_DB_PLACE_LIMIT, '
+                            'рейтинг в разделяемой памяти не загружен'
+            ),
         })
     @action(detail=True, methods=['get'], url_path='ranking')
     def get_player_leaderboard(self, request, pk=None):
@@ -196,39 +212,338 @@ class LiderboardView(ReadOnlyModelViewSet):
             raise ValidationError("Player ID должен быть целым числом")
 
         try:
-            player = Player.objects.get(id=pk)
+            player = Player.objects.for_leaderboard().get(id=pk)
         except Player.DoesNotExist:
             return Response({"error": "Player not found"}, status=404)
 
         queryset = self.get_queryset()
-        serializer_board = self.serializer_class(queryset, many=True)
-
-        players = Player.objects.order_by('-top_score')
-
-        player_rank = list(players).index(player) + 1
+        leaderboard = self.serialize_players(queryset)
 
-        serializer_game = PlayerMinigameSerializer(
-            player.playerminigame_set.all(), many=True)
-        minigame_data = serializer_game.data
-
-        achievement_count = sum(
-            1 for game in minigame_data if game.get("achievement", False))
+        player_rank = player_place(player)
+        if player_rank is None:
+            return Response({"error": "Leaderboard place is unavailable"},
+                            status=503)
 
         response_data = {
             "player_id": player.id,
             "player_name": player.name,
             "place": player_rank,
-            "achievement_count": achievement_count,
+            "achievement_count": player.achievement_count,
             "own_coins": player.own_coins,
             "top_score": player.top_score,
             "user_review": player.user_review,
-            "total_players": players.count(),
-            "liderdoard": serializer_board.data
+            "total_players": player_totals().total_players,
+            "liderdoard": leaderboard
         }
 
         return Response(response_data)
-    
-    
+
+    @extend_schema(
+        summary='Игроки рядом с игроком в таблице лидеров',
+        tags=['Liderboard'],
+        description="""
+            Игрок и его соседи по рейтингу: k игроков выше и k игроков ниже.
+
+            Параметры запроса:
+                id - идентификатор игрока
+                k - количество соседей с каждой стороны (по умолчанию 5, максимум 50)
+                GET /api/v1/liderboard/{id}/around/?k=5
+            """,
+        parameters=[
+            OpenApiParameter('k', int,
+                             description='Количество соседей с каждой стороны'),
+        ],
+        responses={
+            status.HTTP_200_OK: OpenApiResponse(
+                response=LeaderboardPlayerSerializer(many=True),
+                description='Ответ получен',
+                examples=[
+                    OpenApiExample(
+                        name='Соседи по рейтингу',
+                        value={
+                            "player_id": 6,
+                            "place": 2,
+                            "liderdoard": [
+                                {
+                                    "place": 1,
+                                    "name": "Top_player",
+                                    "own_coins": 0,
+                                    "own_money": 0,
+                                    "user_review": 5,
+                                    "top_score": 800,
+                                    "achievement": {
+                                        "gameOne": {
+                                            "achievement": False
+                                        }
+                                    },
+                                },
+                                {
+                                    "place": 2,
+                                    "name": "Doom Guy 3",
+                                    "own_coins": 0,
+                                    "own_money": 0,
+                                    "user_review": 5,
+                                    "top_score": 500,
+                                    "achievement": {
+                                        "gameOne": {
+                                            "achievement": True
+                                        }
+                                    },
+                                }
+                            ]
+                        }
+                    )
+                ]),
+            **common_minigame_status_codes,
+            status.HTTP_503_SERVICE_UNAVAILABLE: OpenApiResponse(
+                response=None,
+                description='Место игрока ниже LEADERBOARD_DB_PLACE_LIMIT, '
+                            'рейтинг в разделяемой памяти не загружен'
+            ),
+        })
+    @action(detail=True, methods=['get'], url_path='around')
+    def get_players_around(self, request, pk=None):
+
+        try:
+            pk = int(pk)
+            count = min(max(int(request.query_params.get('k', 5)), 0), 50)
+        except ValueError:
+            raise ValidationError("Player ID и k должны быть целыми числами")
+
+        try:
+            player = Player.objects.for_leaderboard().get(id=pk)
+        except Player.DoesNotExist:
+            return Response({"error": "Player not found"}, status=404)
+
+        place = player_place(player)
+        if place is None:
+            return Response({"error": "Leaderboard place is unavailable"},
+                            status=503)
+        above, below = players_around(player, count)
+
+        leaderboard_data = self.serialize_players([*above, player, *below])
+        for item_place, item in enumerate(leaderboard_data, start=place - len(above)):
+            item['place'] = item_place
+
+        response_data = {
+            "player_id": player.id,
+            "place": place,
+            "liderdoard": leaderboard_data,
+        }
+
+        return Response(response_data)
+
+    @extend_schema(
+        summary='Полный рейтинг игроков с постраничным обходом',
+        tags=['Liderboard'],
+        description="""
+            Все игроки в порядке таблицы лидеров, страницами по курсору.
+            Ссылка на следующую страницу возвращается в поле next.
+
+            Параметры запроса:
+                limit - размер страницы (по умолчанию 100, максимум 500)
+                cursor - курсор из ссылки next
+                GET /api/v1/liderboard/all/?limit=100
+            """,
+        parameters=[
+            OpenApiParameter('limit', int, description='Размер страницы'),
+            OpenApiParameter('cursor', str, description='Курсор следующей страницы'),
+        ],
+        responses={
+            status.HTTP_200_OK: OpenApiResponse(
+                response=LeaderboardPlayerSerializer(many=True),
+                description='Ответ получен',
+                examples=[
+                    OpenApiExample(
+                        name='Страница рейтинга',
+                        value={
+                            "place": 1,
+                            "name": "Top_player",
+                            "own_coins": 0,
+                            "own_money": 0,
+                            "user_review": 5,
+                            "top_score": 800,
+                            "achievement": {
+                                "gameOne": {
+                                    "achievement": False
+                                }
+                            },
+                        }
+                    )
+                ]),
+            **common_minigame_status_codes
+        })
+    @action(detail=False, methods=['get'], url_path='all',
+            pagination_class=LeaderboardCursorPagination)
+    def get_full_ranking(self, request):
+        page = self.paginate_queryset(ranking())
+        return self.get_paginated_response(self.serialize_players(page))
+
+
+    @extend_schema(
+        summary='Получить 100 лучших игроков мини-игры',
+        tags=['Liderboard'],
+        description="""
+            Список 100 лучших игроков мини-игры по очкам.
+            Ранжирование по атрибуту score в порядке убывания,
+            при равных очках выше игрок с меньшим id.
+
+            Параметр запроса:
+                name - название мини-игры
+                GET /api/v1/liderboard/minigame/{name}/
+            """,
+        responses={
+            status.HTTP_200_OK: OpenApiResponse(
+                response=None,
+                description='Ответ получен',
+                examples=[
+                    OpenApiExample(
+                        name='Лидеры мини-игры',
+                        value={
+                            "minigame": "gameOne",
+                            "liderdoard": [
+                                {
+                                    "place": 1,
+                                    "player_id": 6,
+                                    "name": "Doom Guy",
+                                    "score": 120,
+                                    "achievement": True
+                                }
+                            ]
+                        }
+                    )
+                ]),
+            **common_minigame_status_codes
+        })
+    @action(detail=False, methods=['get'], url_path=r'minigame/(?P<name>[^/.]+)')
+    def get_minigame_leaderboard(self, request, name=None):
+        minigame = catalog_row_named(Minigame, name)
+        if minigame is None:
+            raise Http404
+
+        response_data = {
+            "minigame": minigame.name,
+            "liderdoard": minigame_top_players(minigame),
+        }
+
+        return Response(response_data)
+
+    @extend_schema(
+        summary='Положение игрока в таблице лидеров мини-игры',
+        operation_id='liderboard_minigame_player_retrieve',
+        tags=['Liderboard'],
+        description="""
+            Место игрока в рейтинге мини-игры по очкам.
+
+            Параметры запроса:
+                name - название мини-игры
+                player_id - идентификатор игрока
+                GET /api/v1/liderboard/minigame/{name}/{player_id}/
+            """,
+        responses={
+            status.HTTP_200_OK: OpenApiResponse(
+                response=None,
+                description='Ответ получен',
+                examples=[
+                    OpenApiExample(
+                        name='Место в мини-игре',
+                        value={
+                            "minigame": "gameOne",
+                            "player_id": 6,
+                            "player_name": "Doom Guy",
+                            "place": 3,
+                            "score": 80,
+                            "achievement": False
+                        }
+                    )
+                ]),
+            **common_minigame_status_codes
+        })
+    @action(detail=False, methods=['get'],
+            url_path=r'minigame/(?P<name>[^/.]+)/(?P<player_id>[0-9]+)')
+    def get_minigame_player_place(self, request, name=None, player_id=None):
+        minigame = catalog_row_named(Minigame, name)
+        player_minigame = minigame and player_minigame_progress(minigame, player_id)
+        if player_minigame is None:
+            return Response({"error": "Player not found"}, status=404)
+
+        response_data = {
+            "minigame": player_minigame.minigame.name,
+            "player_id": player_minigame.player_id,
+            "player_name": player_minigame.player.name,
+            "place": minigame_place(player_minigame),
+            "score": player_minigame.score,
+            "achievement": player_minigame.achievement,
+        }
+
+        return Response(response_data)
+
+
+    @extend_schema(
+        summary='Получить лучших игроков за день или неделю',
+        tags=['Liderboard'],
+        description="""
+            Список 100 лучших игроков по очкам, набранным за текущий день (daily)
+            или текущую неделю с понедельника (weekly).
+            Ранжирование по приросту own_coins за период в порядке убывания.
+
+            Параметр запроса:
+                date - дата внутри нужного периода, ГГГГ-ММ-ДД (по умолчанию сегодня)
+                GET /api/v1/liderboard/daily/
+                GET /api/v1/liderboard/weekly/?date=2023-11-20
+            """,
+        parameters=[
+            OpenApiParameter('date', str,
+                             description='Дата внутри периода, ГГГГ-ММ-ДД'),
+        ],
+        responses={
+            status.HTTP_200_OK: OpenApiResponse(
+                response=None,
+                description='Ответ получен',
+                examples=[
+                    OpenApiExample(
+                        name='Лидеры недели',
+                        value={
+                            "period": "week",
+                            "start": "2023-11-20",
+                            "liderdoard": [
+                                {
+                                    "place": 1,
+                                    "player_id": 6,
+                                    "name": "Doom Guy",
+                                    "score": 350
+                                }
+                            ]
+                        }
+                    )
+                ]),
+            **common_minigame_status_codes
+        })
+    @action(detail=False, methods=['get'], url_path=r'(?P<window>daily|weekly)')
+    def get_window_leaderboard(self, request, window=None):
+        period = ScoreRollup.DAY if window == 'daily' else ScoreRollup.WEEK
+
+        day = None
+        if 'date' in request.query_params:
+            try:
+                day = parse_date(request.query_params['date'])
+            except ValueError:
+                # Формат верный, но такой даты нет: 2023-02-30
+                day = None
+            if day is None:
+                raise ValidationError("date должна быть в формате ГГГГ-ММ-ДД")
+
+        bucket, leaders = window_top_players(period, day)
+
+        response_data = {
+            "period": period,
+            "start": bucket,
+            "liderdoard": leaders,
+        }
+
+        return Response(response_data)
+
+
 class PlayerStatistics(APIView):
     @extend_schema(
         summary='Получить данные по игрокам и оценке',
@@ -239,14 +554,17 @@ class PlayerStatistics(APIView):
             """,
     )
     def get(self, request) -> Response:
+        # Агрегаты читаются из одной строки PlayerTotals, без обхода таблицы игроков
+        totals = player_totals()
+
         # Общее количество игроков
-        total_players = Player.objects.count()
+        total_players = totals.total_players
 
         # Количество игроков у которых user_review не равно None
-        players_with_reviews = Player.objects.exclude(user_review=None).count()
+        players_with_reviews = totals.review_count
 
         # Средняя оценка игроков с user_review не равным None
-        average_review = Player.objects.exclude(user_review=None).aggregate(Avg('user_review'))['user_review__avg']
+        average_review = totals.average_review
 
         if players_with_reviews < 10:
             average_review = 5
@@ -5,7 +5,9 @@ from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.viewsets import ReadOnlyModelViewSet
 
+from ..catalog import catalog_row, catalog_rows
 from ..models import Minigame
+from ..rendered import catalog_body, rendered_response
 from ..serializers import MinigameSerializer
 
 
@@ -60,7 +62,11 @@ class MinigameViewSet(ReadOnlyModelViewSet):
         }
     )
     def list(self, request, *args, **kwargs):
-        serializer = self.get_serializer(self.queryset, many=True)
+        # JSON-ответ отдаётся готовым телом, browsable API - сериализатором
+        if request.accepted_renderer.format == 'json':
+            return rendered_response(
+                request, catalog_body(Minigame, self.serializer_class))
+        serializer = self.serializer_class(catalog_rows(Minigame), many=True)
         return Response(serializer.data)
 
     @extend_schema(
@@ -80,13 +86,12 @@ class MinigameViewSet(ReadOnlyModelViewSet):
         }
     )
     def retrieve(self, request, *args, **kwargs):
-        try:
-            instance = self.get_object()
-            serializer = self.get_serializer(instance)
-            return Response(serializer.data)
-        except Minigame.DoesNotExist:
+        # Справочник читается из кэша процесса (api/catalog.py)
+        pk = self.kwargs['pk']
+        instance = catalog_row(Minigame, int(pk)) if pk.isdigit() else None
+        if instance is None:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        except Exception as e:
-            return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        serializer = self.get_serializer(instance)
+        return Response(serializer.data)
 
     
\ No newline at end of file
@@ -1,14 +1,27 @@
+from django.db import transaction
 from django.shortcuts import get_object_or_404
 from drf_spectacular.openapi import OpenApiResponse
-from drf_spectacular.utils import OpenApiExample
+from drf_spectacular.utils import OpenApiExample, OpenApiParameter
 from drf_spectacular.views import extend_schema
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
 from rest_framework.decorators import action
 
-from ..models import Player
-from ..serializers import PlayerSerializer
+from ..batch import apply_batch
+from ..economy import increment_player
+from ..leaderboard import invalidate_minigame_leaderboards
+from ..models import Player, packed_progress
+from ..pagination import PlayerCursorPagination
+from ..progress import patch_progress_lists, reset_player
+from ..payload import validate_update
+from ..representation import player_data, player_values, players_data
+from ..serializers import (PLAYER_NESTED_FIELDS, PlayerBatchSerializer,
+                           PlayerIncrementSerializer, PlayerSerializer,
+                           PlayerSyncSerializer, update_player)
+from ..sync import changes_since, progress_lists
+from ..write_behind import get_write_behind_buffer
 
 common_value={
     "id": 1,
@@ -72,7 +85,8 @@ common_value={
             "complete": False,
             "score": 0
         }
-    }}
+    },
+    "version": 0}
 
 common_player_status_codes = {
     status.HTTP_200_OK: OpenApiResponse(
@@ -108,26 +122,128 @@ common_player_status_codes = {
 }
 
 
+SPARSE_FIELDS_PARAMETER = OpenApiParameter(
+    'fields', str, description='Поля игрока через запятую, например id,name,own_coins')
+SPARSE_INCLUDE_PARAMETER = OpenApiParameter(
+    'include', str,
+    description='Разделы прогресса через запятую: equipment, harvest, minigame')
+
+
+def split_param(value):
+    return [name for name in (value or '').split(',') if name]
+
+
+def parse_sparse_fields(params):
+    if 'fields' not in params and 'include' not in params:
+        return None
+
+    all_fields = PlayerSerializer.Meta.fields
+    fields = split_param(params.get('fields')) or [
+        name for name in all_fields if name not in PLAYER_NESTED_FIELDS]
+    include = split_param(params.get('include'))
+
+    errors = {}
+    unknown = [name for name in fields if name not in all_fields]
+    if unknown:
+        errors['fields'] = [f'Неизвестные поля: {", ".join(unknown)}']
+    unknown = [name for name in include if name not in PLAYER_NESTED_FIELDS]
+    if unknown:
+        errors['include'] = [f'Неизвестные разделы: {", ".join(unknown)}']
+    if errors:
+        raise ValidationError(errors)
+
+    return {*fields, *include}
+
+
 class PlayerViewSet(ModelViewSet):
     queryset = Player.objects.all()
     serializer_class = PlayerSerializer
 
-    def get_object(self):
-        queryset = self.filter_queryset(self.get_queryset())
+    pagination_class = PlayerCursorPagination
+
+    def get_queryset(self):
+        # Вложенный прогресс игроков подгружается заранее, без запроса на каждого
+        fields = self.sparse_fields()
+        if fields is None:
+            return Player.objects.with_progress()
+
+        # Выборочный вывод: читаются только нужные колонки и разделы прогресса
+        sections = [name for name in PLAYER_NESTED_FIELDS if name in fields]
+        columns = {'id', *(name for name in fields if name not in PLAYER_NESTED_FIELDS)}
+        if sections and packed_progress():
+            columns.add('progress')
+        queryset = Player.objects.only(*columns)
+        return queryset.with_progress(sections) if sections else queryset
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('fields', self.sparse_fields())
+        return super().get_serializer(*args, **kwargs)
+
+    def sparse_fields(self):
+        # Поля ответа из ?fields= (поля игрока) и ?include= (разделы прогресса).
+        # Без параметров выводятся все поля. Только для чтения игроков.
+        if self.action not in ('list', 'retrieve'):
+            return None
+        if not hasattr(self, '_sparse_fields'):
+            self._sparse_fields = parse_sparse_fields(self.request.query_params)
+        return self._sparse_fields
+
+    def fast_response(self):
+        # JSON-запросы обходятся без сериализаторов (api/payload.py,
+        # api/representation.py), browsable API работает через них
+        return self.request.accepted_renderer.format == 'json'
+
+    def get_object(self, queryset=None):
+        # Запись читает игрока целиком через queryset=Player.objects.with_progress():
+        # строка с отложенными колонками ?fields= дочитывала бы их по одной
+        queryset = self.filter_queryset(
+            self.get_queryset() if queryset is None else queryset)
         obj = get_object_or_404(queryset, pk=self.kwargs['pk'])
         self.check_object_permissions(self.request, obj)
         return obj
 
+    # Изменения игрока и связанных агрегатов сохраняются в одной транзакции
+    def perform_create(self, serializer):
+        with transaction.atomic():
+            serializer.save()
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            instance.delete()
+
     @extend_schema(
         summary='Получение списка всех объектов класса "Игрок"',
         tags=['Player'],
         description="""
-        Получение списка всех игроков.
-        В ответе будет получен полный список объектов класса "Игрок".
+        Получение списка всех игроков постранично, по возрастанию id.
+        В ответе будет получена страница объектов класса "Игрок"
+        и ссылка next на следующую страницу (null на последней).
+
+        Параметры запроса:
+            limit - размер страницы (по умолчанию 100, максимум 500)
+            cursor - курсор из ссылки next
+            fields - поля игрока через запятую (по умолчанию все)
+            include - разделы прогресса через запятую: equipment, harvest, minigame
+
+        Если указан fields или include, разделы прогресса выводятся
+        только перечисленные, остальные не читаются из базы.
+            GET /api/v1/player/?fields=id,name,own_coins&include=minigame
         """,
+        parameters=[
+            OpenApiParameter('limit', int, description='Размер страницы'),
+            OpenApiParameter('cursor', str, description='Курсор следующей страницы'),
+            SPARSE_FIELDS_PARAMETER,
+            SPARSE_INCLUDE_PARAMETER,
+        ],
         request=PlayerSerializer,
         responses=common_player_status_codes)
     def list(self, request, *args, **kwargs):
+        if self.fast_response():
+            fields = self.sparse_fields()
+            page = self.paginate_queryset(
+                player_values(self.filter_queryset(Player.objects.all()), fields))
+            return self.get_paginated_response(players_data(page, fields))
+
         queryset = self.filter_queryset(self.get_queryset())
         page = self.paginate_queryset(queryset)
         if page is not None:
@@ -195,8 +311,11 @@ class PlayerViewSet(ModelViewSet):
             id - идентификатор игрока
             GET /api/v1/players/{id}
 
+        Необязательные fields и include работают как в списке игроков.
+
         В ответе будет получен объект класса "Игрок".
         """,
+        parameters=[SPARSE_FIELDS_PARAMETER, SPARSE_INCLUDE_PARAMETER],
         responses=common_player_status_codes,
         examples=[
             OpenApiExample(
@@ -207,6 +326,13 @@ class PlayerViewSet(ModelViewSet):
         ],
     )
     def retrieve(self, request, *args, **kwargs):
+        if self.fast_response():
+            fields = self.sparse_fields()
+            row = get_object_or_404(
+                player_values(self.filter_queryset(Player.objects.all()), fields),
+                pk=self.kwargs['pk'])
+            return Response(players_data([row], fields)[0])
+
         instance = self.get_object()
         serializer = self.get_serializer(instance)
         return Response(serializer.data)
@@ -226,7 +352,7 @@ class PlayerViewSet(ModelViewSet):
         responses={**common_player_status_codes}
     )
     def destroy(self, request, *args, **kwargs):
-        instance = instance = self.get_object()
+        instance = instance = self.get_object(Player.objects.with_progress())
         self.perform_destroy(instance)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -243,7 +369,8 @@ class PlayerViewSet(ModelViewSet):
 
             В теле запроса полная информация об игроке, со всеми полями как в ответе.
 
-            В ответе будет получен статус-код выполненого запроса и объект класса "Игрок".
+            В ответе будет получен статус-код выполненого запроса
+            и объект класса "Игрок".
             """,
         responses=common_player_status_codes,
         examples=[
@@ -256,52 +383,16 @@ class PlayerViewSet(ModelViewSet):
     )
     def update(self, request, *args, **kwargs):
         partial = kwargs.pop('partial', False)
-        instance = self.get_object()
+        instance = self.get_object(Player.objects.with_progress())
+
+        if self.fast_response():
+            # Тело проверяется без сериализатора и сразу записывается
+            update_player(instance, validate_update(instance, request.data, partial))
+            return Response(player_data(instance))
+
         data = request.data
 
-        # Преобразование equipment из словаря в список только если есть данные
-        equipment_data = data.get('equipment')
-        if equipment_data is not None:
-            equipment_data = [
-                {
-                    'equipment_name': equipment_name,
-                    'available': equipment_info['available']
-                }
-                for equipment_name, equipment_info in equipment_data.items()
-                if 'available' in equipment_info
-            ]
-            data['equipment'] = equipment_data
-
-        # Преобразование harvest из словаря в список только если есть данные
-        harvest_data = data.get('harvest')
-        if harvest_data is not None:
-            harvest_data = [
-                {
-                    'harvest_name': harvest_name,
-                    'harvest_amount': harvest_info.get('harvest_amount', 0),
-                    'available': harvest_info['available'],
-                    'gen_modified': harvest_info.get('gen_modified', False)
-                }
-                for harvest_name, harvest_info in harvest_data.items()
-                if 'available' in harvest_info
-            ]
-            data['harvest'] = harvest_data
-
-        # Преобразование minigame из словаря в список только если есть данные
-        minigame_data = data.get('minigame')
-        if minigame_data is not None:
-            minigame_data = [
-                {
-                    'minigame_name': minigame_name,
-                    'available': minigame_info['available'],
-                    'complete': minigame_info.get('complete', False),
-                    'score': minigame_info.get('score', 0),
-                    'achievement': minigame_info.get('achievement', False)
-                }
-                for minigame_name, minigame_info in minigame_data.items()
-                if 'available' in minigame_info
-            ]
-            data['minigame'] = minigame_data
+        patch_progress_lists(data)
 
         serializer = self.get_serializer(
             instance, data=data, partial=partial)
@@ -338,7 +429,11 @@ class PlayerViewSet(ModelViewSet):
                 },
             }   
 
-            В ответе будет получен статус-код выполненого запроса и объект класса "Игрок".
+            Ошибки в разделах прогресса возвращаются по названиям записей:
+            {"minigame": {"gameOne": {"score": ["A valid integer is required."]}}}
+
+            В ответе будет получен статус-код выполненого запроса
+            и объект класса "Игрок".
             """,
         responses=common_player_status_codes,
         examples=[
@@ -365,31 +460,255 @@ class PlayerViewSet(ModelViewSet):
         responses=common_player_status_codes)
     @action(detail=True, methods=['get'], url_path='newgame')
     def reset_to_default(self, request, pk=None):
-        player = self.get_object()
-
-        # Обновление полей смежной модели PlayerEquipment
-        for equipment in player.playerequipment_set.all():
-            equipment.available = False
-            equipment.save()
-
-        # Обновление полей смежной модели PlayerHarvest
-        for harvest in player.playerharvest_set.all():
-            harvest.available = False
-            harvest.gen_modified = False
-            harvest.save()
-
-        # Обновление полей смежной модели PlayerMinigame
-        for minigame in player.playerminigame_set.all():
-            minigame.available = False
-            minigame.complete = False
-            minigame.achievement = False
-            minigame.score = 0
-            minigame.save()
-
-        player.own_money = Player._meta.get_field('own_money').get_default()
-        player.own_coins = Player._meta.get_field('own_coins').get_default()
-        player.credit = Player._meta.get_field('credit').get_default()
-        player.save()
+        player = self.get_object(Player.objects.with_progress())
+
+        reset_player(player)
+
+        # Результаты мини-игр обнулены - таблицы лидеров по ним устарели
+        invalidate_minigame_leaderboards()
 
         serializer = PlayerSerializer(player)
         return Response(serializer.data, status=status.HTTP_200_OK)
+
+    @extend_schema(
+        summary='Синхронизация изменений объекта класса "Игрок"',
+        tags=['Player'],
+        description="""
+    Обмен изменениями состояния игрока относительно версии клиента.
+
+    Параметр запроса:
+        id - идентификатор игрока
+        POST /api/v1/player/{id}/sync/
+
+    В теле запроса:
+    - `base_version`: версия состояния, от которой клиент считает изменения
+      (поле `version` в ответах на запросы об игроке).
+    - `changes`: только изменённые поля игрока в формате ответа об игроке.
+      В разделах `equipment`, `harvest`, `minigame` указываются только
+      изменённые поля строк, остальные поля не меняются.
+
+    Если `base_version` совпадает с текущей версией, изменения применяются
+    и в ответе приходит новая версия. Если за это время состояние изменилось
+    на сервере, изменения не применяются: ответ 409 содержит текущую версию
+    и изменения на сервере после `base_version`. Клиент объединяет их
+    со своими и повторяет запрос от новой версии.
+    Запрос без `changes` возвращает изменения после `base_version`.
+    """,
+        request=PlayerSyncSerializer,
+        responses={
+            status.HTTP_200_OK: OpenApiResponse(
+                response=None,
+                examples=[
+                    OpenApiExample(
+                        'Изменения применены',
+                        value={'version': 8, 'changes': {}},
+                    ),
+                ],
+                description='Версия состояния и изменения на сервере после base_version'
+            ),
+            status.HTTP_409_CONFLICT: OpenApiResponse(
+                response=None,
+                examples=[
+                    OpenApiExample(
+                        'Конфликт версий',
+                        value={
+                            'error': 'Version conflict',
+                            'version': 9,
+                            'changes': {
+                                'own_coins': 120,
+                                'equipment': {'robot': {'available': True}},
+                            },
+                        },
+                    ),
+                ],
+                description='Состояние изменилось после base_version'
+            ),
+            **{code: response for code, response in common_player_status_codes.items()
+               if code != status.HTTP_200_OK},
+        },
+        examples=[
+            OpenApiExample(
+                name='Изменение очков и оборудования',
+                value={
+                    'base_version': 7,
+                    'changes': {
+                        'own_coins': 150,
+                        'equipment': {'robot': {'available': True}},
+                    },
+                },
+                request_only=True,
+            )
+        ],
+    )
+    @action(detail=True, methods=['post'], url_path='sync')
+    def sync(self, request, pk=None):
+        request_serializer = PlayerSyncSerializer(data=request.data)
+        request_serializer.is_valid(raise_exception=True)
+        base_version = request_serializer.validated_data['base_version']
+        changes = progress_lists(request_serializer.validated_data['changes'])
+
+        with transaction.atomic():
+            # Блокировка строки игрока: версия сравнивается и меняется
+            # без параллельных записей
+            player = get_object_or_404(
+                self.get_queryset().select_for_update(), pk=pk)
+            self.check_object_permissions(request, player)
+
+            if base_version > player.version:
+                raise ValidationError({'base_version': ['Версия новее текущей']})
+
+            if changes and base_version != player.version:
+                return Response({
+                    'error': 'Version conflict',
+                    'version': player.version,
+                    'changes': changes_since(
+                        player, lambda: PlayerSerializer(player).data, base_version),
+                }, status=status.HTTP_409_CONFLICT)
+
+            if changes:
+                serializer = PlayerSerializer(player, data=changes, partial=True)
+                serializer.is_valid(raise_exception=True)
+                serializer.save()
+                base_version = player.version
+
+        return Response({
+            'version': player.version,
+            'changes': changes_since(
+                player, lambda: PlayerSerializer(player).data, base_version),
+        })
+
+    @extend_schema(
+        summary='Пакетное изменение объектов класса "Игрок"',
+        tags=['Player'],
+        description="""
+    Несколько изменений игроков одним запросом.
+
+    POST /api/v1/player/batch/
+
+    В теле запроса упорядоченный список операций `operations`, не более 500.
+    Операция содержит идентификатор игрока `player` и изменения `data`
+    в формате запроса PATCH /api/v1/player/{id}.
+
+    Все операции выполняются в одной транзакции. Операции одного игрока
+    сливаются по порядку и записываются одним обновлением; рекорд и прирост
+    очков за день и неделю те же, что при отдельных запросах PATCH.
+    Ошибка в операции не мешает остальным: в ответе для каждой операции
+    указан статус (200, 400 или 404), а для выполненных - версия
+    состояния игрока `version` после записи пакета. Если изменения игрока
+    не удалось записать, все его операции откатываются и получают статус 500.
+    """,
+        request=PlayerBatchSerializer,
+        responses={
+            status.HTTP_200_OK: OpenApiResponse(
+                response=None,
+                examples=[
+                    OpenApiExample(
+                        'Результаты операций',
+                        value={
+                            'results': [
+                                {'player': 1, 'status': 200, 'version': 11},
+                                {'player': 1, 'status': 200, 'version': 12},
+                                {'player': 7, 'status': 404,
+                                 'error': 'Player not found'},
+                            ]
+                        },
+                    ),
+                ],
+                description='Результаты операций в порядке запроса'
+            ),
+            **{code: response for code, response in common_player_status_codes.items()
+               if code != status.HTTP_200_OK},
+        },
+        examples=[
+            OpenApiExample(
+                name='Пакет изменений',
+                value={
+                    'operations': [
+                        {'player': 1, 'data': {'own_coins': 150}},
+                        {'player': 1, 'data': {
+                            'equipment': {'robot': {'available': True}}}},
+                        {'player': 7, 'data': {'own_money': 300}},
+                    ]
+                },
+                request_only=True,
+            )
+        ],
+    )
+    @action(detail=False, methods=['post'], url_path='batch')
+    def batch(self, request):
+        serializer = PlayerBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        results = apply_batch(serializer.validated_data['operations'])
+        return Response({'results': results})
+
+    @extend_schema(
+        summary='Изменение очков, гринкоинов и кредита игрока на заданные величины',
+        tags=['Player'],
+        description="""
+    Приращение полей `own_coins`, `own_money`, `credit` (отрицательное - уменьшение).
+
+    Параметр запроса:
+        id - идентификатор игрока
+        POST /api/v1/player/{id}/increment/
+
+    Изменение выполняется одним запросом к базе без чтения игрока,
+    поэтому параллельные приращения не теряются. Рекорд `top_score`
+    растёт вместе с `own_coins` в том же запросе.
+
+    В ответе новые значения полей и версия состояния игрока.
+
+    Если включена отложенная запись (PLAYER_WRITE_BEHIND_INTERVAL),
+    приращения накапливаются на сервере и записываются пачкой
+    через заданный интервал. Ответ в этом случае - 202 без новых значений.
+    """,
+        request=PlayerIncrementSerializer,
+        responses={
+            status.HTTP_200_OK: OpenApiResponse(
+                response=None,
+                examples=[
+                    OpenApiExample(
+                        'Новые значения',
+                        value={'own_coins': 150, 'own_money': 900, 'credit': 0,
+                               'top_score': 150, 'version': 13},
+                    ),
+                ],
+                description='Новые значения полей'
+            ),
+            status.HTTP_202_ACCEPTED: OpenApiResponse(
+                response=None,
+                examples=[OpenApiExample('Приращение принято',
+                                         value={'buffered': True})],
+                description='Приращение принято для отложенной записи'
+            ),
+            **{code: response for code, response in common_player_status_codes.items()
+               if code != status.HTTP_200_OK},
+        },
+        examples=[
+            OpenApiExample(
+                name='Покупка за гринкоины',
+                value={'own_coins': 50, 'own_money': -100},
+                request_only=True,
+            )
+        ],
+    )
+    @action(detail=True, methods=['post'], url_path='increment')
+    def increment(self, request, pk=None):
+        serializer = PlayerIncrementSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        values = None
+        if pk.isdigit():
+            buffer = get_write_behind_buffer()
+            if buffer is not None:
+                # Приращение несуществующего игрока не принимается в буфер:
+                # при записи пачки оно было бы потеряно без ответа клиенту
+                if Player.objects.filter(pk=pk).exists():
+                    buffer.add(int(pk), serializer.validated_data)
+                    return Response({'buffered': True},
+                                    status=status.HTTP_202_ACCEPTED)
+            else:
+                values = increment_player(int(pk), serializer.validated_data)
+        if values is None:
+            return Response({"error": "Player not found"},
+                            status=status.HTTP_404_NOT_FOUND)
+        return Response(values)
@@ -0,0 +1,148 @@
+import atexit
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, connection
+
+from .economy import INCREMENT_FIELDS, increment_players
+
+logger = logging.getLogger(__name__)
+
+# Отложенная запись приращений очков, гринкоинов и кредита.
+#
+# Приращения копятся в памяти процесса и суммируются по игрокам,
+# затем записываются пачками (increment_players) раз в
+# PLAYER_WRITE_BEHIND_INTERVAL секунд, при накоплении
+# PLAYER_WRITE_BEHIND_MAX_PLAYERS игроков и при завершении процесса.
+#
+# Гарантии:
+# - до записи приращения не видны в ответах API и таблицах лидеров,
+#   задержка не больше интервала;
+# - при штатной остановке воркера (SIGTERM, перезапуск gunicorn)
+#   буфер записывается обработчиком atexit;
+# - при аварийном завершении процесса (SIGKILL, OOM, падение контейнера)
+#   теряются приращения, накопленные за последний интервал;
+# - если пачку записать не удалось, игроки записываются по одному:
+#   при недоступной базе (OperationalError, InterfaceError) незаписанные
+#   приращения возвращаются в буфер и записываются при следующей попытке,
+#   приращение, которое база отвергла (например, переполнение поля),
+#   или вызвавшее другую ошибку, пишется в лог и отбрасывается;
+# - приращения игроков, удалённых до записи, пишутся в лог и отбрасываются.
+#
+# PATCH /api/v1/player/{id} всегда пишется сразу: он передаёт абсолютные
+# значения и возвращает всё состояние игрока. Абсолютные значения из
+# буферов разных воркеров записывались бы в порядке записи пачек, а не
+# запросов, и более старое значение могло бы затереть новое. Приращения
+# складываются в любом порядке, поэтому частые изменения счёта
+# отправляются через POST /api/v1/player/{id}/increment/.
+
+
+class WriteBehindBuffer:
+    def __init__(self, interval, max_players):
+        self.interval = interval
+        self.max_players = max_players
+        self.lock = threading.Lock()
+        self.deltas = {}
+        self.timer = None
+        self.pid = os.getpid()
+
+    def _merge(self, player_id, deltas):
+        pending = self.deltas.setdefault(player_id, dict.fromkeys(INCREMENT_FIELDS, 0))
+        for field in INCREMENT_FIELDS:
+            pending[field] += deltas.get(field, 0)
+
+    def _schedule(self):
+        if self.timer is None:
+            self.timer = threading.Timer(self.interval, self.flush_in_thread)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def add(self, player_id, deltas):
+        with self.lock:
+            self._merge(player_id, deltas)
+            full = len(self.deltas) >= self.max_players
+            if not full:
+                self._schedule()
+        if full:
+            self.flush()
+
+    def take(self):
+        with self.lock:
+            deltas, self.deltas = self.deltas, {}
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        return deltas
+
+    def restore(self, deltas):
+        # Незаписанные приращения складываются с накопленными за это время
+        with self.lock:
+            for player_id, player_deltas in deltas.items():
+                self._merge(player_id, player_deltas)
+            self._schedule()
+
+    def flush(self):
+        deltas = self.take()
+        if not deltas:
+            return 0
+        try:
+            written = increment_players(deltas)
+        except Exception:
+            logger.exception('Write-behind flush of %d players failed', len(deltas))
+            return self.flush_each(deltas)
+        self.report_missing(deltas, written)
+        return len(written)
+
+    def report_missing(self, deltas, written):
+        for player_id in deltas.keys() - written.keys():
+            logger.warning('Dropped write-behind deltas of deleted player %d: %r',
+                           player_id, deltas[player_id])
+
+    def flush_each(self, deltas):
+        # Одно ошибочное приращение не должно блокировать запись остальных
+        written = 0
+        player_ids = list(deltas)
+        for position, player_id in enumerate(player_ids):
+            try:
+                result = increment_players({player_id: deltas[player_id]})
+            except (OperationalError, InterfaceError):
+                logger.exception('Write-behind flush failed, database is unavailable')
+                self.restore({player_id: deltas[player_id]
+                              for player_id in player_ids[position:]})
+                break
+            except Exception:
+                logger.exception('Dropped write-behind deltas of player %d: %r',
+                                 player_id, deltas[player_id])
+            else:
+                self.report_missing({player_id: deltas[player_id]}, result)
+                written += len(result)
+        return written
+
+    def flush_in_thread(self):
+        try:
+            self.flush()
+        finally:
+            connection.close()
+
+
+_buffer = None
+
+
+def get_write_behind_buffer():
+    # Включается настройкой PLAYER_WRITE_BEHIND_INTERVAL (секунды, 0 - выключено).
+    # У каждого процесса свой буфер: после fork буфер родителя не наследуется.
+    global _buffer
+    interval = settings.PLAYER_WRITE_BEHIND_INTERVAL
+    if not interval:
+        return None
+    if _buffer is None or _buffer.pid != os.getpid():
+        _buffer = WriteBehindBuffer(interval, settings.PLAYER_WRITE_BEHIND_MAX_PLAYERS)
+    return _buffer
+
+
+@atexit.register
+def flush_write_behind():
+    if _buffer is not None and _buffer.pid == os.getpid():
+        _buffer.flush()
@@ -0,0 +1,3 @@
+#!/bin/bash
+
+/opt/venv/bin/python manage.py backfill_progress || true
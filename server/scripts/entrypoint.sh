@@ -10,8 +10,14 @@ export APP_MODULE=${APP_MODULE:-"server.wsgi:application"}
 
 sleep 10
 
-/app/server/scripts/migrations.sh
-/app/server/scripts/createsuperuser.sh
-/app/server/scripts/loaddata.sh
+bash /app/server/scripts/migrations.sh
+bash /app/server/scripts/createsuperuser.sh
+bash /app/server/scripts/loaddata.sh
+bash /app/server/scripts/syncachievements.sh
+bash /app/server/scripts/rebuildleaderboard.sh
+# Досоздание строк прогресса для новых записей справочников идёт в фоне
+bash /app/server/scripts/backfillprogress.sh &
+# Очистка старой истории прироста очков раз в сутки, тоже в фоне
+bash /app/server/scripts/prunescorehistory.sh &
 
 /opt/venv/bin/gunicorn --worker-tmp-dir /dev/shm --bind "${APP_HOST}:${APP_PORT}" --log-config $LOG_CONFIG "$APP_MODULE"
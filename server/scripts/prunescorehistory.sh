@@ -0,0 +1,7 @@
+#!/bin/bash
+
+# Удаление истории прироста очков старше срока хранения раз в сутки
+while true; do
+    /opt/venv/bin/python manage.py prune_score_history || true
+    sleep 86400
+done
@@ -218,6 +218,33 @@ SPECTACULAR_SETTINGS = {
     ],
 }
 
+# Рейтинг игроков в разделяемой памяти для всех воркеров
+# (например /dev/shm/leaderboard.bin). Не задан - место и лучшие игроки
+# считаются запросами к базе данных.
+LEADERBOARD_SHARED_PATH = getenv('LEADERBOARD_SHARED_PATH')
+
+# Сколько игроков выше данного может пересчитать запрос места к базе.
+# Время запроса растёт с местом (около 260 мс в середине рейтинга из
+# 5 млн игроков), поэтому место ниже этой границы определяется только
+# рейтингом в разделяемой памяти, иначе ответ - 503.
+LEADERBOARD_DB_PLACE_LIMIT = int(getenv('LEADERBOARD_DB_PLACE_LIMIT', 100000))
+
+# Отложенная запись приращений очков (POST /api/v1/player/{id}/increment/):
+# интервал записи в секундах, 0 - приращения пишутся в базу сразу.
+# Гарантии при остановке процесса описаны в api/write_behind.py.
+PLAYER_WRITE_BEHIND_INTERVAL = float(getenv('PLAYER_WRITE_BEHIND_INTERVAL', 0))
+PLAYER_WRITE_BEHIND_MAX_PLAYERS = int(getenv('PLAYER_WRITE_BEHIND_MAX_PLAYERS', 1000))
+
+# Хранение прогресса игроков (оборудование, урожай, мини-игры):
+# 'tables' - строки PlayerEquipment/PlayerHarvest/PlayerMinigame,
+# 'packed' - один документ Player.progress с битовыми масками и массивами.
+# Перед переключением данные переносятся командой pack_progress.
+PLAYER_PROGRESS_STORAGE = getenv('PLAYER_PROGRESS_STORAGE', 'tables')
+
+# Как часто процесс сверяет свой кэш справочников с версией в базе, секунды
+# (api/catalog.py). 0 - при каждом обращении.
+CATALOG_VERSION_CHECK_INTERVAL = float(getenv('CATALOG_VERSION_CHECK_INTERVAL', 5))
+
 # Domain names
 DOMAIN = getenv('DOMAIN')
 SITE_NAME = 'Game'